@@ -0,0 +1,168 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from queue import SimpleQueue, Empty
+
+import pygame
+
+# ============================================
+# ASSET STREAMING
+# ============================================
+# Images, sounds and other prepared surfaces are decoded on a small pool
+# of worker threads so the main loop never waits on disk or rasterizing.
+# A finished load is queued and only enters the cache when pump() drains
+# the queue on the main thread, once per frame; that is also where
+# display-format conversion happens, since it needs the display.
+#
+# Decoded assets live in an LRU bounded by their size in bytes. A key is
+# a tuple whose first two items name its owner, e.g.
+# ('stage', 'dream_land', 'preview'); pinning an owner (the stage being
+# played, the fighters in it) keeps all of its assets however far over
+# budget the cache gets.
+#
+#   preview = ASSETS.request(('stage', stage_id, 'preview'), render_preview, stage)
+#   if preview is None: ...draw a placeholder, it arrives on a later frame
+
+DEFAULT_WORKERS = 2
+DEFAULT_BUDGET = 64 << 20  # bytes of decoded assets kept around
+
+def init_audio():
+    # Opening the audio device is slow on some hardware, so the mixer is
+    # started by the first thing that needs a sound rather than at launch
+    if pygame.mixer.get_init() is None:
+        pygame.mixer.init()
+
+def asset_size(asset):
+    # Decoded bytes an asset holds on to
+    if isinstance(asset, pygame.Surface):
+        return asset.get_pitch() * asset.get_height()
+    if isinstance(asset, pygame.mixer.Sound):
+        frequency, fmt, channels = pygame.mixer.get_init()
+        return int(asset.get_length() * frequency) * channels * (abs(fmt) // 8)
+    return 0
+
+def convert_image(surface):
+    if pygame.display.get_surface() is None:
+        return surface
+    return surface.convert_alpha() if surface.get_flags() & pygame.SRCALPHA else surface.convert()
+
+class AssetManager:
+    def __init__(self, workers=DEFAULT_WORKERS, budget=DEFAULT_BUDGET):
+        self.workers = workers
+        self.budget = budget
+        self.pool = None          # started on first use
+        self.ready = SimpleQueue()
+        self.cache = OrderedDict()  # key -> (asset, bytes), least recent first
+        self.size = 0
+        self.pending = {}         # key -> finish callable for loads in flight
+        self.pins = {}            # group -> frozenset of owners
+        self.pinned = frozenset()
+        self.loads = 0
+        self.evictions = 0
+
+    # ---- loading ----
+
+    def submit(self, load, *args):
+        # Run load(*args) on a worker; returns its Future. For one-off
+        # jobs whose result is not an asset to cache.
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix="assets")
+        return self.pool.submit(load, *args)
+
+    def get(self, key):
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        self.cache.move_to_end(key)
+        return entry[0]
+
+    def request(self, key, load, *args, finish=None):
+        # The cached asset, or None after making sure load(*args) is on its
+        # way. finish(asset) runs on the main thread before caching.
+        asset = self.get(key)
+        if asset is not None or key in self.pending:
+            return asset
+        self.pending[key] = finish
+        ready = self.ready
+        self.submit(load, *args).add_done_callback(lambda future: ready.put((key, future)))
+        return None
+
+    def image(self, path):
+        return self.request(('image', path), pygame.image.load, path, finish=convert_image)
+
+    def sound(self, path):
+        init_audio()
+        return self.request(('sound', path), pygame.mixer.Sound, path)
+
+    def pump(self):
+        # Main thread, once per frame: move finished loads into the cache.
+        # A load that raised re-raises here.
+        count = 0
+        while True:
+            try:
+                key, future = self.ready.get_nowait()
+            except Empty:
+                return count
+            finish = self.pending.pop(key, None)
+            asset = future.result()
+            if finish is not None:
+                asset = finish(asset)
+            self.put(key, asset)
+            count += 1
+
+    def wait(self):
+        # Block until nothing is in flight; for tools and benchmarks
+        while self.pending:
+            self.ready.put(self.ready.get())
+            self.pump()
+
+    # ---- cache ----
+
+    def put(self, key, asset):
+        old = self.cache.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        size = asset_size(asset)
+        self.cache[key] = (asset, size)
+        self.size += size
+        self.loads += 1
+        self.evict()
+        return asset
+
+    def evict(self):
+        if self.size <= self.budget:
+            return
+        # The newest entry stays even when it alone is over budget, or it
+        # would be requested again every frame
+        for key in list(self.cache)[:-1]:
+            if key[:2] in self.pinned:
+                continue
+            asset, size = self.cache.pop(key)
+            self.size -= size
+            self.evictions += 1
+            if self.size <= self.budget:
+                return
+
+    def pin(self, group, owners):
+        # Replace the owners pinned under group, e.g.
+        # pin('battle', [('stage', 'dream_land'), ('fighter', 'Mario')]);
+        # whatever drops out becomes evictable again
+        if owners:
+            self.pins[group] = frozenset(owners)
+        else:
+            self.pins.pop(group, None)
+        self.pinned = frozenset().union(*self.pins.values())
+        self.evict()
+
+    def discard(self, key):
+        entry = self.cache.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def clear(self):
+        self.cache.clear()
+        self.size = 0
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
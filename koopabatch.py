@@ -0,0 +1,343 @@
+import argparse
+import csv
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from multiprocessing import Pool
+
+from koopasim import (
+    STAGES, CHARACTER_ROSTER, FPS, Match, PlayerState,
+    INPUT_LEFT, INPUT_RIGHT, INPUT_JUMP, INPUT_DOWN, INPUT_ATTACK, INPUT_SHIELD,
+)
+
+# ============================================
+# HEADLESS BATCH MATCH RUNNER
+# ============================================
+# Plays the character x character x stage grid without a display, spread
+# over a process pool, and aggregates the results for balance checks:
+# win rates, the frames on which stocks were lost and the damage fighters
+# had when they were knocked out.
+#
+#   python -m koopabatch --policy chase --repeats 4 --json grid.json --csv grid.csv
+#
+# Every match gets its own seed derived from --seed and its place in the
+# grid, so a run is reproducible regardless of how many workers play it.
+
+DEFAULT_MAX_FRAMES = 8 * 60 * FPS  # eight minute time limit
+
+# ============================================
+# INPUT POLICIES
+# ============================================
+# A policy factory takes a seed and returns policy(match, index) -> the
+# INPUT_* bits for one player on the next frame.
+
+def random_policy(seed, change_chance=0.1):
+    # Held buttons that change at random, like a mashing player
+    rng = random.Random(seed)
+    held = 0
+    def policy(match, index):
+        nonlocal held
+        if rng.random() < change_chance:
+            held = rng.randrange(64)
+        return held
+    return policy
+
+def idle_policy(seed):
+    def policy(match, index):
+        return 0
+    return policy
+
+def chase_policy(seed, mistake_chance=0.05):
+    # Scripted opponent: walks at the nearest fighter and attacks in range,
+    # heads back to the main platform when knocked off. A few random inputs
+    # keep mirror matches from playing out identically.
+    rng = random.Random(seed)
+    def policy(match, index):
+        me = match.players[index]
+        if rng.random() < mistake_chance:
+            return rng.randrange(64)
+        main = match.stage.platforms[0]
+        left = main['x']
+        right = main['x'] + main['width']
+
+        # Recovery: back toward the stage, re-pressing jump on the way
+        if me.state == PlayerState.HANGING:
+            return INPUT_JUMP if match.game_time % 2 else 0
+        if not me.grounded and not left < me.x + me.width / 2 < right:
+            bits = INPUT_RIGHT if me.x < left else INPUT_LEFT
+            if me.vy > 0 and match.game_time % 4 == 0:
+                bits |= INPUT_JUMP
+            return bits
+
+        target = None
+        for other in match.players:
+            if other is me or other.stocks <= 0:
+                continue
+            if target is None or abs(other.x - me.x) < abs(target.x - me.x):
+                target = other
+        if target is None:
+            return 0
+
+        dx = target.x - me.x
+        dy = target.y - me.y
+        if abs(dx) > 70:
+            bits = INPUT_RIGHT if dx > 0 else INPUT_LEFT
+            # Stay on the stage instead of chasing off the edge
+            if (dx > 0 and me.x + me.width + me.speed >= right) or (dx < 0 and me.x - me.speed <= left):
+                bits = 0
+        else:
+            bits = INPUT_RIGHT if dx > 0 else INPUT_LEFT
+            if (dx > 0) == me.facing_right and match.game_time % 2 == 0:
+                bits = INPUT_ATTACK
+            elif target.state == PlayerState.ATTACKING and rng.random() < 0.3:
+                bits = INPUT_SHIELD
+        if dy < -80 and me.grounded:
+            bits |= INPUT_JUMP
+        elif dy > 80 and me.grounded:
+            bits |= INPUT_DOWN
+        return bits
+    return policy
+
+def cpu_policy(seed, level=None):
+    # The 1P MODE CPU opponent (koopacpu), deciding in place so results
+    # stay reproducible. Much slower than the scripted policies.
+    from koopacpu import CpuPlayers, DEFAULT_LEVEL
+    cpus = None
+    def policy(match, index):
+        nonlocal cpus
+        if cpus is None:
+            cpus = CpuPlayers(match, {index: level or DEFAULT_LEVEL}, seed=seed)
+        return cpus.fill(match, match.prev_inputs)[index]
+    return policy
+
+POLICIES = {
+    "random": random_policy,
+    "chase": chase_policy,
+    "idle": idle_policy,
+    "cpu": cpu_policy,
+}
+
+# ============================================
+# PLAYING ONE MATCH
+# ============================================
+
+def play_match(job):
+    # job: (stage_id, characters, seed, policy names, max_frames)
+    # Returns a plain dict so results pickle cheaply back to the parent.
+    stage_id, characters, seed, policies, max_frames = job
+    match = Match(STAGES[stage_id], characters, seed=seed)
+    controllers = [POLICIES[name](seed * 31 + i) for i, name in enumerate(policies)]
+    stock_losses = [[] for c in characters]  # (frame, damage at KO) per player
+
+    while not match.over and match.game_time < max_frames:
+        stocks = [p.stocks for p in match.players]
+        damage = [p.damage for p in match.players]
+        match.step([control(match, i) for i, control in enumerate(controllers)])
+        for i, p in enumerate(match.players):
+            if p.stocks < stocks[i]:
+                stock_losses[i].append((match.game_time, damage[i]))
+
+    if match.over:
+        winner = match.winner()
+        winner = winner.player_num - 1 if winner is not None else None
+    else:
+        # Time out: most stocks left wins, a tie is a draw
+        most = max(p.stocks for p in match.players)
+        leaders = [i for i, p in enumerate(match.players) if p.stocks == most]
+        winner = leaders[0] if len(leaders) == 1 else None
+
+    return {
+        'stage': stage_id,
+        'characters': list(characters),
+        'seed': seed,
+        'frames': match.game_time,
+        'timeout': not match.over,
+        'winner': winner,
+        'stocks': [p.stocks for p in match.players],
+        'stock_losses': stock_losses,
+    }
+
+def matchup_jobs(characters, stages, repeats, seed, policies, max_frames, mirrors=True):
+    # Every ordered character pair on every stage, repeats times over.
+    # Ordered pairs keep spawn side from biasing a matchup.
+    jobs = []
+    n = 0
+    for stage_id in stages:
+        for pair in itertools.product(characters, repeat=2):
+            if not mirrors and pair[0] == pair[1]:
+                continue
+            for r in range(repeats):
+                n += 1
+                jobs.append((stage_id, pair, (seed * 1000003 + n) & 0xFFFFFFFF, policies, max_frames))
+    return jobs
+
+def run_jobs(jobs, workers=None, chunksize=4, progress=None):
+    if workers == 1:
+        results = []
+        for job in jobs:
+            results.append(play_match(job))
+            if progress:
+                progress(len(results), len(jobs))
+        return results
+    results = []
+    with Pool(workers) as pool:
+        # imap keeps results in grid order whatever order workers finish in
+        for result in pool.imap(play_match, jobs, chunksize):
+            results.append(result)
+            if progress:
+                progress(len(results), len(jobs))
+    return results
+
+# ============================================
+# AGGREGATION
+# ============================================
+
+class _Tally:
+    def __init__(self):
+        self.matches = 0
+        self.wins = 0
+        self.losses = 0
+        self.draws = 0
+        self.kos_taken = 0
+        self.ko_frames = 0
+        self.ko_damage = 0.0
+
+    def add(self, result, index):
+        self.matches += 1
+        if result['winner'] is None:
+            self.draws += 1
+        elif result['winner'] == index:
+            self.wins += 1
+        else:
+            self.losses += 1
+        for frame, damage in result['stock_losses'][index]:
+            self.kos_taken += 1
+            self.ko_frames += frame
+            self.ko_damage += damage
+
+    def to_dict(self):
+        return {
+            'matches': self.matches,
+            'wins': self.wins,
+            'losses': self.losses,
+            'draws': self.draws,
+            'win_rate': self.wins / self.matches if self.matches else 0.0,
+            'stocks_lost': self.kos_taken,
+            'mean_stock_loss_frame': self.ko_frames / self.kos_taken if self.kos_taken else None,
+            'mean_ko_percent': self.ko_damage / self.kos_taken if self.kos_taken else None,
+        }
+
+def aggregate(results):
+    characters = {}
+    stages = {}
+    matchups = {}
+    for result in results:
+        stage_id = result['stage']
+        for i, key in enumerate(result['characters']):
+            opponents = result['characters'][:i] + result['characters'][i + 1:]
+            characters.setdefault(key, _Tally()).add(result, i)
+            stages.setdefault((stage_id, key), _Tally()).add(result, i)
+            for opponent in opponents:
+                matchups.setdefault((key, opponent, stage_id), _Tally()).add(result, i)
+    frames = [r['frames'] for r in results]
+    return {
+        'matches': len(results),
+        'timeouts': sum(1 for r in results if r['timeout']),
+        'mean_frames': sum(frames) / len(frames) if frames else 0,
+        'characters': {key: t.to_dict() for key, t in sorted(characters.items())},
+        'stages': [dict(stage=s, character=c, **t.to_dict()) for (s, c), t in sorted(stages.items())],
+        'matchups': [dict(character=c, opponent=o, stage=s, **t.to_dict())
+                     for (c, o, s), t in sorted(matchups.items())],
+    }
+
+MATCHUP_COLUMNS = ('character', 'opponent', 'stage', 'matches', 'wins', 'losses', 'draws',
+                   'win_rate', 'stocks_lost', 'mean_stock_loss_frame', 'mean_ko_percent')
+
+def write_csv(path, summary):
+    # One row per (character, opponent, stage)
+    f = sys.stdout if path == "-" else open(path, "w", newline="")
+    try:
+        writer = csv.DictWriter(f, MATCHUP_COLUMNS)
+        writer.writeheader()
+        writer.writerows(summary['matchups'])
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+def write_json(path, summary, results=None):
+    data = dict(summary)
+    if results is not None:
+        data['results'] = results
+    if path == "-":
+        json.dump(data, sys.stdout, indent=1)
+        print()
+    else:
+        with open(path, "w") as f:
+            json.dump(data, f, indent=1)
+
+# ============================================
+# COMMAND LINE
+# ============================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Play the matchup grid headlessly and report balance stats")
+    parser.add_argument("--characters", nargs="+", default=list(CHARACTER_ROSTER),
+                        choices=list(CHARACTER_ROSTER), metavar="KEY")
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=list(STAGES), metavar="STAGE")
+    parser.add_argument("--repeats", type=int, default=1, help="matches per character pair per stage")
+    parser.add_argument("--policy", default="chase", choices=sorted(POLICIES),
+                        help="input policy for every player")
+    parser.add_argument("--opponent-policy", choices=sorted(POLICIES),
+                        help="input policy for player 2 (default: same as --policy)")
+    parser.add_argument("--no-mirrors", action="store_true", help="skip mirror matches")
+    parser.add_argument("--max-frames", type=int, default=DEFAULT_MAX_FRAMES)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="worker processes (1 runs in this process)")
+    parser.add_argument("--json", metavar="PATH", help="write the summary as JSON ('-' for stdout)")
+    parser.add_argument("--csv", metavar="PATH", help="write per-matchup rows as CSV ('-' for stdout)")
+    parser.add_argument("--include-matches", action="store_true",
+                        help="add every match result to the JSON output")
+    args = parser.parse_args(argv)
+
+    policies = (args.policy, args.opponent_policy or args.policy)
+    jobs = matchup_jobs(args.characters, args.stages, args.repeats, args.seed,
+                        policies, args.max_frames, mirrors=not args.no_mirrors)
+    if not jobs:
+        print("nothing to play", file=sys.stderr)
+        return 2
+
+    start = time.perf_counter()
+    def progress(done, total):
+        if done == total or done % 100 == 0:
+            elapsed = time.perf_counter() - start
+            print(f"\r{done}/{total} matches ({done / elapsed:.1f}/s)", end="", file=sys.stderr)
+    results = run_jobs(jobs, args.workers, progress=progress)
+    print(file=sys.stderr)
+
+    summary = aggregate(results)
+    summary['policies'] = list(policies)
+    summary['seed'] = args.seed
+    summary['max_frames'] = args.max_frames
+    if args.json:
+        write_json(args.json, summary, results if args.include_matches else None)
+    if args.csv:
+        write_csv(args.csv, summary)
+
+    if args.json != "-" and args.csv != "-":
+        elapsed = time.perf_counter() - start
+        frames = sum(r['frames'] for r in results)
+        print(f"{len(results)} matches, {frames} frames in {elapsed:.1f}s "
+              f"({frames / elapsed:.0f} frames/s), {summary['timeouts']} timeouts")
+        ranked = sorted(summary['characters'].items(), key=lambda item: -item[1]['win_rate'])
+        for key, stats in ranked:
+            ko = stats['mean_ko_percent']
+            ko = f"{ko:5.1f}%" if ko is not None else "    -"
+            print(f"  {key:<11} win {stats['win_rate']:6.1%}  KO at {ko}  ({stats['matches']} matches)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
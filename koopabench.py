@@ -0,0 +1,432 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+# Rendering is measured off-screen; must be set before pygame opens a display
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+from koopasim import STAGES, CHARACTER_ROSTER, FPS, Match
+
+# ============================================
+# BENCHMARK SUITE
+# ============================================
+# Reproducible performance numbers for the engine:
+#   sim      headless ticks/sec for every stage with 2, 4 and 8 fighters,
+#            plus item-rain party matches with hundreds of live items
+#   render   frames/sec of each screen through SDL's dummy video driver
+#   memory   per-frame allocation behaviour of the same workloads
+#   startup  wall time from launching a fresh interpreter to the first
+#            main menu frame
+#
+# Every workload uses fixed seeds and scripted inputs, and timings are the
+# best of several repeats in process CPU time, so two runs on one machine
+# agree closely even when other work shares the box.
+#
+#   python -m koopabench --output bench.json
+#   python -m koopabench --baseline bench_baseline.json --threshold 0.15
+#
+# With --baseline the exit status is 1 when any metric regressed by more
+# than the threshold, which is what build gates check.
+
+FIGHTER_COUNTS = (2, 4, 8)
+SCREENS = ("main_menu", "character_select", "stage_select", "battle", "battle_8", "battle_items",
+           "results")
+SECTIONS = ("sim", "render", "startup")
+DEFAULT_THRESHOLD = 0.15
+# Item-rain workloads drop an item every ITEM_RAIN frames and start from a
+# match already ITEM_WARMUP frames in, when the stage is full of them
+ITEM_RAIN = 1
+ITEM_WARMUP = 600
+RESULTS_VERSION = 1
+
+# Metric name suffix -> True when a bigger number is better
+HIGHER_IS_BETTER = {
+    'ticks_per_sec': True,
+    'fps': True,
+    'kib_per_frame': False,
+    'blocks_per_frame': False,
+    'peak_kib': False,
+    'gc_per_1k_frames': False,
+    'first_frame_ms': False,
+}
+
+# Absolute slack for small memory numbers, so noise around zero is not a
+# regression
+ABSOLUTE_SLACK = {
+    'kib_per_frame': 0.5,
+    'blocks_per_frame': 2.0,
+    'peak_kib': 64.0,
+    'gc_per_1k_frames': 5.0,
+    'first_frame_ms': 10.0,
+}
+
+def scripted_inputs(seed, players, change_chance=0.1):
+    # Same shape as a mashing player, identical on every run
+    rng = random.Random(seed)
+    held = [0] * players
+    def source(match):
+        for i in range(players):
+            if rng.random() < change_chance:
+                held[i] = rng.randrange(64)
+        return held
+    return source
+
+def roster_for(count, offset=0):
+    keys = list(CHARACTER_ROSTER)
+    return [keys[(offset + i) % len(keys)] for i in range(count)]
+
+def best_of(repeats, run):
+    # run() -> (units, seconds); returns the best units per second.
+    # Like timeit, the collector is kept out of the timed runs so garbage
+    # left by earlier workloads does not land on a later one.
+    best = 0.0
+    enabled = gc.isenabled()
+    try:
+        for r in range(repeats):
+            gc.collect()
+            gc.disable()
+            units, seconds = run()
+            if enabled:
+                gc.enable()
+            if seconds > 0:
+                best = max(best, units / seconds)
+    finally:
+        if enabled:
+            gc.enable()
+    return best
+
+# ============================================
+# MEMORY
+# ============================================
+
+def measure_memory(frame, frames):
+    # Allocation behaviour of frame() over a warmed-up stretch:
+    # net KiB and memory blocks kept per frame, peak traced KiB above the
+    # starting point, and generation-0 collections per 1000 frames (a
+    # proxy for container churn)
+    for i in range(min(60, frames)):
+        frame()
+    gc.collect()
+    collections = gc.get_stats()[0]['collections']
+    tracemalloc.start()
+    start_bytes = tracemalloc.get_traced_memory()[0]
+    blocks = sys.getallocatedblocks()
+    try:
+        for i in range(frames):
+            frame()
+        current, peak = tracemalloc.get_traced_memory()
+        blocks = sys.getallocatedblocks() - blocks
+    finally:
+        tracemalloc.stop()
+    collections = gc.get_stats()[0]['collections'] - collections
+    return {
+        'kib_per_frame': max(current - start_bytes, 0) / 1024 / frames,
+        'blocks_per_frame': max(blocks, 0) / frames,
+        'peak_kib': max(peak - start_bytes, 0) / 1024,
+        'gc_per_1k_frames': collections * 1000 / frames,
+    }
+
+# ============================================
+# SIMULATION
+# ============================================
+
+def item_rain_match(stage_id, characters, inputs):
+    match = Match(STAGES[stage_id], characters, seed=1234, items=ITEM_RAIN)
+    for i in range(ITEM_WARMUP):
+        match.step(inputs(match))
+    return match
+
+def sim_workload(stage_id, count, items=False):
+    # Returns frame() stepping a match that restarts whenever it ends.
+    # Item-rain matches restart from a snapshot taken after the warm-up.
+    state = {}
+    if items:
+        warm = item_rain_match(stage_id, roster_for(count), scripted_inputs(98, count))
+        snapshot = warm.save_state()
+    def new_match():
+        state['inputs'] = scripted_inputs(99, count)
+        if items:
+            warm.load_state(snapshot)
+            state['match'] = warm
+        else:
+            state['match'] = Match(STAGES[stage_id], roster_for(count), seed=1234)
+    new_match()
+    def frame():
+        match = state['match']
+        if match.over:
+            new_match()
+            match = state['match']
+        match.step(state['inputs'](match))
+    return new_match, frame
+
+def bench_sim(frames, repeats, memory_frames):
+    results = {}
+    for stage_id in STAGES:
+        for count in FIGHTER_COUNTS:
+            reset, frame = sim_workload(stage_id, count)
+            def run():
+                reset()
+                start = time.process_time()
+                for i in range(frames):
+                    frame()
+                return frames, time.process_time() - start
+            entry = {'ticks_per_sec': best_of(repeats, run)}
+            # Allocation behaviour hardly varies by stage; sample one
+            if memory_frames and stage_id == "dream_land":
+                reset()
+                entry.update(measure_memory(frame, memory_frames))
+            results[f"{stage_id}/{count}"] = entry
+    for count in FIGHTER_COUNTS:
+        reset, frame = sim_workload("dream_land", count, items=True)
+        def run():
+            reset()
+            start = time.process_time()
+            for i in range(frames):
+                frame()
+            return frames, time.process_time() - start
+        entry = {'ticks_per_sec': best_of(repeats, run)}
+        if memory_frames:
+            reset()
+            entry.update(measure_memory(frame, memory_frames))
+        results[f"items/{count}"] = entry
+    return results
+
+# ============================================
+# RENDERING
+# ============================================
+
+def new_battle(screen, characters):
+    if screen == "battle_items":
+        return item_rain_match("dream_land", characters, scripted_inputs(5, len(characters)))
+    return Match(STAGES["dream_land"], characters, seed=1234)
+
+def screen_workload(game, screen):
+    # Puts the engine on one screen and returns frame() for it
+    import pygame
+    import koopahdrv0 as front
+    from koopainput import DEFAULT_KEYS
+    game.frame_dt = 1.0 / FPS
+    game.keys_pressed = set()
+    game.keys_just_pressed = set()
+    # Default bindings whatever the machine has saved
+    game.controls = front.InputManager(front.default_bindings())
+    front.STAGE_LAYERS.invalidate()
+    game.compositor.invalidate()
+
+    if screen == "main_menu":
+        game.state = front.GameState.MAIN_MENU
+        game.main_menu = front.MainMenu()
+    elif screen == "character_select":
+        game.state = front.GameState.CHARACTER_SELECT
+        game.character_select = front.CharacterSelect()
+    elif screen == "stage_select":
+        game.state = front.GameState.STAGE_SELECT
+        game.stage_select = front.StageSelect()
+    else:
+        # battle_8 is a full eight-fighter match; six of them only idle.
+        # battle_items is a two-fighter match deep into item rain.
+        game.characters = roster_for(8 if screen == "battle_8" else 2)
+        game.match = new_battle(screen, game.characters)
+        game.recorder = None
+        game.timestep.reset()
+        game.state = front.GameState.RESULTS if screen == "results" else front.GameState.BATTLE
+
+    inputs = scripted_inputs(7, 2)
+    held = [0, 0]
+    def frame():
+        if screen in ("battle", "battle_8", "battle_items"):
+            if game.match.over or game.state != front.GameState.BATTLE:
+                game.match = new_battle(screen, game.characters)
+                game.state = front.GameState.BATTLE
+            # Scripted input arrives as key events, as a player's would
+            now = time.perf_counter()
+            for i, bits in enumerate(inputs(game.match)):
+                for bit, key in DEFAULT_KEYS[i].items():
+                    if (bits ^ held[i]) & bit:
+                        kind = pygame.KEYDOWN if bits & bit else pygame.KEYUP
+                        game.controls.feed(pygame.event.Event(kind, key=key), now)
+                held[i] = bits
+        game.update()
+        game.draw()
+    return frame
+
+def bench_render(frames, repeats, memory_frames):
+    import pygame
+    import koopahdrv0 as front
+    game = front.SmashBros64Engine()
+    results = {}
+    try:
+        for screen in SCREENS:
+            frame = screen_workload(game, screen)
+            frame()  # first frame builds caches
+            front.ASSETS.wait()
+            def run():
+                start = time.process_time()
+                for i in range(frames):
+                    frame()
+                return frames, time.process_time() - start
+            entry = {'fps': best_of(repeats, run)}
+            if memory_frames:
+                entry.update(measure_memory(frame, memory_frames))
+            results[screen] = entry
+    finally:
+        pygame.quit()
+    return results
+
+# ============================================
+# STARTUP
+# ============================================
+# A new interpreter imports the front-end, opens the window and draws the
+# main menu, then reports back; the clock runs from spawning the process,
+# so interpreter start and every import are included.
+
+STARTUP_SCRIPT = """
+import koopahdrv0
+game = koopahdrv0.SmashBros64Engine()
+game.handle_events()
+game.update()
+game.draw()
+print("ready", flush=True)
+koopahdrv0.ASSETS.shutdown()
+"""
+
+def bench_startup(repeats):
+    env = dict(os.environ, PYGAME_HIDE_SUPPORT_PROMPT="1")
+    root = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for r in range(repeats):
+        start = time.perf_counter()
+        child = subprocess.Popen([sys.executable, "-c", STARTUP_SCRIPT], cwd=root, env=env,
+                                 stdout=subprocess.PIPE, text=True)
+        line = child.stdout.readline()
+        elapsed = (time.perf_counter() - start) * 1000
+        child.communicate()
+        if line.strip() != "ready" or child.returncode:
+            raise RuntimeError("startup benchmark: the front-end failed to start")
+        best = elapsed if best is None else min(best, elapsed)
+    return {'main_menu': {'first_frame_ms': best}}
+
+# ============================================
+# RESULTS AND BASELINES
+# ============================================
+
+def run_suite(quick=False, sections=SECTIONS, memory=True):
+    sim_frames, render_frames, repeats, memory_frames = (600, 60, 3, 120) if quick else (3000, 300, 5, 600)
+    if not memory:
+        memory_frames = 0
+    results = {
+        'version': RESULTS_VERSION,
+        'meta': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'system': platform.system(),
+            'quick': quick,
+            'sim_frames': sim_frames,
+            'render_frames': render_frames,
+            'repeats': repeats,
+        },
+    }
+    if "sim" in sections:
+        results['sim'] = bench_sim(sim_frames, repeats, memory_frames)
+    if "render" in sections:
+        results['render'] = bench_render(render_frames, repeats, memory_frames)
+    if "startup" in sections:
+        results['startup'] = bench_startup(repeats)
+    return results
+
+def flatten(results):
+    # "section/workload/metric" -> value for every comparable metric
+    metrics = {}
+    for section in SECTIONS:
+        for workload, entry in results.get(section, {}).items():
+            for metric, value in entry.items():
+                if metric in HIGHER_IS_BETTER:
+                    metrics[f"{section}/{workload}/{metric}"] = value
+    return metrics
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    # Returns (name, baseline, current, change, regressed) for each metric
+    # present in both runs; change is relative, positive means better
+    current = flatten(results)
+    rows = []
+    for name, old in sorted(flatten(baseline).items()):
+        if name not in current:
+            continue
+        new = current[name]
+        metric = name.rsplit("/", 1)[1]
+        if HIGHER_IS_BETTER[metric]:
+            change = (new - old) / old if old else 0.0
+            regressed = new < old * (1 - threshold)
+        else:
+            change = (old - new) / old if old else (0.0 if new == old else -1.0)
+            regressed = new > old * (1 + threshold) + ABSOLUTE_SLACK.get(metric, 0.0)
+        rows.append((name, old, new, change, regressed))
+    return rows
+
+def print_results(results, file=sys.stdout):
+    for section in SECTIONS:
+        entries = results.get(section)
+        if not entries:
+            continue
+        print(f"[{section}]", file=file)
+        for workload, entry in entries.items():
+            fields = "  ".join(f"{metric} {value:,.1f}" for metric, value in entry.items())
+            print(f"  {workload:<22}{fields}", file=file)
+
+def print_comparison(rows, threshold, file=sys.stdout):
+    regressions = [row for row in rows if row[4]]
+    for name, old, new, change, regressed in rows:
+        if regressed or abs(change) > threshold:
+            mark = "REGRESSION" if regressed else "improved" if change > 0 else "slower (within slack)"
+            print(f"  {name:<48}{old:12.1f} -> {new:12.1f}  {change:+7.1%}  {mark}", file=file)
+    print(f"{len(rows)} metrics compared, {len(regressions)} regressed beyond {threshold:.0%}", file=file)
+    return regressions
+
+# ============================================
+# COMMAND LINE
+# ============================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Engine performance benchmarks")
+    parser.add_argument("--quick", action="store_true", help="shorter runs for a fast sanity check")
+    parser.add_argument("--only", choices=SECTIONS, help="run one section")
+    parser.add_argument("--no-memory", action="store_true", help="skip the allocation measurements")
+    parser.add_argument("--output", metavar="PATH", help="write results as JSON")
+    parser.add_argument("--baseline", metavar="PATH", help="compare against a stored results file")
+    parser.add_argument("--save-baseline", metavar="PATH", help="also store these results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="relative change that counts as a regression (default 0.15)")
+    args = parser.parse_args(argv)
+
+    sections = (args.only,) if args.only else SECTIONS
+    results = run_suite(args.quick, sections, memory=not args.no_memory)
+    print_results(results)
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('version') != RESULTS_VERSION:
+            print(f"{args.baseline}: baseline format {baseline.get('version')} != {RESULTS_VERSION}")
+            return 2
+        if baseline.get('meta', {}).get('quick') != results['meta']['quick']:
+            print("warning: baseline and this run used different --quick settings")
+        if print_comparison(compare(results, baseline, args.threshold), args.threshold):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
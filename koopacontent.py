@@ -0,0 +1,673 @@
+import hashlib
+import mmap
+import os
+import struct
+import sys
+
+# ============================================
+# CONTENT PACKS
+# ============================================
+# Stages and characters are data. A content pack is a .json or .toml file
+# with a "stages" table and a "characters" table; the built-in roster is
+# content/base.json and every pack named on KOOPA_CONTENT_PATH (files or
+# directories, separated like PATH) is read after it, so a later pack can
+# add entries or replace one with the same id.
+#
+# Packs are validated once, when they change, and compiled into a single
+# binary cache keyed by a SHA-256 of every pack's bytes. Normal starts
+# memory-map that file and unpack fixed-size records straight into the
+# plain dicts koopasim builds Stage and CharacterData objects from, with
+# no parsing or validation. Nothing here imports the simulation.
+#
+# Cache layout (little endian):
+#   magic 'KPAK', u16 version, 32-byte digest, then u32 counts of stages,
+#   platforms, points, shapes, keyframes, hazards, characters, moves and
+#   hitboxes and the string table size
+#   stage records, platform records, points, shape records, keyframes,
+#   hazard records, character records, move records, hitbox records, then
+#   the string table (NUL-separated UTF-8)
+# A stage record is followed in the tables by its own platforms, spawn
+# points, shapes and hazards in order; every shape owns its next
+# point_count points, and every platform then every hazard of a stage its
+# next keyframe_count keyframes. Likewise a character owns its next moves
+# and a move its next hitboxes.
+
+CONTENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "content")
+CONTENT_PATH_ENV = "KOOPA_CONTENT_PATH"
+CACHE_DIR_ENV = "KOOPA_CACHE_DIR"
+CACHE_NAME = "content.kpak"
+CACHE_MAGIC = b"KPAK"
+CACHE_VERSION = 4
+PACK_EXTENSIONS = (".json", ".toml")
+
+# Background layer primitives and how many numbers each takes
+SHAPES = ("rect", "ellipse", "circle", "polygon")
+SHAPE_SIZES = {"rect": 4, "ellipse": 4, "circle": 3}
+
+# Attack moves a character can define; "neutral" is required and stands
+# in for any other it leaves out
+MOVE_NAMES = ("neutral", "forward", "down", "air")
+
+# Entity kinds the simulation knows; a move can throw any of them as its
+# projectile
+ENTITY_NAMES = ("fireball", "laser", "shot", "thunder", "bomb", "shell")
+
+NO_STRING = 0xFFFF
+
+_HEADER = struct.Struct("<4sH32s10I")
+# Numbers are stored as doubles plus a mask of the ones that were ints
+_STAGE = struct.Struct("<3H3BB4d4H")         # id, name, scenery, bg rgb, mask, blast zones, counts
+_PLATFORM = struct.Struct("<4dB3B?H")        # x, y, width, height, mask, rgb, solid, keyframe count
+_POINT = struct.Struct("<2dB")               # x, y, mask
+_SHAPE = struct.Struct("<5BH")               # shape, rgba, point count
+_KEYFRAME = struct.Struct("<H2dB")           # frame, offset, mask
+_HAZARD = struct.Struct("<4B8dBH?3H")        # rgba, box, damage, knockback, mask, keyframe count,
+                                             # scheduled, first frame, period, active frames
+_CHARACTER = struct.Struct("<2H3Bx4dBH")     # key, name, rgb, stats, mask, move count
+_MOVE = struct.Struct("<7H2dB")              # name, startup, active, recovery, hitbox count,
+                                             # projectile kind, frame, offset, mask
+_HITBOX = struct.Struct("<2H8dB")            # first and last frame, box, damage, knockback, mask
+
+class ContentError(Exception):
+    pass
+
+# ============================================
+# VALIDATION
+# ============================================
+# Turns one parsed pack into plain records, raising ContentError with the
+# offending path on the first problem. Numbers keep whatever int/float
+# type the pack gave them: simulation state, and with it replay digests,
+# depends on whether a stat was 1 or 1.0.
+
+def _fields(table, where, required, optional=()):
+    if not isinstance(table, dict):
+        raise ContentError(f"{where} must be a table")
+    for key in table:
+        if key not in required and key not in optional:
+            raise ContentError(f"{where}: unknown field {key!r}")
+    for key in required:
+        if key not in table:
+            raise ContentError(f"{where}: missing field {key!r}")
+    return table
+
+def _check_number(value, where, minimum=None, positive=False):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ContentError(f"{where} must be a number")
+    if positive and value <= 0:
+        raise ContentError(f"{where} must be greater than 0")
+    if minimum is not None and value < minimum:
+        raise ContentError(f"{where} must be at least {minimum}")
+    return value
+
+def _check_numbers(value, where, count=None):
+    if not isinstance(value, list) or (count is not None and len(value) != count):
+        raise ContentError(f"{where} must be a list of {count or 'some'} numbers")
+    return tuple(_check_number(v, f"{where}[{i}]") for i, v in enumerate(value))
+
+def _check_color(value, where):
+    if (not isinstance(value, list) or len(value) not in (3, 4) or
+            any(isinstance(c, bool) or not isinstance(c, int) or not 0 <= c <= 255 for c in value)):
+        raise ContentError(f"{where} must be 3 or 4 integers from 0 to 255")
+    # Fully opaque is stored as plain RGB, as the cache decodes it
+    return tuple(value[:3] if len(value) == 4 and value[3] == 255 else value)
+
+def _check_id(value, where):
+    # Replays store ids with a one byte length
+    if not value or len(value.encode()) > 255:
+        raise ContentError(f"{where}: ids must be 1 to 255 bytes")
+    return value
+
+def _check_text(value, where):
+    if not isinstance(value, str) or not value:
+        raise ContentError(f"{where} must be a non-empty string")
+    return value
+
+def _check_frames(value, where, minimum=0):
+    if isinstance(value, bool) or not isinstance(value, int) or not minimum <= value <= 0xFFFF:
+        raise ContentError(f"{where} must be a whole number of frames")
+    return value
+
+def _check_path(value, where):
+    # A motion path is keyframes [frame, dx, dy], offsets from where the
+    # thing is placed. Frames count up from 0; the last one is the length
+    # of the loop, and the path starts over from the first keyframe there.
+    if not isinstance(value, list) or len(value) < 2:
+        raise ContentError(f"{where} must list at least 2 keyframes")
+    path = []
+    for i, key in enumerate(value):
+        at = f"{where}[{i}]"
+        if not isinstance(key, list) or len(key) != 3:
+            raise ContentError(f"{at} must be [frame, dx, dy]")
+        frame = _check_frames(key[0], f"{at}[0]")
+        if (i == 0 and frame != 0) or (i > 0 and frame <= path[-1][0]):
+            raise ContentError(f"{at}[0]: frames must start at 0 and keep increasing")
+        path.append((frame,) + _check_numbers(key[1:], at))
+    return tuple(path)
+
+def validate_hazard(table, where):
+    # A hazard is a box that strikes any fighter touching it, knocking it
+    # back like a hitbox with angle measured away from the box's centre.
+    # It may follow a path, and with a schedule it is only out for active
+    # frames every period frames starting at frame at; its path then
+    # starts over each time it comes out.
+    _fields(table, where, ("box", "color", "damage", "base", "growth", "angle"), ("path", "schedule"))
+    box = _check_numbers(table["box"], f"{where}.box", 4)
+    if box[2] <= 0 or box[3] <= 0:
+        raise ContentError(f"{where}.box must have a positive width and height")
+    schedule = None
+    if "schedule" in table:
+        at = f"{where}.schedule"
+        times = _fields(table["schedule"], at, ("at", "every", "active"))
+        schedule = (_check_frames(times["at"], f"{at}.at"),
+                    _check_frames(times["every"], f"{at}.every", minimum=1),
+                    _check_frames(times["active"], f"{at}.active", minimum=1))
+        if schedule[2] >= schedule[1]:
+            raise ContentError(f"{at}.active must be shorter than every")
+    return {
+        'box': box,
+        'color': _check_color(table["color"], f"{where}.color"),
+        'damage': _check_number(table["damage"], f"{where}.damage", minimum=0),
+        'base': _check_number(table["base"], f"{where}.base", minimum=0),
+        'growth': _check_number(table["growth"], f"{where}.growth", minimum=0),
+        'angle': _check_number(table["angle"], f"{where}.angle"),
+        'path': _check_path(table["path"], f"{where}.path") if "path" in table else None,
+        'schedule': schedule,
+    }
+
+def validate_stage(table, where):
+    _fields(table, where, ("name", "platforms", "blast_zones", "spawn_points", "background"), ("hazards",))
+    if not isinstance(table["platforms"], list) or not table["platforms"]:
+        raise ContentError(f"{where}.platforms must list at least the main platform")
+    platforms = []
+    for i, p in enumerate(table["platforms"]):
+        at = f"{where}.platforms[{i}]"
+        # A platform with a path moves; moving platforms are one-way, and
+        # the first platform, the one fighters spawn over, stays put
+        _fields(p, at, ("x", "y", "width", "height", "color"), ("solid", "path"))
+        solid = p.get("solid", False)
+        if not isinstance(solid, bool):
+            raise ContentError(f"{at}.solid must be true or false")
+        path = _check_path(p["path"], f"{at}.path") if "path" in p else None
+        if path is not None and (solid or i == 0):
+            raise ContentError(f"{at}: only one-way platforms after the first can move")
+        platforms.append({
+            'x': _check_number(p["x"], f"{at}.x"),
+            'y': _check_number(p["y"], f"{at}.y"),
+            'width': _check_number(p["width"], f"{at}.width", positive=True),
+            'height': _check_number(p["height"], f"{at}.height", positive=True),
+            'color': _check_color(p["color"], f"{at}.color")[:3],
+            'solid': solid,
+            'path': path,
+        })
+
+    at = f"{where}.blast_zones"
+    zones = _fields(table["blast_zones"], at, ("left", "right", "top", "bottom"))
+    blast_zones = tuple(_check_number(zones[k], f"{at}.{k}") for k in ("left", "right", "top", "bottom"))
+    if blast_zones[0] >= blast_zones[1] or blast_zones[2] >= blast_zones[3]:
+        raise ContentError(f"{at} must enclose an area")
+
+    if not isinstance(table["spawn_points"], list) or not table["spawn_points"]:
+        raise ContentError(f"{where}.spawn_points must list at least one point")
+    spawn_points = [_check_numbers(p, f"{where}.spawn_points[{i}]", 2)
+                    for i, p in enumerate(table["spawn_points"])]
+
+    at = f"{where}.background"
+    background = _fields(table["background"], at, ("color",), ("layers", "scenery"))
+    scenery = background.get("scenery")
+    if scenery is not None:
+        _check_text(scenery, f"{at}.scenery")
+    layers = []
+    for i, layer in enumerate(background.get("layers", [])):
+        layer_at = f"{at}.layers[{i}]"
+        shapes = [shape for shape in SHAPES if shape in layer] if isinstance(layer, dict) else []
+        if len(shapes) != 1:
+            raise ContentError(f"{layer_at} needs exactly one of {', '.join(SHAPES)}")
+        shape = shapes[0]
+        _fields(layer, layer_at, (shape, "color"))
+        if shape == "polygon":
+            if not isinstance(layer[shape], list) or len(layer[shape]) < 3:
+                raise ContentError(f"{layer_at}.polygon needs at least 3 points")
+            coords = tuple(_check_numbers(p, f"{layer_at}.polygon[{j}]", 2) for j, p in enumerate(layer[shape]))
+        else:
+            coords = _check_numbers(layer[shape], f"{layer_at}.{shape}", SHAPE_SIZES[shape])
+        layers.append((shape, _check_color(layer["color"], f"{layer_at}.color"), coords))
+
+    hazards = table.get("hazards", [])
+    if not isinstance(hazards, list):
+        raise ContentError(f"{where}.hazards must be a list")
+    hazards = [validate_hazard(h, f"{where}.hazards[{i}]") for i, h in enumerate(hazards)]
+
+    return {
+        'name': _check_text(table["name"], f"{where}.name"),
+        'platforms': platforms,
+        'blast_zones': blast_zones,
+        'spawn_points': spawn_points,
+        'bg_color': _check_color(background["color"], f"{at}.color")[:3],
+        'layers': layers,
+        'scenery': scenery,
+        'hazards': hazards,
+    }
+
+def validate_move(table, where):
+    # Frames are numbered from 1, the first frame after the button press.
+    # A hitbox is out on frames first..last, by default the whole active
+    # window; its box is x, y, width, height with x measured forward from
+    # the front of the fighter and y down from its top. angle is degrees
+    # above horizontal, toward the way the attacker faces. A projectile is
+    # thrown on one frame, offset like a hitbox box from the fighter.
+    _fields(table, where, ("startup", "active", "recovery", "hitboxes"), ("projectile",))
+    startup = _check_frames(table["startup"], f"{where}.startup")
+    active = _check_frames(table["active"], f"{where}.active", minimum=1)
+    recovery = _check_frames(table["recovery"], f"{where}.recovery")
+    if startup + active + recovery > 0xFFFF:
+        raise ContentError(f"{where} lasts too many frames")
+    if not isinstance(table["hitboxes"], list) or not table["hitboxes"]:
+        raise ContentError(f"{where}.hitboxes must list at least one hitbox")
+    hitboxes = []
+    for i, h in enumerate(table["hitboxes"]):
+        at = f"{where}.hitboxes[{i}]"
+        _fields(h, at, ("box", "damage", "base", "growth", "angle"), ("frames",))
+        if "frames" in h:
+            frames = h["frames"]
+            if not isinstance(frames, list) or len(frames) != 2:
+                raise ContentError(f"{at}.frames must be [first, last]")
+            first, last = (_check_frames(f, f"{at}.frames[{k}]") for k, f in enumerate(frames))
+            if not startup < first <= last <= startup + active:
+                raise ContentError(f"{at}.frames must lie in the active frames "
+                                   f"{startup + 1}-{startup + active}")
+        else:
+            first, last = startup + 1, startup + active
+        box = _check_numbers(h["box"], f"{at}.box", 4)
+        if box[2] <= 0 or box[3] <= 0:
+            raise ContentError(f"{at}.box must have a positive width and height")
+        hitboxes.append({
+            'frames': (first, last),
+            'box': box,
+            'damage': _check_number(h["damage"], f"{at}.damage", minimum=0),
+            'base': _check_number(h["base"], f"{at}.base", minimum=0),
+            'growth': _check_number(h["growth"], f"{at}.growth", minimum=0),
+            'angle': _check_number(h["angle"], f"{at}.angle"),
+        })
+    projectile = None
+    if "projectile" in table:
+        at = f"{where}.projectile"
+        p = _fields(table["projectile"], at, ("kind", "frame", "offset"))
+        if p["kind"] not in ENTITY_NAMES:
+            raise ContentError(f"{at}.kind must be one of {', '.join(ENTITY_NAMES)}")
+        frame = _check_frames(p["frame"], f"{at}.frame", minimum=1)
+        if frame > startup + active + recovery:
+            raise ContentError(f"{at}.frame must be within the move")
+        projectile = {'kind': p["kind"], 'frame': frame,
+                      'offset': _check_numbers(p["offset"], f"{at}.offset", 2)}
+    return {'startup': startup, 'active': active, 'recovery': recovery, 'hitboxes': hitboxes,
+            'projectile': projectile}
+
+def validate_character(table, where):
+    _fields(table, where, ("name", "color", "speed", "jump_power", "weight", "fall_speed", "moves"))
+    at = f"{where}.moves"
+    moves = _fields(table["moves"], at, ("neutral",), MOVE_NAMES)
+    return {
+        'name': _check_text(table["name"], f"{where}.name"),
+        'color': _check_color(table["color"], f"{where}.color")[:3],
+        'speed': _check_number(table["speed"], f"{where}.speed", minimum=0),
+        'jump_power': _check_number(table["jump_power"], f"{where}.jump_power", minimum=0),
+        'weight': _check_number(table["weight"], f"{where}.weight", positive=True),
+        'fall_speed': _check_number(table["fall_speed"], f"{where}.fall_speed", positive=True),
+        'moves': {name: validate_move(moves[name], f"{at}.{name}") for name in MOVE_NAMES if name in moves},
+    }
+
+def validate_pack(data, source):
+    # -> (stages, characters) as ordered id -> record dicts
+    _fields(data, source, (), ("pack", "version", "stages", "characters"))
+    stages = {}
+    characters = {}
+    for section, out, validate in (("stages", stages, validate_stage),
+                                   ("characters", characters, validate_character)):
+        tables = data.get(section, {})
+        if not isinstance(tables, dict):
+            raise ContentError(f"{source}: {section} must be a table")
+        for entry_id, table in tables.items():
+            where = f"{source}: {section}.{entry_id}"
+            out[_check_id(entry_id, where)] = validate(table, where)
+    return stages, characters
+
+# ============================================
+# LOADING
+# ============================================
+
+def pack_paths(extra=None):
+    # Pack files in load order: the built-in packs, then KOOPA_CONTENT_PATH
+    if extra is None:
+        extra = [p for p in os.environ.get(CONTENT_PATH_ENV, "").split(os.pathsep) if p]
+    paths = []
+    for entry in [CONTENT_DIR] + list(extra):
+        if os.path.isdir(entry):
+            paths.extend(os.path.join(entry, name) for name in sorted(os.listdir(entry))
+                         if name.endswith(PACK_EXTENSIONS))
+        elif os.path.isfile(entry):
+            paths.append(entry)
+        else:
+            raise ContentError(f"{entry}: no such content pack")
+    return paths
+
+def parse_pack(path, raw):
+    # The parsers are imported here, not at the top: a start that hits the
+    # cache never needs them
+    try:
+        if path.endswith(".toml"):
+            try:
+                import tomllib
+            except ImportError:
+                raise ContentError(f"{path}: TOML packs need Python 3.11 or newer") from None
+            return tomllib.loads(raw.decode("utf-8"))
+        import json
+        return json.loads(raw)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ContentError(f"{path}: {e}") from None
+
+def content_digest(sources):
+    # sources: [(path, raw bytes)] in load order
+    h = hashlib.sha256(CACHE_MAGIC + struct.pack("<H", CACHE_VERSION))
+    for path, raw in sources:
+        name = os.path.basename(path).encode()
+        h.update(struct.pack("<HI", len(name), len(raw)))
+        h.update(name)
+        h.update(raw)
+    return h.digest()
+
+def compile_packs(sources):
+    # Validate and merge every pack; later packs win on matching ids
+    stages = {}
+    characters = {}
+    for path, raw in sources:
+        pack_stages, pack_characters = validate_pack(parse_pack(path, raw), path)
+        stages.update(pack_stages)
+        characters.update(pack_characters)
+    if not stages or not characters:
+        raise ContentError("content packs define no stages or no characters")
+    return stages, characters
+
+def cache_dir():
+    # Shared with the other build caches, e.g. the fighter sprite atlases
+    return os.environ.get(CACHE_DIR_ENV) or os.path.join(CONTENT_DIR, ".cache")
+
+def default_cache_path():
+    return os.path.join(cache_dir(), CACHE_NAME)
+
+def read_sources(paths):
+    sources = []
+    for path in paths:
+        with open(path, "rb") as f:
+            sources.append((path, f.read()))
+    return sources
+
+def load_content(paths=None, cache_path=None, use_cache=True):
+    # -> (stages, characters). Reads the binary cache when it matches the
+    # packs on disk, otherwise validates the packs and rewrites it.
+    sources = read_sources(paths if paths is not None else pack_paths())
+    digest = content_digest(sources)
+    if cache_path is None:
+        cache_path = default_cache_path()
+
+    if use_cache:
+        content = read_cache(cache_path, digest)
+        if content is not None:
+            return content
+    content = compile_packs(sources)
+    if use_cache:
+        try:
+            write_cache(cache_path, digest, *content)
+        except OSError:
+            pass  # read-only install: stay uncached
+    return content
+
+# ============================================
+# BINARY CACHE
+# ============================================
+
+def _int_mask(values):
+    return sum(1 << i for i, v in enumerate(values) if isinstance(v, int))
+
+def _typed(values, mask):
+    return tuple(int(v) if mask >> i & 1 else v for i, v in enumerate(values))
+
+def encode_cache(digest, stages, characters):
+    strings = {}
+    def string(text):
+        if text is None:
+            return NO_STRING
+        return strings.setdefault(text, len(strings))
+
+    stage_rows = bytearray()
+    platform_rows = bytearray()
+    point_rows = bytearray()
+    shape_rows = bytearray()
+    keyframe_rows = bytearray()
+    hazard_rows = bytearray()
+    character_rows = bytearray()
+    move_rows = bytearray()
+    hitbox_rows = bytearray()
+    counts = [0, 0, 0, 0, 0, 0, 0, 0, 0]
+    def point(xy):
+        point_rows.extend(_POINT.pack(*xy, _int_mask(xy)))
+        counts[2] += 1
+    def keyframes(path):
+        for key in path or ():
+            keyframe_rows.extend(_KEYFRAME.pack(*key, _int_mask(key[1:])))
+            counts[4] += 1
+
+    for stage_id, s in stages.items():
+        zones = s['blast_zones']
+        stage_rows += _STAGE.pack(string(stage_id), string(s['name']), string(s['scenery']),
+                                  *s['bg_color'], _int_mask(zones), *zones,
+                                  len(s['platforms']), len(s['spawn_points']), len(s['layers']),
+                                  len(s['hazards']))
+        counts[0] += 1
+        for p in s['platforms']:
+            box = (p['x'], p['y'], p['width'], p['height'])
+            platform_rows += _PLATFORM.pack(*box, _int_mask(box), *p['color'], p['solid'],
+                                            len(p['path'] or ()))
+            counts[1] += 1
+            keyframes(p['path'])
+        for xy in s['spawn_points']:
+            point(xy)
+        for shape, color, coords in s['layers']:
+            if shape == "polygon":
+                points = coords
+            else:
+                # rect/ellipse: (x, y), (w, h); circle: (x, y), (radius, 0)
+                points = (coords[:2], (coords[2:] + (0,))[:2])
+            rgba = color if len(color) == 4 else color + (255,)
+            shape_rows += _SHAPE.pack(SHAPES.index(shape), *rgba, len(points))
+            counts[3] += 1
+            for xy in points:
+                point(xy)
+        for h in s['hazards']:
+            numbers = (*h['box'], h['damage'], h['base'], h['growth'], h['angle'])
+            color = h['color']
+            rgba = color if len(color) == 4 else color + (255,)
+            hazard_rows += _HAZARD.pack(*rgba, *numbers, _int_mask(numbers), len(h['path'] or ()),
+                                        h['schedule'] is not None, *(h['schedule'] or (0, 0, 0)))
+            counts[5] += 1
+            keyframes(h['path'])
+
+    for key, c in characters.items():
+        stats = (c['speed'], c['jump_power'], c['weight'], c['fall_speed'])
+        character_rows += _CHARACTER.pack(string(key), string(c['name']), *c['color'],
+                                          *stats, _int_mask(stats), len(c['moves']))
+        counts[6] += 1
+        for name, move in c['moves'].items():
+            projectile = move['projectile'] or {'kind': None, 'frame': 0, 'offset': (0, 0)}
+            offset = projectile['offset']
+            move_rows += _MOVE.pack(string(name), move['startup'], move['active'], move['recovery'],
+                                    len(move['hitboxes']), string(projectile['kind']), projectile['frame'],
+                                    *offset, _int_mask(offset))
+            counts[7] += 1
+            for h in move['hitboxes']:
+                numbers = (*h['box'], h['damage'], h['base'], h['growth'], h['angle'])
+                hitbox_rows += _HITBOX.pack(*h['frames'], *numbers, _int_mask(numbers))
+                counts[8] += 1
+
+    if len(strings) >= NO_STRING:
+        raise ContentError("too many names for the content cache")
+    table = "\0".join(strings).encode()
+    header = _HEADER.pack(CACHE_MAGIC, CACHE_VERSION, digest, *counts, len(table))
+    return b"".join((header, stage_rows, platform_rows, point_rows, shape_rows, keyframe_rows,
+                     hazard_rows, character_rows, move_rows, hitbox_rows, table))
+
+def decode_cache(data, digest=None):
+    # data: bytes or an mmap. Returns None when the header does not match.
+    if len(data) < _HEADER.size:
+        return None
+    (magic, version, file_digest, n_stages, n_platforms, n_points, n_shapes, n_keyframes,
+     n_hazards, n_characters, n_moves, n_hitboxes, table_size) = _HEADER.unpack_from(data)
+    if magic != CACHE_MAGIC or version != CACHE_VERSION or (digest is not None and file_digest != digest):
+        return None
+
+    view = memoryview(data)
+    pos = _HEADER.size
+    def rows(record, count):
+        nonlocal pos
+        end = pos + record.size * count
+        table = record.iter_unpack(view[pos:end])
+        pos = end
+        return table
+    try:
+        stage_rows = rows(_STAGE, n_stages)
+        platform_rows = rows(_PLATFORM, n_platforms)
+        point_rows = rows(_POINT, n_points)
+        shape_rows = rows(_SHAPE, n_shapes)
+        keyframe_rows = rows(_KEYFRAME, n_keyframes)
+        hazard_rows = rows(_HAZARD, n_hazards)
+        character_rows = rows(_CHARACTER, n_characters)
+        move_rows = rows(_MOVE, n_moves)
+        hitbox_rows = rows(_HITBOX, n_hitboxes)
+        if pos + table_size != len(data):
+            return None
+        strings = bytes(view[pos:pos + table_size]).decode().split("\0")
+
+        def points(count):
+            return [_typed((x, y), mask) for x, y, mask in (next(point_rows) for i in range(count))]
+        def path(count):
+            if not count:
+                return None
+            return tuple((frame,) + _typed((x, y), mask)
+                         for frame, x, y, mask in (next(keyframe_rows) for i in range(count)))
+
+        stages = {}
+        for row in stage_rows:
+            stage_id, name, scenery, r, g, b, mask = row[:7]
+            n_plat, n_spawn, n_shape, n_hazard = row[11:]
+            platforms = []
+            for p in (next(platform_rows) for i in range(n_plat)):
+                x, y, width, height = _typed(p[:4], p[4])
+                platforms.append({'x': x, 'y': y, 'width': width, 'height': height,
+                                  'color': p[5:8], 'solid': p[8], 'path': path(p[9])})
+            spawn_points = points(n_spawn)
+            layers = []
+            for i in range(n_shape):
+                shape, sr, sg, sb, sa, count = next(shape_rows)
+                shape = SHAPES[shape]
+                coords = tuple(points(count))
+                if shape != "polygon":
+                    coords = (coords[0] + coords[1])[:SHAPE_SIZES[shape]]
+                layers.append((shape, (sr, sg, sb) if sa == 255 else (sr, sg, sb, sa), coords))
+            hazards = []
+            for h in (next(hazard_rows) for i in range(n_hazard)):
+                x, y, width, height, damage, base, growth, angle = _typed(h[4:12], h[12])
+                hazards.append({'box': (x, y, width, height),
+                                'color': h[:3] if h[3] == 255 else h[:4],
+                                'damage': damage, 'base': base, 'growth': growth, 'angle': angle,
+                                'path': path(h[13]), 'schedule': h[15:18] if h[14] else None})
+            stages[strings[stage_id]] = {
+                'name': strings[name],
+                'platforms': platforms,
+                'blast_zones': _typed(row[7:11], mask),
+                'spawn_points': spawn_points,
+                'bg_color': (r, g, b),
+                'layers': layers,
+                'scenery': strings[scenery] if scenery != NO_STRING else None,
+                'hazards': hazards,
+            }
+
+        characters = {}
+        for row in character_rows:
+            key, name = row[:2]
+            speed, jump_power, weight, fall_speed = _typed(row[5:9], row[9])
+            moves = {}
+            for i in range(row[10]):
+                move_name, startup, active, recovery, n_hit, kind, frame, px, py, mask = next(move_rows)
+                hitboxes = []
+                for h in (next(hitbox_rows) for k in range(n_hit)):
+                    x, y, width, height, damage, base, growth, angle = _typed(h[2:10], h[10])
+                    hitboxes.append({'frames': h[:2], 'box': (x, y, width, height), 'damage': damage,
+                                     'base': base, 'growth': growth, 'angle': angle})
+                projectile = None
+                if kind != NO_STRING:
+                    projectile = {'kind': strings[kind], 'frame': frame, 'offset': _typed((px, py), mask)}
+                moves[strings[move_name]] = {'startup': startup, 'active': active, 'recovery': recovery,
+                                             'hitboxes': hitboxes, 'projectile': projectile}
+            characters[strings[key]] = {
+                'name': strings[name],
+                'color': row[2:5],
+                'speed': speed,
+                'jump_power': jump_power,
+                'weight': weight,
+                'fall_speed': fall_speed,
+                'moves': moves,
+            }
+    except (struct.error, StopIteration, IndexError, UnicodeDecodeError):
+        return None  # truncated or damaged: rebuild it
+    return stages, characters
+
+def read_cache(path, digest):
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return decode_cache(data, digest)
+    except (OSError, ValueError):
+        return None  # missing or empty file
+
+def write_cache(path, digest, stages, characters):
+    # Written beside the target and renamed into place, so a reader never
+    # maps a half-written cache
+    data = encode_cache(digest, stages, characters)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return len(data)
+
+# ============================================
+# COMMAND LINE
+# ============================================
+# python -m koopacontent mods/ another_pack.toml
+# validates packs and rebuilds the cache, reporting the first error.
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Validate content packs and rebuild the binary cache")
+    parser.add_argument("packs", nargs="*", help=f"extra packs or directories (default: ${CONTENT_PATH_ENV})")
+    parser.add_argument("--cache", metavar="PATH", help="cache file to write (default: %(default)s)",
+                        default=default_cache_path())
+    args = parser.parse_args(argv)
+
+    try:
+        paths = pack_paths(args.packs or None)
+        sources = read_sources(paths)
+        digest = content_digest(sources)
+        stages, characters = compile_packs(sources)
+    except ContentError as e:
+        print(e, file=sys.stderr)
+        return 1
+    size = write_cache(args.cache, digest, stages, characters)
+    print(f"{len(paths)} packs, {len(stages)} stages, {len(characters)} characters -> "
+          f"{args.cache} ({size} bytes, {digest.hex()[:12]})")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
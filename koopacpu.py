@@ -0,0 +1,279 @@
+import random
+from time import perf_counter
+
+import numpy as np
+
+from koopasim import (
+    STAGES, Match,
+    INPUT_LEFT, INPUT_RIGHT, INPUT_JUMP, INPUT_DOWN, INPUT_ATTACK, INPUT_SHIELD,
+)
+from koopavec import BatchSim
+
+# ============================================
+# CPU OPPONENTS - LOOKAHEAD ROLLOUTS
+# ============================================
+# A CPU player picks its inputs by trying them out. When it is due to
+# decide, the match is copied into the rows of a BatchSim, one row per
+# candidate plan, every row is played a short way ahead, and the CPU plays
+# the plan whose row ends best for it: damage dealt and taken, stocks,
+# staying over the stage and closing on the nearest opponent. Everybody
+# else is assumed to keep holding what they hold now.
+#
+# The candidates of every CPU due at once share one batch, so three CPUs
+# cost one vectorised rollout, not three. A rollout only reads a match
+# snapshot, so it can run on a worker thread while the match goes on; given
+# a deadline it stops early and scores the rows at the depth it reached.
+# Rollouts play the stage static (see koopavec).
+#
+# Difficulty is a row of CPU_LEVELS: how often the CPU decides, how many
+# frames it takes to react, how far ahead it looks over how many plans,
+# and how often it fumbles the choice.
+#
+#   cpus = CpuPlayers(match, {1: 9, 2: 9, 3: 9})
+#   match.step(cpus.fill(match, inputs))  # every tick
+
+PLAN_FRAMES = 64  # longest reaction + horizon a level may use
+
+# Candidate plans as (frame, held bits) keyframes; the last is held on.
+# Levels look at the first few, so the basics come first.
+L, R, J, D, A, S = INPUT_LEFT, INPUT_RIGHT, INPUT_JUMP, INPUT_DOWN, INPUT_ATTACK, INPUT_SHIELD
+PLANS = (
+    ('wait', ((0, 0),)),
+    ('walk left', ((0, L),)),
+    ('walk right', ((0, R),)),
+    ('attack left', ((0, L | A), (1, L))),
+    ('attack right', ((0, R | A), (1, R))),
+    ('jump', ((0, J), (1, 0))),
+    ('jump left', ((0, J | L), (1, L))),
+    ('jump right', ((0, J | R), (1, R))),
+    ('attack', ((0, A), (1, 0))),
+    ('shield', ((0, S),)),
+    ('down attack', ((0, D | A), (1, D))),
+    ('drop', ((0, D), (1, 0))),
+    ('air attack left', ((0, J | L), (1, L), (6, L | A), (7, L))),
+    ('air attack right', ((0, J | R), (1, R), (6, R | A), (7, R))),
+    ('double jump left', ((0, J | L), (1, L), (12, J | L), (13, L))),
+    ('double jump right', ((0, J | R), (1, R), (12, J | R), (13, R))),
+)
+del L, R, J, D, A, S
+
+def _plan_inputs(keyframes):
+    bits = np.zeros(PLAN_FRAMES, dtype=np.uint8)
+    for frame, held in keyframes:
+        bits[frame:] = held
+    return bits
+
+PLAN_NAMES = tuple(name for name, keyframes in PLANS)
+PLAN_INPUTS = np.array([_plan_inputs(keyframes) for name, keyframes in PLANS])
+
+class CpuLevel:
+    __slots__ = ('interval', 'reaction', 'horizon', 'plans', 'mistakes')
+
+    def __init__(self, interval, reaction, horizon, plans, mistakes):
+        self.interval = interval  # frames between decisions
+        self.reaction = reaction  # frames from seeing the match to acting on it
+        self.horizon = horizon    # frames each plan is played ahead
+        self.plans = plans        # how many of PLANS it considers
+        self.mistakes = mistakes  # chance of playing a random plan instead
+        if reaction + horizon > PLAN_FRAMES or not 0 < plans <= len(PLANS):
+            raise ValueError("CPU level out of range")
+
+CPU_LEVELS = {
+    1: CpuLevel(40, 20, 8, 6, 0.5),
+    2: CpuLevel(32, 16, 10, 8, 0.4),
+    3: CpuLevel(26, 14, 12, 9, 0.3),
+    4: CpuLevel(20, 12, 14, 11, 0.2),
+    5: CpuLevel(16, 10, 16, 12, 0.15),
+    6: CpuLevel(12, 8, 18, 14, 0.1),
+    7: CpuLevel(10, 6, 20, 16, 0.05),
+    8: CpuLevel(8, 5, 22, 16, 0.02),
+    9: CpuLevel(6, 4, 24, 16, 0),
+}
+DEFAULT_LEVEL = 5
+
+# Scoring weights
+STOCK_VALUE = 300      # per stock taken; losing one costs LOSS_FEAR times that
+LOSS_FEAR = 1.5
+HURT_FEAR = 1.2        # per % taken, against 1 per % dealt
+OFFSTAGE_COST = 0.6    # per pixel outside or below the main platform
+APPROACH_COST = 0.02   # per pixel to the nearest opponent
+KEEP_BONUS = 2         # for sticking with the current plan
+
+class CpuPlanner:
+    # Batched rollouts for every CPU in one match. decide() only touches
+    # the planner, so one decision may run on a worker thread at a time.
+    def __init__(self, stage_id, characters, levels, seed=0, hazards=True):
+        # levels: player index -> CPU level number
+        self.levels = {i: CPU_LEVELS[level] for i, level in levels.items()}
+        self.characters = list(characters)
+        # Each CPU owns a block of rows, one per plan it considers
+        self.blocks = {}
+        rows = 0
+        for i, level in self.levels.items():
+            self.blocks[i] = slice(rows, rows + level.plans)
+            rows += level.plans
+        self.sim = BatchSim([stage_id] * rows, [self.characters] * rows, seed=seed)
+        self.inputs = np.zeros((rows, len(self.characters)), dtype=np.uint8)
+        # Snapshots are restored into a private match before copying them
+        # into the batch
+        self.shadow = Match(STAGES[stage_id], self.characters, seed=seed, hazards=hazards)
+        main = self.shadow.stage.platforms[0]
+        self.main_left = main['x']
+        self.main_right = main['x'] + main['width']
+        self.main_top = main['y']
+        self.rng = random.Random(seed)
+
+    def decide(self, state, due, current, deadline=None):
+        # state: a Match.save_state() snapshot. due: CPUs deciding now.
+        # current: player index -> (plan, frames into it, pending) being
+        # played, pending being (plan, frames until it starts) or None.
+        # Returns player index -> chosen plan, to start reaction frames
+        # after the snapshot.
+        shadow = self.shadow
+        shadow.load_state(state)
+        sim = self.sim
+        sim.load_match(shadow)
+        held = np.array(shadow.prev_inputs, dtype=np.uint8)
+        self.inputs[:] = held
+        depth = 0
+        for i in due:
+            level = self.levels[i]
+            depth = max(depth, level.reaction + level.horizon)
+        damage = np.array([p.damage for p in shadow.players])
+        stocks = np.array([p.stocks for p in shadow.players])
+
+        scores = {}
+        for frame in range(depth):
+            for i in due:
+                level = self.levels[i]
+                block = self.blocks[i]
+                if frame < level.reaction:
+                    # Still playing out what it was doing
+                    plan, t, pending = current.get(i, (0, 0, None))
+                    if pending is not None and frame >= pending[1]:
+                        plan, t = pending[0], frame - pending[1]
+                    else:
+                        t += frame
+                    self.inputs[block, i] = PLAN_INPUTS[plan, min(t, PLAN_FRAMES - 1)]
+                else:
+                    self.inputs[block, i] = PLAN_INPUTS[:level.plans, frame - level.reaction]
+            sim.step(self.inputs)
+            late = deadline is not None and perf_counter() > deadline
+            for i in due:
+                level = self.levels[i]
+                if i not in scores and (frame + 1 == level.reaction + level.horizon or
+                                        (late and frame >= level.reaction)):
+                    scores[i] = self.score(i, damage, stocks)
+            if late:
+                break
+
+        choices = {}
+        for i in due:
+            level = self.levels[i]
+            if i not in scores:
+                continue  # out of time before its plans even started
+            score = scores[i]
+            plan, _, pending = current.get(i, (0, 0, None))
+            if pending is not None:
+                plan = pending[0]
+            if plan < level.plans:
+                score[plan] += KEEP_BONUS
+            if self.rng.random() < level.mistakes:
+                choices[i] = self.rng.randrange(level.plans)
+            else:
+                choices[i] = int(score.argmax())
+        return choices
+
+    def score(self, i, damage, stocks):
+        # How well each row of CPU i's block ends up for it
+        s = self.sim.store
+        block = self.blocks[i]
+        kept = s.stocks[block] == stocks
+        hurt = np.where(kept, s.damage[block] - damage, 0)
+        lost = stocks - s.stocks[block]
+        others = np.arange(len(stocks)) != i
+        value = ((hurt[:, others].sum(axis=1) - HURT_FEAR * hurt[:, i]) +
+                 STOCK_VALUE * (lost[:, others].sum(axis=1) - LOSS_FEAR * lost[:, i]))
+
+        x = s.x[block, i] + s.width[block, i] / 2
+        y = s.y[block, i] + s.height[block, i]
+        off = (np.maximum(self.main_left - x, 0) + np.maximum(x - self.main_right, 0) +
+               np.maximum(y - self.main_top, 0))
+        value -= OFFSTAGE_COST * off
+
+        alive = others & (stocks > 0)
+        if alive.any():
+            cx = s.x[block] + s.width[block] / 2
+            cy = s.y[block] + s.height[block] / 2
+            distance = np.abs(cx[:, alive] - cx[:, i, None]) + np.abs(cy[:, alive] - cy[:, i, None])
+            value -= APPROACH_COST * distance.min(axis=1)
+        return value
+
+class CpuPlayers:
+    # Drives the CPU players of one match. fill() is called every tick;
+    # with submit (e.g. AssetManager.submit) decisions run on a worker
+    # and arrive a few frames later, otherwise they are made in place and
+    # the match stays reproducible from its seed (or seed, if given).
+    # budget_ms caps a worker decision's rollout.
+    def __init__(self, match, levels, submit=None, budget_ms=None, seed=None):
+        self.levels = {i: CPU_LEVELS[level] for i, level in levels.items()}
+        self.planner = CpuPlanner(match.stage.stage_id, match.characters, levels,
+                                  seed=match.seed if seed is None else seed,
+                                  hazards=match.hazards.enabled)
+        self.submit = submit
+        self.budget_ms = budget_ms
+        # player index -> (plan, first frame it is played on)
+        self.plans = {i: (0, match.game_time) for i in self.levels}
+        # player index -> (plan, frame it takes over on), chosen but waiting
+        # out the CPU's reaction time
+        self.pending = {}
+        self.next_decision = {i: match.game_time for i in self.levels}
+        self.job = None  # (future, snapshot frame) while a decision runs
+        self.decisions = 0
+
+    def fill(self, match, inputs):
+        # A copy of inputs with the CPU players' entries filled in for the
+        # next tick
+        frame = match.game_time
+        if self.job is not None and self.job[0].done():
+            future, seen = self.job
+            self.job = None
+            self.adopt(future.result(), seen)
+        if self.job is None:
+            due = [i for i, when in self.next_decision.items()
+                   if when <= frame and match.players[i].stocks > 0]
+            if due:
+                self.start(match, due)
+
+        inputs = list(inputs)
+        for i in self.levels:
+            if i in self.pending and self.pending[i][1] <= frame:
+                self.plans[i] = self.pending.pop(i)
+            plan, start = self.plans[i]
+            inputs[i] = int(PLAN_INPUTS[plan, min(max(frame - start, 0), PLAN_FRAMES - 1)])
+        return inputs
+
+    def start(self, match, due):
+        frame = match.game_time
+        current = {}
+        for i, (plan, start) in self.plans.items():
+            pending = self.pending.get(i)
+            if pending is not None:
+                pending = (pending[0], max(pending[1] - frame, 0))
+            current[i] = (plan, max(frame - start, 0), pending)
+        for i in due:
+            self.next_decision[i] = frame + self.levels[i].interval
+        state = match.save_state()
+        self.decisions += 1
+        if self.submit is None:
+            self.adopt(self.planner.decide(state, due, current), frame)
+            return
+        deadline = perf_counter() + self.budget_ms / 1000 if self.budget_ms else None
+        self.job = (self.submit(self.planner.decide, state, due, current, deadline), frame)
+
+    def adopt(self, choices, seen):
+        # A plan starts reaction frames after the frame it was chosen from;
+        # until then, the one already playing (or waiting) carries on
+        for i, plan in choices.items():
+            if self.pending.get(i, self.plans[i])[0] != plan:
+                self.pending[i] = (plan, seen + self.levels[i].reaction)
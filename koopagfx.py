@@ -0,0 +1,330 @@
+import warnings
+from collections import OrderedDict
+
+import pygame
+
+# ============================================
+# RENDER CACHES
+# ============================================
+# Shared pygame-side caches for the front-end. Nothing here allocates
+# once the game has reached a steady state; everything is built the first
+# time it is asked for and reused afterwards.
+
+DIGIT_GLYPHS = "0123456789%:-"
+
+class GlyphAtlas:
+    # One surface holding a pre-rendered glyph per character, so number
+    # strings are drawn by blitting sub-rects instead of rasterizing text.
+    def __init__(self, font, color, chars=DIGIT_GLYPHS):
+        glyphs = [font.render(ch, True, color) for ch in chars]
+        self.height = max(g.get_height() for g in glyphs)
+        self.surface = pygame.Surface((sum(g.get_width() for g in glyphs), self.height),
+                                      pygame.SRCALPHA)
+        self.rects = {}
+        x = 0
+        for ch, glyph in zip(chars, glyphs):
+            self.surface.blit(glyph, (x, 0))
+            self.rects[ch] = pygame.Rect(x, 0, glyph.get_width(), self.height)
+            x += glyph.get_width()
+
+    def supports(self, text):
+        rects = self.rects
+        return all(ch in rects for ch in text)
+
+    def width(self, text):
+        return sum(self.rects[ch].width for ch in text)
+
+    def draw(self, screen, text, pos):
+        x, y = pos
+        for ch in text:
+            rect = self.rects[ch]
+            screen.blit(self.surface, (x, y), rect)
+            x += rect.width
+        return pygame.Rect(pos[0], y, x - pos[0], self.height)
+
+class TextRenderer:
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.fonts = {}
+        self.atlases = {}
+        self.surfaces = OrderedDict()
+        self.font_loads = 0
+        self.renders = 0
+
+    def font(self, size, name=None):
+        key = (name, size)
+        font = self.fonts.get(key)
+        if font is None:
+            font = pygame.font.Font(name, size)
+            self.fonts[key] = font
+            self.font_loads += 1
+        return font
+
+    def render(self, text, size, color, name=None):
+        # LRU of rendered strings keyed by (font, text, color)
+        key = (name, size, text, color)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            return surface
+        surface = self.font(size, name).render(text, True, color)
+        self.renders += 1
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.capacity:
+            self.surfaces.popitem(last=False)
+        return surface
+
+    def atlas(self, size, color, name=None):
+        key = (name, size, color)
+        atlas = self.atlases.get(key)
+        if atlas is None:
+            atlas = GlyphAtlas(self.font(size, name), color)
+            self.atlases[key] = atlas
+        return atlas
+
+    def blit(self, screen, text, size, color, name=None, **anchor):
+        # Draw text positioned like Surface.get_rect(**anchor); returns the rect
+        surface = self.render(text, size, color, name)
+        rect = surface.get_rect(**anchor)
+        screen.blit(surface, rect)
+        return rect
+
+    def blit_number(self, screen, text, size, color, name=None, **anchor):
+        # Counters change every few frames, so they go through the glyph
+        # atlas rather than filling the LRU with one-off strings.
+        atlas = self.atlas(size, color, name)
+        if not atlas.supports(text):
+            return self.blit(screen, text, size, color, name, **anchor)
+        rect = pygame.Rect(0, 0, atlas.width(text), atlas.height)
+        for attr, value in anchor.items():
+            setattr(rect, attr, value)
+        return atlas.draw(screen, text, rect.topleft)
+
+    def clear(self):
+        self.atlases.clear()
+        self.surfaces.clear()
+
+TEXT = TextRenderer()
+
+class StageLayerCache:
+    # Static stage art baked once per (stage, resolution). The painter
+    # draws background, scenery and platforms in screen coordinates.
+    # Each slot remembers the scenery layer_key it was baked for, so a new
+    # match with a different seeded skyline rebakes in place.
+    def __init__(self, painter):
+        self.painter = painter
+        self.layers = {}
+        self.bakes = 0
+
+    def get(self, stage, size, scenery):
+        entry = self.layers.get((stage.stage_id, size))
+        if entry is not None and entry[0] == scenery.layer_key:
+            return entry[1]
+        return self.put(stage, size, scenery, self.bake(stage, size, scenery))
+
+    def bake(self, stage, size, scenery):
+        # Paints a layer without touching the cache, so a loader thread
+        # can do the drawing; hand the result to put() on the main thread
+        layer = pygame.Surface(size)
+        self.painter(layer, stage, scenery)
+        return layer
+
+    def put(self, stage, size, scenery, layer):
+        if pygame.display.get_surface() is not None:
+            layer = layer.convert()
+        self.layers[(stage.stage_id, size)] = (scenery.layer_key, layer)
+        self.bakes += 1
+        return layer
+
+    def invalidate(self):
+        self.layers.clear()
+
+class DirtyRectCompositor:
+    # Tracks what was drawn over the background last frame so the next
+    # frame only restores and presents those areas.
+    def __init__(self):
+        self.previous = []
+        self.full = True
+        self.size = None
+
+    def invalidate(self):
+        self.full = True
+
+    def begin(self, screen, background):
+        size = screen.get_size()
+        if size != self.size:
+            self.size = size
+            self.full = True
+        if self.full:
+            screen.blit(background, (0, 0))
+        else:
+            for rect in self.previous:
+                screen.blit(background, rect, rect)
+
+    def present(self, screen, rects):
+        bounds = screen.get_rect()
+        rects = [bounds.clip(r) for r in rects]
+        rects = [r for r in rects if r.width and r.height]
+        if self.full:
+            pygame.display.flip()
+            self.full = False
+        else:
+            pygame.display.update(self.previous + rects)
+        self.previous = rects
+
+class ParticleSprites:
+    # Pre-rasterized particle discs keyed by (colour ramp, size, life).
+    # ramp(color, fade) returns the RGB for a particle with fade in 0..1.
+    # A frame of particles becomes a single Surface.blits call.
+    def __init__(self, ramp, full_life):
+        self.ramp = ramp
+        self.full_life = full_life
+        self.sprites = {}
+
+    def get(self, color, size, life):
+        key = (color, size, life)
+        sprite = self.sprites.get(key)
+        if sprite is None:
+            sprite = pygame.Surface((size * 2 + 1, size * 2 + 1))
+            sprite.set_colorkey((0, 0, 0))
+            pygame.draw.circle(sprite, self.ramp(color, min(life / self.full_life, 1.0)), (size, size), size)
+            if pygame.display.get_surface() is not None:
+                sprite = sprite.convert()
+            self.sprites[key] = sprite
+        return sprite
+
+    def draw(self, screen, pool):
+        # Returns the dirty rects
+        if not pool.live:
+            return []
+        x, y, size, life, color = pool.x, pool.y, pool.size, pool.life, pool.color
+        get = self.get
+        return screen.blits([(get(color[s], size[s], life[s]), (int(x[s]) - size[s], int(y[s]) - size[s]))
+                             for s in pool.live])
+
+class EntitySprites:
+    # One pre-rendered sprite per entity kind, painted on first use by
+    # painters[kind name](surface); a frame of entities is a single
+    # Surface.blits call.
+    def __init__(self, kinds, painters):
+        self.kinds = kinds
+        self.painters = painters
+        self.sprites = [None] * len(kinds)
+
+    def get(self, kind):
+        sprite = self.sprites[kind]
+        if sprite is None:
+            k = self.kinds[kind]
+            sprite = pygame.Surface((k.width, k.height), pygame.SRCALPHA)
+            self.painters[k.name](sprite)
+            if pygame.display.get_surface() is not None:
+                sprite = sprite.convert_alpha()
+            self.sprites[kind] = sprite
+        return sprite
+
+    def draw(self, screen, pool):
+        # Returns the dirty rects
+        if not pool.live:
+            return []
+        kind, x, y = pool.kind, pool.x, pool.y
+        get = self.get
+        return screen.blits([(get(kind[s]), (int(x[s]), int(y[s]))) for s in pool.live])
+
+class EffectSurfaces:
+    # Translucent effect overlays (shields, hitboxes) pre-rendered per
+    # quantized alpha, so drawing one is a single blit of a cached,
+    # display-format surface. painter(surface, alpha) draws the effect.
+    def __init__(self):
+        self.effects = {}
+        self.surfaces = {}
+        self.bakes = 0
+
+    def register(self, name, size, painter, buckets=16):
+        self.effects[name] = (size, painter, buckets)
+        for key in [k for k in self.surfaces if k[0] == name]:
+            del self.surfaces[key]
+
+    def get(self, name, alpha=255):
+        size, painter, buckets = self.effects[name]
+        bucket = min(max(int(alpha), 0) * buckets // 256, buckets - 1)
+        key = (name, bucket)
+        surface = self.surfaces.get(key)
+        if surface is None:
+            if buckets > 1:
+                alpha = bucket * 255 // (buckets - 1)
+            surface = pygame.Surface(size, pygame.SRCALPHA)
+            painter(surface, max(0, min(int(alpha), 255)))
+            if pygame.display.get_surface() is not None:
+                surface = surface.convert_alpha()
+            self.surfaces[key] = surface
+            self.bakes += 1
+        return surface
+
+    def clear(self):
+        self.surfaces.clear()
+
+class ProfilerOverlay:
+    # Frame-time graph and per-section percentiles from a FrameProfiler.
+    # The graph is a cached surface scrolled one bar per recorded frame and
+    # the text block is re-rendered only every refresh_frames frames.
+    def __init__(self, profiler, budget_ms=1000 / 60, width=320, graph_height=80,
+                 text_size=18, refresh_frames=30):
+        self.profiler = profiler
+        self.budget_ms = budget_ms
+        self.width = width
+        self.graph_height = graph_height
+        self.text_size = text_size
+        self.refresh_frames = refresh_frames
+        self.scale = graph_height / (budget_ms * 2)  # full height is two frame budgets
+        self.graph = pygame.Surface((width, graph_height))
+        self.graph.fill((16, 16, 16))
+        self.text = None
+        self.font_name = None
+        self.seen = 0
+        self.text_frame = -refresh_frames
+
+    def update_graph(self):
+        profiler = self.profiler
+        new = min(profiler.frames - self.seen, self.width // 2)
+        ring = profiler.rings.get('frame')
+        if new > 0 and ring is not None:
+            h = self.graph_height
+            self.graph.scroll(-2 * new, 0)
+            for i in range(new):
+                ms = ring[(profiler.frames - new + i) % profiler.history]
+                x = self.width - 2 * (new - i)
+                bar = min(int(ms * self.scale), h)
+                color = (60, 200, 60) if ms <= self.budget_ms else (220, 60, 60)
+                self.graph.fill((16, 16, 16), (x, 0, 2, h))
+                self.graph.fill(color, (x, h - bar, 2, bar))
+            budget_y = h - int(self.budget_ms * self.scale)
+            self.graph.fill((200, 200, 0), (0, budget_y, self.width, 1))
+        self.seen = profiler.frames
+
+    def update_text(self):
+        if self.font_name is None:
+            # Columns line up only in a monospaced face; fall back to the default
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")  # no fontconfig on some kiosks
+                self.font_name = pygame.font.match_font("dejavusansmono,couriernew,monospace") or ""
+        font = TEXT.font(self.text_size, self.font_name or None)
+        lines = [f"{'':<15}{'p50':>6}{'p95':>6}{'p99':>6}"]
+        for label, (p50, p95, p99) in self.profiler.summary().items():
+            lines.append(f"{label:<15}{p50:6.2f}{p95:6.2f}{p99:6.2f}")
+        line_height = font.get_linesize()
+        self.text = pygame.Surface((self.width, line_height * len(lines) + 4))
+        self.text.fill((16, 16, 16))
+        for i, line in enumerate(lines):
+            self.text.blit(font.render(line, True, (230, 230, 230)), (4, 2 + i * line_height))
+        self.text_frame = self.profiler.frames
+
+    def draw(self, screen, topright=None):
+        # Returns the rect covered
+        self.update_graph()
+        if self.text is None or self.profiler.frames - self.text_frame >= self.refresh_frames:
+            self.update_text()
+        if topright is None:
+            topright = (screen.get_width() - 8, 8)
+        rect = screen.blit(self.graph, (topright[0] - self.width, topright[1]))
+        rect.union_ip(screen.blit(self.text, (rect.left, rect.bottom)))
+        return rect
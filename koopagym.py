@@ -0,0 +1,438 @@
+import argparse
+import os
+import random
+import sys
+import time
+from multiprocessing import Pipe, Process
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from koopasim import STAGES, CHARACTER_ROSTER, SCREEN_WIDTH, SCREEN_HEIGHT, FPS, MAX_FALL_SPEED, PlayerState, Match
+from koopavec import BatchSim
+from koopabatch import POLICIES
+
+# ============================================
+# REINFORCEMENT LEARNING ENVIRONMENTS
+# ============================================
+# Battles behind the Gymnasium calling convention, for training bots:
+#
+#   obs, info = env.reset(seed=None)
+#   obs, reward, terminated, truncated, info = env.step(action)
+#
+# An action is the INPUT_* bitfield (0..63) a learner holds for the next
+# frame_skip frames. Observations are float32: every fighter's position,
+# speed, damage, stocks, facing, footing and state, the learner's own
+# fighter first, then the stage's blast zones and first platforms. The
+# reward is damage and stocks the others lose minus what the learner
+# loses. terminated means the match is over, truncated that it ran to
+# max_frames.
+#
+# KoopaEnv plays one Match, with hazards and items, against koopabatch
+# policies. BatchEnv plays many matches in lockstep on a BatchSim: the
+# first `agents` players of every row are learners, each one environment
+# of the batch, and rows restart by themselves when they finish (the
+# last observation is kept in info['final_observation']). SubprocBatchEnv
+# splits a BatchEnv over worker processes that write into shared memory.
+# None of them open a display unless a KoopaEnv is asked to render.
+#
+#   python -m koopagym --envs 2048 --workers 4
+
+ACTION_COUNT = 64
+DEFAULT_FRAME_SKIP = 4
+EPISODE_FRAMES = 3 * 60 * FPS  # three minute time limit
+
+# Observation layout
+FIGHTER_FEATURES = 8 + len(PlayerState)
+STAGE_PLATFORMS = 4
+STAGE_FEATURES = 4 + 4 * STAGE_PLATFORMS
+START_STOCKS = 4
+
+_STATE_ONE_HOT = np.zeros((max(s.value for s in PlayerState) + 1, len(PlayerState)), dtype=np.float32)
+for _i, _state in enumerate(PlayerState):
+    _STATE_ONE_HOT[_state.value, _i] = 1
+
+# Rewards
+DAMAGE_REWARD = 0.01
+STOCK_REWARD = 1.0
+
+# Button changes per frame of the batch 'random' opponent, as koopabatch's
+BATCH_OPPONENTS = ("random", "idle")
+RANDOM_CHANGE = 0.1
+
+def observation_size(fighters):
+    return fighters * FIGHTER_FEATURES + STAGE_FEATURES
+
+def stage_features(stage):
+    features = np.zeros(STAGE_FEATURES, dtype=np.float32)
+    left, right, top, bottom = stage.blast_zones
+    features[:4] = (left / SCREEN_WIDTH, right / SCREEN_WIDTH, top / SCREEN_HEIGHT, bottom / SCREEN_HEIGHT)
+    for p, (left, top, right, bottom, solid) in enumerate(stage.collision.platforms[:STAGE_PLATFORMS]):
+        features[4 + 4 * p:8 + 4 * p] = (left / SCREEN_WIDTH, right / SCREEN_WIDTH, top / SCREEN_HEIGHT, solid)
+    return features
+
+def _agent_order(agents, fighters):
+    # Each learner's view of the fighters: itself, then the rest in order
+    return np.array([[a] + [i for i in range(fighters) if i != a] for a in range(agents)])
+
+_OBSERVED = ('x', 'y', 'vx', 'vy', 'damage', 'stocks', 'state', 'facing_right', 'grounded', 'width', 'height')
+
+class _FighterColumns:
+    # One Match's fighters as (1, fighters) arrays, the shape of a
+    # FighterStore, so both environments share encode()
+    def __init__(self, players):
+        for name in _OBSERVED:
+            values = [getattr(p, name) for p in players]
+            if name == 'state':
+                values = [state.value for state in values]
+            setattr(self, name, np.array([values]))
+
+def encode(out, f, order, stage, rows=slice(None)):
+    # Write observations for some rows of (matches, fighters) columns f
+    # into out, shaped (matches, agents, observation_size)
+    x = f.x[rows]
+    fighters = x.shape[1]
+    features = np.empty(x.shape + (FIGHTER_FEATURES,), dtype=np.float32)
+    features[..., 0] = (x + f.width[rows] / 2) / SCREEN_WIDTH
+    features[..., 1] = (f.y[rows] + f.height[rows] / 2) / SCREEN_HEIGHT
+    features[..., 2] = f.vx[rows] / MAX_FALL_SPEED
+    features[..., 3] = f.vy[rows] / MAX_FALL_SPEED
+    features[..., 4] = f.damage[rows] / 100
+    features[..., 5] = f.stocks[rows] / START_STOCKS
+    features[..., 6] = np.where(f.facing_right[rows], 1, -1)
+    features[..., 7] = f.grounded[rows]
+    features[..., 8:] = _STATE_ONE_HOT[f.state[rows]]
+    view = features[:, order]
+    out[rows, :, :fighters * FIGHTER_FEATURES] = view.reshape(view.shape[0], len(order), -1)
+    out[rows, :, fighters * FIGHTER_FEATURES:] = stage[rows, None]
+
+def rewards(damage, stocks, f, agents):
+    # (matches, agents) rewards given the damage and stocks before a step.
+    # Damage goes back to 0 with a lost stock, so it only counts when the
+    # stock was kept.
+    kept = f.stocks == stocks
+    loss = DAMAGE_REWARD * np.where(kept, f.damage - damage, 0) + STOCK_REWARD * (stocks - f.stocks)
+    mine = loss[:, :agents]
+    return loss.sum(axis=1, keepdims=True) - 2 * mine
+
+# ============================================
+# ONE MATCH
+# ============================================
+
+class KoopaEnv:
+    # P1 learns; the other players follow the koopabatch policy opponent
+    def __init__(self, stage_id, characters, opponent="random", frame_skip=DEFAULT_FRAME_SKIP,
+                 max_frames=EPISODE_FRAMES, seed=None, items=0, hazards=True, render_mode=None):
+        if opponent not in POLICIES:
+            raise ValueError(f"unknown opponent policy {opponent!r}")
+        if render_mode not in (None, "rgb_array"):
+            raise ValueError(f"unsupported render mode {render_mode!r}")
+        self.stage_id = stage_id
+        self.characters = list(characters)
+        self.opponent = opponent
+        self.frame_skip = frame_skip
+        self.max_frames = max_frames
+        self.items = items
+        self.hazards = hazards
+        self.render_mode = render_mode
+        self.observation_shape = (observation_size(len(self.characters)),)
+        self.action_count = ACTION_COUNT
+        self.order = _agent_order(1, len(self.characters))
+        self.stage = stage_features(STAGES[stage_id])[None]
+        self.rng = random.Random(seed)
+        self.match = None
+        self.opponents = []
+        self.front = None  # the pygame front-end, once rendered
+
+    def reset(self, seed=None):
+        if seed is not None:
+            self.rng.seed(seed)
+        match_seed = self.rng.getrandbits(32)
+        self.match = Match(STAGES[self.stage_id], self.characters, seed=match_seed, items=self.items,
+                           hazards=self.hazards)
+        self.opponents = [POLICIES[self.opponent](match_seed * 31 + i) for i in range(1, len(self.characters))]
+        return self.observe(_FighterColumns(self.match.players)), {'seed': match_seed}
+
+    def step(self, action):
+        match = self.match
+        players = match.players
+        damage = np.array([[p.damage for p in players]])
+        stocks = np.array([[p.stocks for p in players]])
+        for _ in range(self.frame_skip):
+            match.step([int(action)] + [policy(match, i) for i, policy in enumerate(self.opponents, 1)])
+            if match.over:
+                break
+        f = _FighterColumns(players)
+        reward = float(rewards(damage, stocks, f, 1)[0, 0])
+        truncated = not match.over and match.game_time >= self.max_frames
+        return self.observe(f), reward, match.over, truncated, {'frame': match.game_time}
+
+    def observe(self, f):
+        out = np.empty((1, 1) + self.observation_shape, dtype=np.float32)
+        encode(out, f, self.order, self.stage)
+        return out[0, 0]
+
+    def render(self):
+        # The battle screen as an (height, width, 3) array
+        if self.render_mode is None:
+            return None
+        import pygame
+        import koopahdrv0 as front
+        if self.front is None:
+            os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+            self.front = front.SmashBros64Engine()
+        game = self.front
+        if game.match is not self.match:
+            game.match = self.match
+            game.compositor.invalidate()
+        front.ASSETS.pump()
+        game.draw_battle()
+        return pygame.surfarray.array3d(game.screen).swapaxes(0, 1)
+
+    def close(self):
+        if self.front is not None:
+            import pygame
+            import koopahdrv0 as front
+            front.ASSETS.shutdown()
+            pygame.quit()
+            self.front = None
+
+# ============================================
+# BATCHED MATCHES
+# ============================================
+
+class BatchEnv:
+    # stage_ids and characters as for BatchSim. Observations, rewards and
+    # flags come back as (matches * agents, ...) arrays, row-major by match,
+    # and are overwritten by the next step.
+    def __init__(self, stage_ids, characters, agents=1, opponent="random", frame_skip=DEFAULT_FRAME_SKIP,
+                 max_frames=EPISODE_FRAMES, seed=0):
+        if opponent not in BATCH_OPPONENTS:
+            raise ValueError(f"unknown batch opponent {opponent!r}")
+        self.sim = BatchSim(stage_ids, characters, seed=seed)
+        self.initial = self.sim.save_state()
+        n, fighters = self.sim.store.shape
+        if not 0 < agents <= fighters:
+            raise ValueError("agents must be between 1 and the fighters per match")
+        self.agents = agents
+        self.opponent = opponent
+        self.frame_skip = frame_skip
+        self.max_frames = max_frames
+        self.num_envs = n * agents
+        self.observation_shape = (observation_size(fighters),)
+        self.action_count = ACTION_COUNT
+        self.order = _agent_order(agents, fighters)
+        self.stage = np.array([stage_features(STAGES[s]) for s in stage_ids])
+        self.rng = np.random.default_rng(seed)
+
+        self.inputs = np.zeros((n, fighters), dtype=np.uint8)
+        self.observations = np.zeros((n, agents) + self.observation_shape, dtype=np.float32)
+        self.final_observations = np.zeros_like(self.observations)
+        self.rewards = np.zeros((n, agents), dtype=np.float32)
+        self.terminated = np.zeros((n, agents), dtype=np.bool_)
+        self.truncated = np.zeros((n, agents), dtype=np.bool_)
+
+    def reset(self, seed=None):
+        if seed is not None:
+            self.rng = np.random.default_rng(seed)
+        self.sim.load_state(self.initial)
+        self.inputs[:] = 0
+        encode(self.observations, self.sim.store, self.order, self.stage)
+        return self.observations.reshape(self.num_envs, -1), {}
+
+    def step(self, actions):
+        sim = self.sim
+        s = sim.store
+        agents = self.agents
+        self.inputs[:, :agents] = np.asarray(actions, dtype=np.uint8).reshape(-1, agents)
+        damage = s.damage.copy()
+        stocks = s.stocks.copy()
+        opponents = self.inputs[:, agents:]
+        for _ in range(self.frame_skip):
+            if self.opponent == "random" and opponents.size:
+                change = self.rng.random(opponents.shape) < RANDOM_CHANGE
+                opponents[change] = self.rng.integers(0, ACTION_COUNT, int(change.sum()))
+            sim.step(self.inputs)
+        self.rewards[:] = rewards(damage, stocks, s, agents)
+        truncated = ~sim.over & (sim.game_time >= self.max_frames)
+        self.terminated[:] = sim.over[:, None]
+        self.truncated[:] = truncated[:, None]
+        encode(self.observations, s, self.order, self.stage)
+
+        # Finished matches start over
+        done = sim.over | truncated
+        if done.any():
+            self.final_observations[done] = self.observations[done]
+            sim.load_state(self.initial, done)
+            self.inputs[done] = 0
+            encode(self.observations, s, self.order, self.stage, done)
+        return (self.observations.reshape(self.num_envs, -1), self.rewards.reshape(-1),
+                self.terminated.reshape(-1), self.truncated.reshape(-1),
+                {'final_observation': self.final_observations.reshape(self.num_envs, -1)})
+
+# ============================================
+# BATCHES ACROSS PROCESSES
+# ============================================
+# Every worker runs a BatchEnv over a contiguous block of matches. Actions
+# go in and observations come out through shared memory; the pipes only
+# carry the commands.
+
+def _shared(shape, dtype):
+    dtype = np.dtype(dtype)
+    block = SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+def _attach(name, shape, dtype):
+    block = SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+def _batch_worker(pipe, stage_ids, characters, options, layout, envs):
+    env = BatchEnv(stage_ids, characters, **options)
+    blocks = []
+    arrays = {}
+    for key, (name, shape, dtype) in layout.items():
+        block, array = _attach(name, shape, dtype)
+        blocks.append(block)
+        arrays[key] = array[envs]
+    while True:
+        command, arg = pipe.recv()
+        if command == "step":
+            obs, reward, terminated, truncated, info = env.step(arrays['actions'])
+            arrays['observations'][:] = obs
+            arrays['final_observations'][:] = info['final_observation']
+            arrays['rewards'][:] = reward
+            arrays['terminated'][:] = terminated
+            arrays['truncated'][:] = truncated
+        elif command == "reset":
+            arrays['observations'][:] = env.reset(arg)[0]
+        else:
+            break
+        pipe.send(None)
+    del arrays, array  # no views may outlive the blocks
+    for block in blocks:
+        block.close()
+
+class SubprocBatchEnv:
+    # A BatchEnv split over worker processes (os.cpu_count() by default).
+    # Takes BatchEnv's arguments; worker k seeds its batch with seed + k.
+    def __init__(self, stage_ids, characters, workers=None, seed=0, **options):
+        n = len(stage_ids)
+        agents = options.get('agents', 1)
+        workers = max(1, min(workers or os.cpu_count(), n))
+        self.num_envs = n * agents
+        self.observation_shape = (observation_size(len(characters[0])),)
+        self.action_count = ACTION_COUNT
+
+        shapes = {
+            'actions': ((self.num_envs,), np.uint8),
+            'observations': ((self.num_envs,) + self.observation_shape, np.float32),
+            'final_observations': ((self.num_envs,) + self.observation_shape, np.float32),
+            'rewards': ((self.num_envs,), np.float32),
+            'terminated': ((self.num_envs,), np.bool_),
+            'truncated': ((self.num_envs,), np.bool_),
+        }
+        self.blocks = []
+        layout = {}
+        for key, (shape, dtype) in shapes.items():
+            block, array = _shared(shape, dtype)
+            self.blocks.append(block)
+            setattr(self, key, array)
+            layout[key] = (block.name, shape, dtype)
+
+        self.pipes = []
+        self.processes = []
+        bounds = np.linspace(0, n, workers + 1).astype(int)
+        for k in range(workers):
+            lo, hi = bounds[k], bounds[k + 1]
+            parent, child = Pipe()
+            process = Process(target=_batch_worker, daemon=True,
+                              args=(child, stage_ids[lo:hi], characters[lo:hi], dict(options, seed=seed + k),
+                                    layout, slice(lo * agents, hi * agents)))
+            process.start()
+            child.close()
+            self.pipes.append(parent)
+            self.processes.append(process)
+
+    def _command(self, command, args):
+        for pipe, arg in zip(self.pipes, args):
+            pipe.send((command, arg))
+        for pipe in self.pipes:
+            pipe.recv()
+
+    def reset(self, seed=None):
+        self._command("reset", [None if seed is None else seed + k for k in range(len(self.pipes))])
+        return self.observations, {}
+
+    def step(self, actions):
+        self.actions[:] = actions
+        self._command("step", [None] * len(self.pipes))
+        return (self.observations, self.rewards, self.terminated, self.truncated,
+                {'final_observation': self.final_observations})
+
+    def close(self):
+        if not self.processes:
+            return
+        for pipe in self.pipes:
+            pipe.send(("close", None))
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        for name in ('actions', 'observations', 'final_observations', 'rewards', 'terminated', 'truncated'):
+            delattr(self, name)
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# ============================================
+# THROUGHPUT CHECK
+# ============================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Step batched environments with random actions and report env steps/s")
+    parser.add_argument("--envs", type=int, default=1024, help="matches in the batch")
+    parser.add_argument("--agents", type=int, default=1, help="learners per match")
+    parser.add_argument("--characters", nargs="+", default=["Mario", "Fox"], choices=list(CHARACTER_ROSTER),
+                        metavar="KEY")
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=list(STAGES), metavar="STAGE")
+    parser.add_argument("--frame-skip", type=int, default=DEFAULT_FRAME_SKIP)
+    parser.add_argument("--steps", type=int, default=200, help="batch steps to time")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="worker processes (1 runs in this process)")
+    args = parser.parse_args(argv)
+
+    stage_ids = [args.stages[i % len(args.stages)] for i in range(args.envs)]
+    characters = [list(args.characters)] * args.envs
+    options = dict(agents=args.agents, frame_skip=args.frame_skip, seed=args.seed)
+    if args.workers == 1:
+        env = BatchEnv(stage_ids, characters, **options)
+    else:
+        env = SubprocBatchEnv(stage_ids, characters, workers=args.workers, **options)
+    rng = np.random.default_rng(args.seed)
+    env.reset()
+    actions = rng.integers(0, ACTION_COUNT, env.num_envs, dtype=np.uint8)
+    env.step(actions)  # warm up
+    episodes = 0
+    start = time.perf_counter()
+    for step in range(args.steps):
+        if step % 8 == 0:
+            actions = rng.integers(0, ACTION_COUNT, env.num_envs, dtype=np.uint8)
+        obs, reward, terminated, truncated, info = env.step(actions)
+        episodes += int((terminated | truncated).sum())
+    elapsed = time.perf_counter() - start
+    if isinstance(env, SubprocBatchEnv):
+        env.close()
+
+    steps = args.steps * env.num_envs
+    print(f"{steps} env steps ({steps * args.frame_skip} frames) in {elapsed:.2f}s: "
+          f"{steps / elapsed:.0f} env steps/s, {episodes} episodes finished")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,39 +1,38 @@
 import pygame
+import argparse
+import os
 import sys
-import math
+import time
 import random
 from enum import Enum
-import json
 
-# Initialize Pygame
-pygame.init()
-pygame.mixer.init()
+from koopasim import (
+    SCREEN_WIDTH, SCREEN_HEIGHT, FPS,
+    BLACK, WHITE, RED, BLUE, GREEN, YELLOW, PURPLE, CYAN, ORANGE,
+    GRAY, DARK_GRAY, N64_BLUE,
+    PlayerState, StageScenery, STAGES, CHARACTER_ROSTER, Fighter,
+    Match, FixedTimestep, PARTICLE_LIFE, FIGHTER_WIDTH, FIGHTER_HEIGHT, ENTITY_KINDS,
+)
+from koopagfx import (
+    TEXT, StageLayerCache, DirtyRectCompositor, ParticleSprites, EntitySprites, EffectSurfaces,
+    ProfilerOverlay,
+)
+from koopaassets import AssetManager, convert_image
+from koopasprites import FighterAnimator, load_atlas
+from koopaprof import FrameProfiler
+from koopareplay import ReplayRecorder, REPLAY_EXTENSION
+from koopacpu import CpuPlayers, CPU_LEVELS, DEFAULT_LEVEL
+from koopainput import (
+    InputManager, FramePacer, INPUT_BITS, INPUT_NAMES, default_bindings, load_bindings, save_bindings,
+    describe,
+)
+from kooparollback import RollbackSession, UdpPeer
 
 # ============================================
 # HAL LABORATORY SUPER SMASH BROS 64 ENGINE
 # ============================================
-
-# Constants
-SCREEN_WIDTH = 1024
-SCREEN_HEIGHT = 768
-FPS = 60
-GRAVITY = 0.9
-MAX_FALL_SPEED = 18
-
-# N64 Color Palette
-BLACK = (0, 0, 0)
-WHITE = (255, 255, 255)
-RED = (200, 30, 30)
-BLUE = (30, 30, 200)
-GREEN = (30, 200, 30)
-YELLOW = (255, 220, 0)
-PURPLE = (200, 30, 200)
-CYAN = (30, 200, 200)
-ORANGE = (255, 140, 0)
-GRAY = (128, 128, 128)
-DARK_GRAY = (64, 64, 64)
-N64_BLUE = (70, 90, 120)
-N64_RED = (180, 60, 60)
+# pygame front-end. The battle itself is simulated by koopasim; this file
+# only reads the keyboard, feeds input frames to the match and renders.
 
 # Game States
 class GameState(Enum):
@@ -45,19 +44,7 @@ class GameState(Enum):
     PAUSE = 6
     RESULTS = 7
     OPTIONS = 8
-
-class PlayerState(Enum):
-    IDLE = 1
-    WALKING = 2
-    RUNNING = 3
-    JUMPING = 4
-    FALLING = 5
-    ATTACKING = 6
-    STUNNED = 7
-    SHIELDING = 8
-    DODGING = 9
-    GRABBING = 10
-    THROWN = 11
+    LOADING = 9
 
 class MenuOption(Enum):
     SINGLE_PLAYER = 1
@@ -65,494 +52,243 @@ class MenuOption(Enum):
     OPTIONS = 3
     DATA = 4
 
+# HUD colour per player slot
+PLAYER_COLORS = [RED, BLUE, GREEN, YELLOW, PURPLE, CYAN, ORANGE, GRAY]
+
+def hud_slots(count):
+    # (name position, first stock centre) for each player. Two players
+    # keep the classic top corners; bigger matches get a row along the bottom.
+    if count <= 2:
+        return [((50, 20), (60, 60)), ((SCREEN_WIDTH - 200, 20), (SCREEN_WIDTH - 150, 60))][:count]
+    width = (SCREEN_WIDTH - 60) // count
+    return [((30 + i * width, SCREEN_HEIGHT - 80), (40 + i * width, SCREEN_HEIGHT - 40))
+            for i in range(count)]
+
 # ============================================
-# STAGE DEFINITIONS - All 9 N64 Stages
+# STAGE RENDERING - All 9 N64 Stages
 # ============================================
 
-class Stage:
-    def __init__(self, name, stage_id, platforms, blast_zones, spawn_points, bg_color):
-        self.name = name
-        self.stage_id = stage_id
-        self.platforms = platforms
-        self.blast_zones = blast_zones  # left, right, top, bottom
-        self.spawn_points = spawn_points
-        self.bg_color = bg_color
-        self.ground_y = 500
+def draw_layers(screen, layers):
+    # Background primitives from the stage's content pack, in order
+    for shape, color, coords in layers:
+        if shape == "rect":
+            pygame.draw.rect(screen, color, coords)
+        elif shape == "ellipse":
+            pygame.draw.ellipse(screen, color, coords)
+        elif shape == "circle":
+            pygame.draw.circle(screen, color, coords[:2], coords[2])
+        else:
+            pygame.draw.polygon(screen, color, coords)
 
-    def draw(self, screen):
-        # Draw background
-        screen.fill(self.bg_color)
-        
-        # Draw stage-specific elements
-        if self.stage_id == "peachs_castle":
-            self.draw_peachs_castle(screen)
-        elif self.stage_id == "congo_jungle":
-            self.draw_congo_jungle(screen)
-        elif self.stage_id == "hyrule_castle":
-            self.draw_hyrule_castle(screen)
-        elif self.stage_id == "super_happy_tree":
-            self.draw_yoshis_island(screen)
-        elif self.stage_id == "dream_land":
-            self.draw_dream_land(screen)
-        elif self.stage_id == "sector_z":
-            self.draw_sector_z(screen)
-        elif self.stage_id == "planet_zebes":
-            self.draw_planet_zebes(screen)
-        elif self.stage_id == "saffron_city":
-            self.draw_saffron_city(screen)
-        elif self.stage_id == "mushroom_kingdom":
-            self.draw_mushroom_kingdom(screen)
-        
-        # Draw platforms
-        for platform in self.platforms:
-            pygame.draw.rect(screen, platform['color'], 
-                           (platform['x'], platform['y'], platform['width'], platform['height']))
-
-    def draw_peachs_castle(self, screen):
-        # Castle structure
-        pygame.draw.rect(screen, (255, 182, 193), (350, 400, 300, 100))
-        # Castle towers
-        pygame.draw.polygon(screen, (255, 105, 180), [(350, 400), (380, 350), (410, 400)])
-        pygame.draw.polygon(screen, (255, 105, 180), [(590, 400), (620, 350), (650, 400)])
-        # Bumper platform
-        pygame.draw.ellipse(screen, (255, 255, 100), (480, 380, 40, 20))
-
-    def draw_congo_jungle(self, screen):
-        # Barrel cannon platforms
-        pygame.draw.circle(screen, (139, 69, 19), (200, 450), 30)
-        pygame.draw.circle(screen, (139, 69, 19), (824, 450), 30)
-        # Jungle trees
-        for x in range(0, SCREEN_WIDTH, 150):
-            pygame.draw.rect(screen, (101, 67, 33), (x, 500, 30, 200))
-            pygame.draw.circle(screen, (34, 139, 34), (x + 15, 480), 40)
-
-    def draw_hyrule_castle(self, screen):
-        # Castle walls
-        pygame.draw.rect(screen, (105, 105, 105), (100, 400, 824, 100))
-        # Triforce symbol
-        pygame.draw.polygon(screen, (255, 215, 0), [(512, 300), (462, 380), (562, 380)])
-        # Tornado spawn area
-        pygame.draw.circle(screen, (200, 200, 255, 50), (700, 450), 40)
-
-    def draw_yoshis_island(self, screen):
-        # Happy clouds
-        for cloud in [(200, 200), (600, 150), (800, 250)]:
-            pygame.draw.ellipse(screen, WHITE, (cloud[0], cloud[1], 80, 40))
-            pygame.draw.ellipse(screen, WHITE, (cloud[0]-20, cloud[1]+10, 60, 30))
-            pygame.draw.ellipse(screen, WHITE, (cloud[0]+40, cloud[1]+10, 60, 30))
-
-    def draw_dream_land(self, screen):
-        # Whispy Woods tree
-        pygame.draw.rect(screen, (139, 69, 19), (100, 300, 80, 200))
-        pygame.draw.circle(screen, (34, 139, 34), (140, 280), 100)
-        # Dream Land clouds
-        for i in range(3):
-            x = 300 + i * 200
-            pygame.draw.ellipse(screen, (255, 182, 193), (x, 100, 100, 50))
-
-    def draw_sector_z(self, screen):
-        # Great Fox ship outline
-        pygame.draw.polygon(screen, (192, 192, 192), 
-                           [(200, 450), (824, 450), (750, 500), (274, 500)])
-        # Arwing fighters in background
-        for i in range(3):
-            x = 100 + i * 300
-            y = 100 + i * 50
-            pygame.draw.polygon(screen, (100, 100, 150), 
-                               [(x, y), (x+40, y+10), (x+30, y+20), (x+10, y+20)])
-
-    def draw_planet_zebes(self, screen):
-        # Acid lava at bottom
-        pygame.draw.rect(screen, (255, 100, 0), (0, 550, SCREEN_WIDTH, 50))
-        # Bubbling effect
-        for i in range(10):
-            x = random.randint(0, SCREEN_WIDTH)
-            pygame.draw.circle(screen, (255, 150, 0), (x, 555), random.randint(3, 8))
-
-    def draw_saffron_city(self, screen):
-        # City buildings
-        for i in range(5):
-            height = random.randint(100, 300)
-            x = i * 200
-            pygame.draw.rect(screen, (100, 100, 100), (x, 500-height, 150, height))
-            # Windows
-            for w in range(0, height-20, 30):
-                for wx in range(10, 140, 30):
-                    pygame.draw.rect(screen, YELLOW, (x+wx, 510-height+w, 20, 20))
-
-    def draw_mushroom_kingdom(self, screen):
-        # Retro pipes
-        pygame.draw.rect(screen, (0, 200, 0), (150, 420, 60, 80))
-        pygame.draw.rect(screen, (0, 255, 0), (150, 400, 60, 30))
-        pygame.draw.rect(screen, (0, 200, 0), (814, 420, 60, 80))
-        pygame.draw.rect(screen, (0, 255, 0), (814, 400, 60, 30))
-        # Retro blocks
-        for i in range(3):
-            x = 350 + i * 100
-            pygame.draw.rect(screen, (200, 100, 0), (x, 350, 40, 40))
-            pygame.draw.rect(screen, YELLOW, (x+15, 365, 10, 10))
-
-# Initialize all stages
-STAGES = {
-    "peachs_castle": Stage(
-        "Peach's Castle", "peachs_castle",
-        [{'x': 300, 'y': 500, 'width': 400, 'height': 20, 'color': (200, 150, 100)},
-         {'x': 460, 'y': 380, 'width': 80, 'height': 10, 'color': (255, 255, 100)}],
-        (-100, 1124, -200, 700),
-        [(400, 300), (600, 300)],
-        (135, 206, 235)
-    ),
-    "congo_jungle": Stage(
-        "Congo Jungle", "congo_jungle",
-        [{'x': 300, 'y': 500, 'width': 424, 'height': 20, 'color': (101, 67, 33)},
-         {'x': 170, 'y': 420, 'width': 60, 'height': 10, 'color': (139, 69, 19)},
-         {'x': 794, 'y': 420, 'width': 60, 'height': 10, 'color': (139, 69, 19)}],
-        (-100, 1124, -200, 700),
-        [(400, 300), (600, 300)],
-        (34, 100, 34)
-    ),
-    "hyrule_castle": Stage(
-        "Hyrule Castle", "hyrule_castle",
-        [{'x': 100, 'y': 500, 'width': 824, 'height': 20, 'color': (105, 105, 105)},
-         {'x': 350, 'y': 350, 'width': 100, 'height': 10, 'color': (128, 128, 128)},
-         {'x': 574, 'y': 350, 'width': 100, 'height': 10, 'color': (128, 128, 128)}],
-        (-150, 1174, -250, 700),
-        [(400, 300), (600, 300)],
-        (70, 50, 100)
-    ),
-    "super_happy_tree": Stage(
-        "Super Happy Tree", "super_happy_tree",
-        [{'x': 350, 'y': 500, 'width': 324, 'height': 20, 'color': (150, 255, 150)},
-         {'x': 250, 'y': 400, 'width': 80, 'height': 10, 'color': (200, 255, 200)},
-         {'x': 694, 'y': 400, 'width': 80, 'height': 10, 'color': (200, 255, 200)},
-         {'x': 450, 'y': 300, 'width': 124, 'height': 10, 'color': (200, 255, 200)}],
-        (-100, 1124, -200, 700),
-        [(400, 300), (600, 300)],
-        (135, 206, 250)
-    ),
-    "dream_land": Stage(
-        "Dream Land", "dream_land",
-        [{'x': 250, 'y': 500, 'width': 524, 'height': 20, 'color': (255, 182, 193)},
-         {'x': 350, 'y': 370, 'width': 100, 'height': 10, 'color': (255, 200, 200)},
-         {'x': 574, 'y': 370, 'width': 100, 'height': 10, 'color': (255, 200, 200)},
-         {'x': 462, 'y': 250, 'width': 100, 'height': 10, 'color': (255, 200, 200)}],
-        (-100, 1124, -200, 700),
-        [(400, 300), (600, 300)],
-        (255, 200, 255)
-    ),
-    "sector_z": Stage(
-        "Sector Z", "sector_z",
-        [{'x': 200, 'y': 475, 'width': 624, 'height': 30, 'color': (192, 192, 192)}],
-        (-200, 1224, -300, 700),
-        [(400, 350), (600, 350)],
-        (20, 20, 40)
-    ),
-    "planet_zebes": Stage(
-        "Planet Zebes", "planet_zebes",
-        [{'x': 350, 'y': 500, 'width': 324, 'height': 20, 'color': (100, 50, 50)},
-         {'x': 200, 'y': 380, 'width': 80, 'height': 10, 'color': (150, 75, 75)},
-         {'x': 744, 'y': 380, 'width': 80, 'height': 10, 'color': (150, 75, 75)},
-         {'x': 450, 'y': 280, 'width': 124, 'height': 10, 'color': (150, 75, 75)}],
-        (-100, 1124, -200, 600),
-        [(400, 300), (600, 300)],
-        (50, 25, 25)
-    ),
-    "saffron_city": Stage(
-        "Saffron City", "saffron_city",
-        [{'x': 300, 'y': 500, 'width': 424, 'height': 20, 'color': (100, 100, 100)},
-         {'x': 200, 'y': 350, 'width': 100, 'height': 10, 'color': (150, 150, 150)},
-         {'x': 724, 'y': 350, 'width': 100, 'height': 10, 'color': (150, 150, 150)}],
-        (-100, 1124, -200, 700),
-        [(400, 300), (600, 300)],
-        (50, 50, 100)
-    ),
-    "mushroom_kingdom": Stage(
-        "Mushroom Kingdom", "mushroom_kingdom",
-        [{'x': 0, 'y': 500, 'width': 1024, 'height': 20, 'color': (200, 100, 0)},
-         {'x': 350, 'y': 390, 'width': 40, 'height': 10, 'color': (200, 100, 0)},
-         {'x': 450, 'y': 390, 'width': 40, 'height': 10, 'color': (200, 100, 0)},
-         {'x': 550, 'y': 390, 'width': 40, 'height': 10, 'color': (200, 100, 0)}],
-        (0, 1024, -200, 700),  # Walk-off stage
-        [(400, 300), (600, 300)],
-        (100, 150, 255)
-    )
-}
+def draw_skyline(screen, scenery):
+    # City buildings, rolled once per match
+    for i, height in enumerate(scenery.skyline):
+        x = i * 200
+        pygame.draw.rect(screen, (100, 100, 100), (x, 500-height, 150, height))
+        # Windows
+        for w in range(0, height-20, 30):
+            for wx in range(10, 140, 30):
+                pygame.draw.rect(screen, YELLOW, (x+wx, 510-height+w, 20, 20))
 
-# ============================================
-# CHARACTER DEFINITIONS - Original 12
-# ============================================
+def animate_lava_bubbles(screen, scenery):
+    # Bubbling effect
+    for x, size, life in scenery.bubbles:
+        pygame.draw.circle(screen, (255, 150, 0), (x, 555), size)
+    return [pygame.Rect(0, 547, SCREEN_WIDTH, 17)]
 
-class CharacterData:
-    def __init__(self, name, color, speed, jump_power, weight, fall_speed):
-        self.name = name
-        self.color = color
-        self.speed = speed
-        self.jump_power = jump_power
-        self.weight = weight
-        self.fall_speed = fall_speed
-
-CHARACTER_ROSTER = {
-    "Mario": CharacterData("Mario", RED, 5, 17, 1.0, 1.0),
-    "DK": CharacterData("Donkey Kong", (139, 69, 19), 4, 18, 1.3, 1.2),
-    "Link": CharacterData("Link", GREEN, 4.5, 16, 1.1, 1.1),
-    "Samus": CharacterData("Samus", ORANGE, 3.5, 16, 1.2, 1.0),
-    "Yoshi": CharacterData("Yoshi", (50, 205, 50), 6, 19, 0.9, 0.8),
-    "Kirby": CharacterData("Kirby", (255, 182, 193), 4, 20, 0.7, 0.6),
-    "Fox": CharacterData("Fox", (255, 140, 0), 7, 18, 0.8, 1.5),
-    "Pikachu": CharacterData("Pikachu", YELLOW, 6.5, 17, 0.75, 0.9),
-    "Luigi": CharacterData("Luigi", (0, 200, 0), 5, 19, 0.95, 0.8),
-    "Ness": CharacterData("Ness", (255, 0, 100), 4.5, 17, 0.9, 0.95),
-    "C.Falcon": CharacterData("Captain Falcon", (0, 0, 200), 8, 17, 1.1, 1.3),
-    "Jigglypuff": CharacterData("Jigglypuff", (255, 200, 255), 4, 22, 0.6, 0.5)
+# Scenery rolled per match, keyed by a stage's background "scenery" kind.
+# Painters are baked with the static layer.
+SCENERY_PAINTERS = {
+    "skyline": draw_skyline,
 }
 
-class Fighter:
-    def __init__(self, character_data, x, y, player_num):
-        self.name = character_data.name
-        self.x = x
-        self.y = y
-        self.vx = 0
-        self.vy = 0
-        self.width = 40
-        self.height = 60
-        self.color = character_data.color
-        self.player_num = player_num
-        
-        # Character stats from data
-        self.speed = character_data.speed
-        self.jump_power = character_data.jump_power
-        self.weight = character_data.weight
-        self.fall_speed_multiplier = character_data.fall_speed
-        
-        # Combat stats
-        self.damage = 0
-        self.stocks = 4
-        self.state = PlayerState.IDLE
-        self.facing_right = True
-        self.invulnerable = False
-        self.invuln_timer = 0
-        
-        # Movement
-        self.max_jumps = 2
-        self.jumps_left = self.max_jumps
-        self.fast_falling = False
-        
-        # Timers
-        self.attack_timer = 0
-        self.stun_timer = 0
-        self.shield_health = 100
-        self.dodge_timer = 0
-        
-        # Visual effects
-        self.hit_particles = []
-        
-    def update(self, stage):
-        # Handle invulnerability
-        if self.invulnerable:
-            self.invuln_timer -= 1
-            if self.invuln_timer <= 0:
-                self.invulnerable = False
-        
-        # Handle stun
-        if self.state == PlayerState.STUNNED:
-            self.stun_timer -= 1
-            if self.stun_timer <= 0:
-                self.state = PlayerState.IDLE
-        
-        # Handle attacks
-        if self.state == PlayerState.ATTACKING:
-            self.attack_timer -= 1
-            if self.attack_timer <= 0:
-                self.state = PlayerState.IDLE
-        
-        # Handle dodge
-        if self.state == PlayerState.DODGING:
-            self.dodge_timer -= 1
-            if self.dodge_timer <= 0:
-                self.state = PlayerState.IDLE
-                self.invulnerable = False
-        
-        # Apply gravity
-        if self.y < stage.ground_y:
-            gravity = GRAVITY * self.fall_speed_multiplier
-            if self.fast_falling:
-                gravity *= 2
-            self.vy += gravity
-            if self.vy > MAX_FALL_SPEED * self.fall_speed_multiplier:
-                self.vy = MAX_FALL_SPEED * self.fall_speed_multiplier
-        
-        # Apply movement
-        if self.state != PlayerState.STUNNED:
-            self.x += self.vx
-        self.y += self.vy
-        
-        # Ground collision
-        if self.y >= stage.ground_y:
-            self.y = stage.ground_y
-            self.vy = 0
-            self.jumps_left = self.max_jumps
-            self.fast_falling = False
-            if self.state in [PlayerState.JUMPING, PlayerState.FALLING]:
-                self.state = PlayerState.IDLE
-        
-        # Platform collisions
-        for platform in stage.platforms:
-            if (self.vy > 0 and 
-                self.x + self.width > platform['x'] and 
-                self.x < platform['x'] + platform['width'] and
-                self.y < platform['y'] and 
-                self.y + self.height >= platform['y']):
-                self.y = platform['y'] - self.height
-                self.vy = 0
-                self.jumps_left = self.max_jumps
-                self.fast_falling = False
-                if self.state in [PlayerState.JUMPING, PlayerState.FALLING]:
-                    self.state = PlayerState.IDLE
-        
-        # Check blast zones
-        if (self.x < stage.blast_zones[0] or 
-            self.x > stage.blast_zones[1] or 
-            self.y < stage.blast_zones[2] or 
-            self.y > stage.blast_zones[3]):
-            self.respawn(stage)
-        
-        # Update particles
-        self.hit_particles = [(x, y, size, life - 1) 
-                              for x, y, size, life in self.hit_particles if life > 0]
-    
-    def move(self, direction):
-        if self.state == PlayerState.STUNNED:
-            return
-        
-        if direction == 'left':
-            self.vx = -self.speed
-            self.facing_right = False
-            if self.state == PlayerState.IDLE:
-                self.state = PlayerState.WALKING
-        elif direction == 'right':
-            self.vx = self.speed
-            self.facing_right = True
-            if self.state == PlayerState.IDLE:
-                self.state = PlayerState.WALKING
-        else:
-            self.vx *= 0.85
-            if abs(self.vx) < 0.5:
-                self.vx = 0
-                if self.state == PlayerState.WALKING:
-                    self.state = PlayerState.IDLE
-    
-    def jump(self):
-        if self.state == PlayerState.STUNNED:
-            return
-        
-        if self.jumps_left > 0:
-            self.vy = -self.jump_power
-            self.jumps_left -= 1
-            self.state = PlayerState.JUMPING
+# Scenery that changes every frame; each returns the rects it touched
+SCENERY_ANIMATIONS = {
+    "lava_bubbles": animate_lava_bubbles,
+}
+
+def paint_stage_layer(surface, stage, scenery):
+    # Draw background
+    surface.fill(stage.bg_color)
     
-    def attack(self, attack_type='neutral'):
-        if self.state in [PlayerState.STUNNED, PlayerState.ATTACKING]:
-            return
-        
-        self.state = PlayerState.ATTACKING
-        self.attack_timer = 20
+    # Draw stage-specific elements
+    draw_layers(surface, stage.layers)
+    painter = SCENERY_PAINTERS.get(stage.scenery)
+    if painter:
+        painter(surface, scenery)
     
-    def shield(self, active):
-        if self.state == PlayerState.STUNNED:
-            return
-        
-        if active and self.shield_health > 0:
-            self.state = PlayerState.SHIELDING
-            self.shield_health -= 0.5
+    # Draw platforms
+    draw_platforms(surface, stage)
+
+def draw_platforms(screen, stage, area=None):
+    for platform in stage.platforms:
+        rect = pygame.Rect(platform['x'], platform['y'], platform['width'], platform['height'])
+        if area is None or area.colliderect(rect):
+            pygame.draw.rect(screen, platform['color'], rect)
+
+STAGE_LAYERS = StageLayerCache(paint_stage_layer)
+
+# Everything decoded or pre-rendered off the main thread
+ASSETS = AssetManager()
+
+def animate_stage(screen, stage, scenery):
+    # Draw the animated layers over the baked background, keeping
+    # platforms in front of them. Returns the dirty rects.
+    animation = SCENERY_ANIMATIONS.get(stage.scenery)
+    if not animation:
+        return []
+    rects = animation(screen, scenery)
+    for rect in rects:
+        draw_platforms(screen, stage, rect)
+    return rects
+
+def hazard_surface(hazard):
+    # One overlay per hazard look, registered the first time it is drawn
+    size = (int(hazard.width), int(hazard.height))
+    name = ('hazard', size, hazard.color)
+    if name not in EFFECTS.effects:
+        color = hazard.color
+        EFFECTS.register(name, size, lambda surface, alpha: surface.fill(color), buckets=1)
+    return EFFECTS.get(name)
+
+def draw_hazards(screen, hazards):
+    # Moving platforms and the hazards that are out, over the stage and
+    # behind fighters. Returns the dirty rects.
+    dirty = [pygame.draw.rect(screen, platform.color, (x, y, platform.width, platform.height))
+             for platform, x, y in zip(hazards.platforms, hazards.platform_x, hazards.platform_y)]
+    out = [(hazard_surface(hazard), (int(x), int(y)))
+           for hazard, x, y, shown in zip(hazards.hazards, hazards.hazard_x, hazards.hazard_y, hazards.out)
+           if shown]
+    if out:
+        dirty.extend(screen.blits(out))
+    return dirty
+
+def draw_stage(screen, stage, scenery):
+    screen.blit(STAGE_LAYERS.get(stage, screen.get_size(), scenery), (0, 0))
+    return animate_stage(screen, stage, scenery)
+
+# ============================================
+# FIGHTER RENDERING
+# ============================================
+
+def paint_shield(surface, alpha):
+    pygame.draw.ellipse(surface, (*CYAN, alpha), surface.get_rect())
+
+def paint_hitbox(surface, alpha):
+    pygame.draw.ellipse(surface, (*YELLOW, alpha), surface.get_rect())
+
+EFFECTS = EffectSurfaces()
+EFFECTS.register('shield', (FIGHTER_WIDTH + 30, FIGHTER_HEIGHT + 30), paint_shield)
+
+def hitbox_surface(width, height):
+    # One overlay per hitbox size, registered the first time it is drawn
+    name = ('hitbox', width, height)
+    if name not in EFFECTS.effects:
+        EFFECTS.register(name, (width, height), paint_hitbox, buckets=1)
+    return EFFECTS.get(name, 100)
+
+def fighter_atlas(key):
+    # The character's sprite atlas, or None while it is loading
+    return ASSETS.request(('fighter', key, 'atlas'), load_atlas, CHARACTER_ROSTER[key], finish=convert_image)
+
+ANIMATOR = FighterAnimator()
+
+def draw_fighters(screen, match):
+    # Every fighter's sprite in one Surface.blits call, then the effects
+    # and damage readouts over all of them. Returns the dirty rects.
+    ANIMATOR.follow(match)
+    sprites = []
+    dirty = []
+    for fighter, key in zip(match.players, match.characters):
+        atlas = fighter_atlas(key)
+        if atlas is None:
+            dirty.append(draw_fighter_placeholder(screen, fighter))
         else:
-            if self.state == PlayerState.SHIELDING:
-                self.state = PlayerState.IDLE
-            if self.shield_health < 100:
-                self.shield_health += 0.3
+            sprites.append(ANIMATOR.blit(atlas, fighter, match.game_time))
+    dirty.extend(screen.blits(sprites))
+    for fighter in match.players:
+        dirty.append(draw_fighter(screen, fighter))
+    return dirty
+
+def draw_fighter_placeholder(screen, fighter):
+    # Flat body for the frames before a fighter's atlas has loaded
+    if fighter.invulnerable and fighter.invuln_timer % 12 < 6:
+        color = WHITE
+    else:
+        color = fighter.color
+    dirty = pygame.draw.rect(screen, color, (fighter.x, fighter.y, fighter.width, fighter.height))
+    eye_x = fighter.x + 30 if fighter.facing_right else fighter.x + 10
+    pygame.draw.circle(screen, WHITE, (eye_x, fighter.y + 15), 4)
+    return dirty
+
+def draw_fighter(screen, fighter):
+    # Effects and the damage readout over a fighter's sprite
+    dirty = pygame.Rect(fighter.x, fighter.y, fighter.width, fighter.height)
     
-    def take_hit(self, damage, knockback_x, knockback_y):
-        if self.invulnerable or self.state == PlayerState.SHIELDING:
-            if self.state == PlayerState.SHIELDING:
-                self.shield_health -= damage * 2
-            return
-        
-        self.damage += damage
-        
-        # N64-style knockback calculation
-        kb_multiplier = 1 + (self.damage / 80) / self.weight
-        self.vx = knockback_x * kb_multiplier
-        self.vy = knockback_y * kb_multiplier
-        
-        self.state = PlayerState.STUNNED
-        self.stun_timer = min(60, int(damage * 1.5))
-        self.invulnerable = True
-        self.invuln_timer = 60
-        
-        # Add hit effect
-        for i in range(12):
-            self.hit_particles.append((
-                self.x + self.width//2,
-                self.y + self.height//2,
-                random.randint(3, 8),
-                20
-            ))
+    # Shield, fading with shield health
+    if fighter.state == PlayerState.SHIELDING:
+        shield_surface = EFFECTS.get('shield', fighter.shield_health * 2.55)
+        dirty.union_ip(screen.blit(shield_surface, (fighter.x - 15, fighter.y - 15)))
     
-    def respawn(self, stage):
-        self.stocks -= 1
-        if self.stocks > 0:
-            spawn = random.choice(stage.spawn_points)
-            self.x = spawn[0]
-            self.y = spawn[1]
-            self.vx = 0
-            self.vy = 0
-            self.damage = 0
-            self.state = PlayerState.IDLE
-            self.invulnerable = True
-            self.invuln_timer = 120
+    # Hitboxes out on this frame of the attack
+    if fighter.state == PlayerState.ATTACKING:
+        moves = fighter.moves
+        for slot in moves.slots(fighter.attack_move, fighter.move_frame()):
+            left, top, right, bottom = fighter.hitbox(slot)
+            size = (round(moves.right[True][slot] - moves.left[True][slot]), round(moves.bottom[slot] - moves.top[slot]))
+            dirty.union_ip(screen.blit(hitbox_surface(*size), (left, top)))
     
-    def draw(self, screen):
-        # Draw character with N64-style rendering
-        if self.invulnerable and pygame.time.get_ticks() % 200 < 100:
-            color = WHITE
-        else:
-            color = self.color
-        
-        # Character body
-        pygame.draw.rect(screen, color, (self.x, self.y, self.width, self.height))
-        
-        # Direction indicator
-        eye_y = self.y + 15
-        if self.facing_right:
-            pygame.draw.circle(screen, WHITE, (self.x + 30, eye_y), 4)
-        else:
-            pygame.draw.circle(screen, WHITE, (self.x + 10, eye_y), 4)
-        
-        # Shield
-        if self.state == PlayerState.SHIELDING:
-            shield_alpha = int(self.shield_health * 2.55)
-            shield_surface = pygame.Surface((self.width + 30, self.height + 30), pygame.SRCALPHA)
-            pygame.draw.ellipse(shield_surface, (*CYAN, shield_alpha), 
-                              (0, 0, self.width + 30, self.height + 30))
-            screen.blit(shield_surface, (self.x - 15, self.y - 15))
-        
-        # Attack hitbox
-        if self.state == PlayerState.ATTACKING:
-            attack_surface = pygame.Surface((60, 60), pygame.SRCALPHA)
-            hitbox_x = self.x + (self.width if self.facing_right else -60)
-            pygame.draw.circle(attack_surface, (*YELLOW, 100), (30, 30), 30)
-            screen.blit(attack_surface, (hitbox_x, self.y))
-        
-        # Hit particles
-        for x, y, size, life in self.hit_particles:
-            alpha = life / 20
-            pygame.draw.circle(screen, (255, int(255*alpha), int(255*alpha)), 
-                             (int(x), int(y)), size)
-        
-        # Damage percentage
-        font = pygame.font.Font(None, 32)
-        damage_text = font.render(f"{int(self.damage)}%", True, WHITE)
-        text_x = self.x + self.width // 2 - damage_text.get_width() // 2
-        screen.blit(damage_text, (text_x, self.y - 30))
+    # Damage percentage
+    dirty.union_ip(TEXT.blit_number(screen, f"{int(fighter.damage)}%", 32, WHITE,
+                                    midtop=(fighter.x + fighter.width // 2, fighter.y - 30)))
+    return dirty
+
+def particle_color(color, fade):
+    # Hit sparks cool from white to red
+    return (255, int(255 * fade), int(255 * fade))
+
+PARTICLE_SPRITES = ParticleSprites(particle_color, PARTICLE_LIFE)
+
+# ============================================
+# ENTITY RENDERING
+# ============================================
+
+def paint_fireball(surface):
+    rect = surface.get_rect()
+    pygame.draw.ellipse(surface, ORANGE, rect)
+    pygame.draw.ellipse(surface, YELLOW, rect.inflate(-rect.width // 2, -rect.height // 2))
+
+def paint_laser(surface):
+    surface.fill((255, 60, 60))
+
+def paint_shot(surface):
+    rect = surface.get_rect()
+    pygame.draw.ellipse(surface, (255, 200, 60), rect)
+    pygame.draw.ellipse(surface, WHITE, rect.inflate(-rect.width // 2, -rect.height // 2))
+
+def paint_thunder(surface):
+    w, h = surface.get_size()
+    pygame.draw.polygon(surface, YELLOW, [(w // 2, 0), (w - 1, h // 2), (w // 2, h - 1), (0, h // 2)])
+
+def paint_bomb(surface):
+    w, h = surface.get_size()
+    pygame.draw.circle(surface, BLACK, (w // 2, h // 2 + 2), w // 2 - 2)
+    pygame.draw.line(surface, RED, (w // 2, 4), (w // 2 + 4, 0), 2)
+
+def paint_shell(surface):
+    rect = surface.get_rect()
+    pygame.draw.ellipse(surface, GREEN, rect)
+    pygame.draw.ellipse(surface, WHITE, rect, 2)
+
+ENTITY_PAINTERS = {
+    'fireball': paint_fireball,
+    'laser': paint_laser,
+    'shot': paint_shot,
+    'thunder': paint_thunder,
+    'bomb': paint_bomb,
+    'shell': paint_shell,
+}
+ENTITY_SPRITES = EntitySprites(ENTITY_KINDS, ENTITY_PAINTERS)
 
 # ============================================
 # MENU SYSTEM
@@ -562,9 +298,9 @@ class MainMenu:
     def __init__(self):
         self.options = ["1P MODE", "VS MODE", "OPTIONS", "DATA"]
         self.selected = 0
-        self.title_font = pygame.font.Font(None, 72)
-        self.menu_font = pygame.font.Font(None, 48)
-        self.copyright_font = pygame.font.Font(None, 24)
+        self.title_size = 72
+        self.menu_size = 48
+        self.copyright_size = 24
         
     def update(self, keys_pressed):
         if pygame.K_UP in keys_pressed:
@@ -579,19 +315,19 @@ class MainMenu:
         screen.fill(N64_BLUE)
         
         # Draw title
-        title = self.title_font.render("SUPER SMASH BROS", True, WHITE)
+        title = TEXT.render("SUPER SMASH BROS", self.title_size, WHITE)
         title_rect = title.get_rect(center=(SCREEN_WIDTH//2, 150))
         screen.blit(title, title_rect)
         
         # Draw N64 subtitle
-        subtitle = self.menu_font.render("64", True, YELLOW)
+        subtitle = TEXT.render("64", self.menu_size, YELLOW)
         subtitle_rect = subtitle.get_rect(center=(SCREEN_WIDTH//2, 210))
         screen.blit(subtitle, subtitle_rect)
         
         # Draw menu options
         for i, option in enumerate(self.options):
             color = YELLOW if i == self.selected else WHITE
-            text = self.menu_font.render(option, True, color)
+            text = TEXT.render(option, self.menu_size, color)
             text_rect = text.get_rect(center=(SCREEN_WIDTH//2, 350 + i * 60))
             screen.blit(text, text_rect)
             
@@ -604,17 +340,18 @@ class MainMenu:
         
         # Draw copyright
         copyright_text = "© 1999 HAL Laboratory, Inc. / Nintendo"
-        copyright = self.copyright_font.render(copyright_text, True, WHITE)
+        copyright = TEXT.render(copyright_text, self.copyright_size, WHITE)
         copyright_rect = copyright.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT - 30))
         screen.blit(copyright, copyright_rect)
 
 class CharacterSelect:
-    def __init__(self):
+    def __init__(self, humans=2):
         self.characters = list(CHARACTER_ROSTER.keys())
+        self.humans = humans  # 1 in 1P MODE, where P2 is a CPU
         self.selected = [0, 1]  # P1 and P2 selections
-        self.confirmed = [False, False]
-        self.title_font = pygame.font.Font(None, 48)
-        self.name_font = pygame.font.Font(None, 32)
+        self.confirmed = [False, humans < 2]
+        self.title_size = 48
+        self.name_size = 32
         
     def update(self, keys_pressed):
         # Player 1 controls (WASD)
@@ -627,7 +364,7 @@ class CharacterSelect:
                 self.confirmed[0] = True
         
         # Player 2 controls (Arrows)
-        if not self.confirmed[1]:
+        if self.humans > 1 and not self.confirmed[1]:
             if pygame.K_LEFT in keys_pressed:
                 self.selected[1] = (self.selected[1] - 1) % len(self.characters)
             elif pygame.K_RIGHT in keys_pressed:
@@ -637,14 +374,14 @@ class CharacterSelect:
         
         # Check if both players confirmed
         if self.confirmed[0] and self.confirmed[1]:
-            return (self.characters[self.selected[0]], self.characters[self.selected[1]])
+            return tuple(self.characters[i] for i in self.selected[:self.humans])
         return None
     
     def draw(self, screen):
         screen.fill(DARK_GRAY)
         
         # Draw title
-        title = self.title_font.render("CHARACTER SELECT", True, WHITE)
+        title = TEXT.render("CHARACTER SELECT", self.title_size, WHITE)
         title_rect = title.get_rect(center=(SCREEN_WIDTH//2, 50))
         screen.blit(title, title_rect)
         
@@ -666,7 +403,7 @@ class CharacterSelect:
             color = GRAY
             if i == self.selected[0]:
                 color = RED if not self.confirmed[0] else (255, 100, 100)
-            elif i == self.selected[1]:
+            elif i == self.selected[1] and self.humans > 1:
                 color = BLUE if not self.confirmed[1] else (100, 100, 255)
             
             pygame.draw.rect(screen, color, (x, y, box_width - 10, box_height - 10), 3)
@@ -677,23 +414,130 @@ class CharacterSelect:
                            (x + 30, y + 20, 50, 60))
             
             # Draw character name
-            name = self.name_font.render(char_name[:8], True, WHITE)
+            name = TEXT.render(char_name[:8], self.name_size, WHITE)
             name_rect = name.get_rect(center=(x + box_width//2 - 5, y + box_height - 20))
             screen.blit(name, name_rect)
         
         # Draw player indicators
-        p1_text = self.name_font.render("P1", True, RED)
+        p1_text = TEXT.render("P1", self.name_size, RED)
         screen.blit(p1_text, (50, 300))
         
-        p2_text = self.name_font.render("P2", True, BLUE)
+        p2_text = TEXT.render("P2" if self.humans > 1 else "CPU", self.name_size, BLUE)
         screen.blit(p2_text, (SCREEN_WIDTH - 80, 300))
 
+class OptionsMenu:
+    # Controls for each player slot. UP/DOWN picks an action, LEFT/RIGHT
+    # the player, RETURN binds the action to the next key or pad input,
+    # BACKSPACE clears it and R restores the slot's defaults. Every change
+    # is saved straight away.
+    def __init__(self, controls):
+        self.controls = controls
+        self.player = 0
+        self.selected = 0
+        self.capturing = False
+        self.title_size = 48
+        self.row_size = 32
+    
+    def update(self, keys_pressed):
+        if self.capturing:
+            return
+        players = len(self.controls.bindings)
+        if pygame.K_UP in keys_pressed:
+            self.selected = (self.selected - 1) % len(INPUT_BITS)
+        elif pygame.K_DOWN in keys_pressed:
+            self.selected = (self.selected + 1) % len(INPUT_BITS)
+        elif pygame.K_LEFT in keys_pressed:
+            self.player = (self.player - 1) % players
+        elif pygame.K_RIGHT in keys_pressed:
+            self.player = (self.player + 1) % players
+        elif pygame.K_RETURN in keys_pressed:
+            self.capturing = True
+        elif pygame.K_BACKSPACE in keys_pressed:
+            self.rebind({INPUT_BITS[self.selected]: []})
+        elif pygame.K_r in keys_pressed:
+            self.rebind(default_bindings()[self.player])
+    
+    def capture(self, event):
+        # While capturing, the next key or pad input becomes the binding
+        # and ESC cancels. Returns whether the event was used up.
+        if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+            self.capturing = False
+            return True
+        control = self.controls.control_for(event)
+        if control is None:
+            return False
+        self.rebind({INPUT_BITS[self.selected]: [control]})
+        self.capturing = False
+        return True
+    
+    def rebind(self, changes):
+        bindings = self.controls.bindings
+        bindings[self.player].update(changes)
+        self.controls.set_bindings(bindings)
+        try:
+            save_bindings(bindings)
+        except OSError as error:
+            print(f"could not save bindings: {error}", file=sys.stderr)
+    
+    def draw(self, screen):
+        screen.fill(N64_BLUE)
+        TEXT.blit(screen, "CONTROLS", self.title_size, WHITE, center=(SCREEN_WIDTH//2, 60))
+        color = PLAYER_COLORS[self.player % len(PLAYER_COLORS)]
+        TEXT.blit(screen, f"<  P{self.player + 1}  >", self.title_size, color, center=(SCREEN_WIDTH//2, 140))
+        
+        bindings = self.controls.bindings[self.player]
+        for i, (bit, name) in enumerate(zip(INPUT_BITS, INPUT_NAMES)):
+            y = 230 + i * 60
+            color = YELLOW if i == self.selected else WHITE
+            TEXT.blit(screen, name.upper(), self.row_size, color, midleft=(160, y))
+            if self.capturing and i == self.selected:
+                bound = "PRESS A KEY OR BUTTON..."
+            else:
+                bound = ", ".join(describe(control) for control in bindings[bit][:3]) or "-"
+            TEXT.blit(screen, bound, self.row_size, color, midleft=(380, y))
+        
+        help_text = "RETURN REBIND   BACKSPACE CLEAR   R RESET   ESC BACK"
+        TEXT.blit(screen, help_text, 24, WHITE, center=(SCREEN_WIDTH//2, SCREEN_HEIGHT - 40))
+
+# Stage select previews are the whole stage scaled to PREVIEW_SIZE, which
+# keeps the screen's 4:3 shape: every 64 screen pixels become 25 preview
+# pixels. Stages with animated scenery refresh just the animated strips
+# every PREVIEW_ANIMATION_FRAMES frames instead of every frame.
+PREVIEW_SIZE = (400, 300)
+PREVIEW_GRID = 64
+PREVIEW_ANIMATION_FRAMES = 6
+
+def render_preview(stage, scenery):
+    # Runs on an asset worker; the result is cached per stage
+    surface = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT))
+    paint_stage_layer(surface, stage, scenery)
+    animate_stage(surface, stage, scenery)
+    return pygame.transform.smoothscale(surface, PREVIEW_SIZE)
+
+def rescale_preview(preview, source, rect):
+    # Scale one screen-space rect of source into the preview. The rect is
+    # widened to the grid so it maps onto whole preview pixels.
+    grid = PREVIEW_GRID
+    left = rect.left // grid * grid
+    top = rect.top // grid * grid
+    area = pygame.Rect(left, top, -(-rect.right // grid) * grid - left,
+                       -(-rect.bottom // grid) * grid - top).clip(source.get_rect())
+    if not area:
+        return
+    sx = PREVIEW_SIZE[0] / SCREEN_WIDTH
+    sy = PREVIEW_SIZE[1] / SCREEN_HEIGHT
+    scaled = pygame.transform.smoothscale(source.subsurface(area), (round(area.width * sx), round(area.height * sy)))
+    preview.blit(scaled, (round(area.x * sx), round(area.y * sy)))
+
 class StageSelect:
     def __init__(self):
         self.stages = list(STAGES.keys())
         self.selected = 0
-        self.title_font = pygame.font.Font(None, 48)
-        self.name_font = pygame.font.Font(None, 32)
+        self.scenery = {}
+        self.title_size = 48
+        self.name_size = 32
+        self.frames = 0
+        self.live = None  # (stage_id, screen-size work surface, animated preview, dirty rects)
         
     def update(self, keys_pressed):
         if pygame.K_LEFT in keys_pressed:
@@ -704,23 +548,71 @@ class StageSelect:
             return self.stages[self.selected]
         return None
     
+    def request_preview(self, index):
+        stage = STAGES[self.stages[index]]
+        scenery = self.scenery.get(stage.stage_id)
+        if scenery is None:
+            scenery = StageScenery(stage, random.Random(index))
+            self.scenery[stage.stage_id] = scenery
+        return ASSETS.request(('stage', stage.stage_id, 'preview'), render_preview, stage, scenery,
+                              finish=convert_image)
+    
+    def preview(self):
+        # The selected stage's preview, or None while it is being rendered.
+        # Its neighbours are queued right behind it so scrolling finds them ready.
+        preview = self.request_preview(self.selected)
+        for step in (1, -1):
+            self.request_preview((self.selected + step) % len(self.stages))
+        
+        stage = STAGES[self.stages[self.selected]]
+        if preview is None or stage.scenery not in SCENERY_ANIMATIONS:
+            return preview
+        
+        # Animated scenery: replay the animation over the stage's static
+        # layer at a reduced rate and rescale only the strips it touched
+        self.frames += 1
+        live = self.live
+        if live is not None and live[0] == stage.stage_id:
+            if self.frames % PREVIEW_ANIMATION_FRAMES:
+                return live[2]
+            stage_id, work, animated, dirty = live
+        else:
+            work, animated, dirty = None, preview.copy(), []
+        scenery = self.scenery[stage.stage_id]
+        layer = STAGE_LAYERS.get(stage, (SCREEN_WIDTH, SCREEN_HEIGHT), scenery)
+        if work is None:
+            work = layer.copy()
+        for rect in dirty:
+            work.blit(layer, rect, rect)
+        for i in range(PREVIEW_ANIMATION_FRAMES):
+            scenery.tick()
+        rects = animate_stage(work, stage, scenery)
+        for rect in dirty + rects:
+            rescale_preview(animated, work, rect)
+        self.live = (stage.stage_id, work, animated, rects)
+        return animated
+    
     def draw(self, screen):
         screen.fill(DARK_GRAY)
         
         # Draw title
-        title = self.title_font.render("STAGE SELECT", True, WHITE)
+        title = TEXT.render("STAGE SELECT", self.title_size, WHITE)
         title_rect = title.get_rect(center=(SCREEN_WIDTH//2, 50))
         screen.blit(title, title_rect)
         
         # Draw stage preview
         stage = STAGES[self.stages[self.selected]]
-        preview_surface = pygame.Surface((600, 400))
-        stage.draw(preview_surface)
-        preview_surface = pygame.transform.scale(preview_surface, (450, 300))
-        screen.blit(preview_surface, (SCREEN_WIDTH//2 - 225, 150))
+        preview = self.preview()
+        preview_rect = pygame.Rect((0, 0), PREVIEW_SIZE)
+        preview_rect.midtop = (SCREEN_WIDTH//2, 150)
+        if preview is not None:
+            screen.blit(preview, preview_rect)
+        else:
+            pygame.draw.rect(screen, BLACK, preview_rect)
+            TEXT.blit(screen, "LOADING...", self.name_size, GRAY, center=preview_rect.center)
         
         # Draw stage name
-        name = self.name_font.render(stage.name.upper(), True, YELLOW)
+        name = TEXT.render(stage.name.upper(), self.name_size, YELLOW)
         name_rect = name.get_rect(center=(SCREEN_WIDTH//2, 480))
         screen.blit(name, name_rect)
         
@@ -738,33 +630,103 @@ class StageSelect:
 # GAME ENGINE
 # ============================================
 
+def preload_stages():
+    # Builds every Stage and its collision index ahead of stage select
+    for stage_id in STAGES:
+        STAGES[stage_id]
+
+# CPU players decide on the asset workers; each decision's rollout stops
+# after CPU_BUDGET_MS so it never holds the interpreter for much of a frame
+CPU_BUDGET_MS = 10
+
+# After leaving a netplay match the peer keeps sending for up to this many
+# frames, until the other side has every input it needs (or hears we quit)
+NETPLAY_LINGER_FRAMES = 2 * FPS
+
+def load_battle(stage_id, characters, size, items=0, hazards=True, cpu_levels=None):
+    # Runs on an asset worker: the match, its stage art baked ready for
+    # STAGE_LAYERS.put on the main thread, and its CPU players if any
+    match = Match(STAGES[stage_id], characters, items=items, hazards=hazards)
+    cpus = None
+    if cpu_levels:
+        cpus = CpuPlayers(match, cpu_levels, submit=ASSETS.submit, budget_ms=CPU_BUDGET_MS)
+    return match, STAGE_LAYERS.bake(match.stage, size, match.scenery), cpus
+
 class SmashBros64Engine:
-    def __init__(self):
+    def __init__(self, replay_dir=None, player_count=2, profile=False, trace_path=None, items=0,
+                 hazards=True, cpu_level=DEFAULT_LEVEL, frame_delay=0):
+        # Only what the first frame needs: the window and fonts. Other
+        # pygame modules start when something first uses them.
+        pygame.display.init()
+        pygame.font.init()
+        
         self.screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
         pygame.display.set_caption("Super Smash Bros 64 - HAL Laboratory")
-        self.clock = pygame.time.Clock()
         self.running = True
         
-        # Game state
+        # Game state. The other menus are built when they are entered.
         self.state = GameState.MAIN_MENU
         self.main_menu = MainMenu()
-        self.character_select = CharacterSelect()
-        self.stage_select = StageSelect()
+        self.character_select = None
+        self.stage_select = None
+        self.options_menu = None
+        
+        # Stage data and battle setup load on the asset workers; the
+        # stages are warmed up while the player is still in the menus
+        self.loading = None
+        ASSETS.submit(preload_stages)
         
         # Battle state
-        self.current_stage = None
-        self.players = []
-        self.game_time = 0
+        self.characters = None
+        self.player_count = player_count
+        self.items = items  # frames between item rain drops, 0 for none
+        self.hazards = hazards
+        self.humans = 2  # keyboard players; the rest are CPUs in 1P MODE
+        self.cpu_level = cpu_level
+        self.cpus = None
+        self.match = None
+        self.recorder = None
+        self.replay_dir = replay_dir
+        self.netplay = None
+        self.leaving = None  # (peer, frames left, quit) after a netplay match
         self.pause = False
-        
-        # Input handling
+        self.timestep = FixedTimestep(FPS)
+        self.compositor = DirtyRectCompositor()
+        self.frame_dt = 1.0 / FPS
+        self.events = []  # (time, event) pumped since the last frame
+        self.pacer = FramePacer(FPS, self.poll_events, frame_delay)
+        
+        # Profiling (F3 toggles the overlay); off unless asked for
+        self.profiler = FrameProfiler()
+        self.profiler_overlay = None
+        self.trace_path = trace_path
+        if trace_path:
+            self.profiler.start_trace()
+        if profile or trace_path:
+            self.set_profiling(True, show=profile)
+        
+        # Input handling. Gamepads announce themselves with JOYDEVICEADDED
+        # events once the joystick module is up.
+        pygame.joystick.init()
+        self.controls = InputManager(load_bindings())
         self.keys_pressed = set()
         self.keys_just_pressed = set()
         
+    def poll_events(self):
+        now = time.perf_counter()
+        for event in pygame.event.get():
+            self.events.append((now, event))
+    
     def handle_events(self):
         self.keys_just_pressed.clear()
-        
-        for event in pygame.event.get():
+        self.poll_events()
+        events, self.events = self.events, []
+        
+        for when, event in events:
+            self.controls.feed(event, when)
+            if self.state == GameState.OPTIONS and self.options_menu.capturing:
+                if self.options_menu.capture(event):
+                    continue
             if event.type == pygame.QUIT:
                 self.running = False
             elif event.type == pygame.KEYDOWN:
@@ -772,8 +734,11 @@ class SmashBros64Engine:
                 self.keys_pressed.add(event.key)
                 
                 # Global controls
-                if event.key == pygame.K_ESCAPE:
+                if event.key == pygame.K_F3:
+                    self.set_profiling(self.profiler_overlay is None)
+                elif event.key == pygame.K_ESCAPE:
                     if self.state == GameState.BATTLE:
+                        self.leave_netplay(quit=True)
                         self.state = GameState.MAIN_MENU
                     elif self.state != GameState.MAIN_MENU:
                         self.state = GameState.MAIN_MENU
@@ -781,111 +746,184 @@ class SmashBros64Engine:
             elif event.type == pygame.KEYUP:
                 self.keys_pressed.discard(event.key)
     
+    def set_profiling(self, on, show=True):
+        # Instrumentation stays on while tracing even with the overlay hidden
+        profiler = self.profiler
+        if on and not profiler.enabled:
+            module = sys.modules[__name__]
+            profiler.instrument(self, 'handle_events', 'events')
+            profiler.instrument(self, 'update_battle', 'update')
+            profiler.instrument(Fighter, 'update', 'fighter.update')
+            profiler.instrument(Match, 'check_attack_collisions', 'collisions')
+            profiler.instrument(self.compositor, 'begin', 'stage')
+            profiler.instrument(module, 'animate_stage', 'stage')
+            profiler.instrument(module, 'draw_hazards', 'stage')
+            profiler.instrument(module, 'draw_fighters', 'fighters')
+            profiler.instrument(PARTICLE_SPRITES, 'draw', 'particles')
+            profiler.instrument(ENTITY_SPRITES, 'draw', 'entities')
+            profiler.instrument(self, 'draw_hud', 'hud')
+            profiler.instrument(self.compositor, 'present', 'present')
+        elif not on and profiler.enabled and not profiler.tracing:
+            profiler.uninstrument()
+            profiler.reset()
+        self.profiler_overlay = ProfilerOverlay(profiler, 1000 / FPS) if on and show else None
+        self.compositor.invalidate()
+    
+    def read_player_input(self, player_index, until=None):
+        # Input held as of until (everything pumped by default); presses
+        # released again since the last read still count as held
+        return self.controls.sample(player_index, until)
+    
     def update(self):
+        ASSETS.pump()
+        if self.leaving:
+            self.linger_netplay()
         if self.state == GameState.MAIN_MENU:
             selection = self.main_menu.update(self.keys_just_pressed)
             if selection is not None:
-                if selection == 1:  # VS MODE
+                if selection in (0, 1):  # 1P MODE, VS MODE
+                    self.humans = selection + 1
                     self.state = GameState.CHARACTER_SELECT
-                    self.character_select = CharacterSelect()
+                    self.character_select = CharacterSelect(self.humans)
+                elif selection == 2:  # OPTIONS
+                    self.state = GameState.OPTIONS
+                    self.options_menu = OptionsMenu(self.controls)
+        
+        elif self.state == GameState.OPTIONS:
+            self.options_menu.update(self.keys_just_pressed)
         
         elif self.state == GameState.CHARACTER_SELECT:
             characters = self.character_select.update(self.keys_just_pressed)
             if characters:
-                # Create fighters
-                char1_data = CHARACTER_ROSTER[characters[0]]
-                char2_data = CHARACTER_ROSTER[characters[1]]
-                self.players = [
-                    Fighter(char1_data, 400, 300, 1),
-                    Fighter(char2_data, 600, 300, 2)
-                ]
+                # Slots beyond the keyboard players are filled with
+                # training partners (CPUs in 1P MODE), cycling through
+                # the roster
+                roster = list(CHARACTER_ROSTER)
+                extra = [roster[(roster.index(characters[-1]) + i) % len(roster)]
+                         for i in range(1, self.player_count - len(characters) + 1)]
+                self.characters = list(characters) + extra
+                ASSETS.pin('battle', [('fighter', key) for key in self.characters])
                 self.state = GameState.STAGE_SELECT
                 self.stage_select = StageSelect()
         
         elif self.state == GameState.STAGE_SELECT:
             stage_id = self.stage_select.update(self.keys_just_pressed)
             if stage_id:
-                self.current_stage = STAGES[stage_id]
-                # Position players at spawn points
-                for i, player in enumerate(self.players):
-                    spawn = self.current_stage.spawn_points[i]
-                    player.x = spawn[0]
-                    player.y = spawn[1]
+                cpu_levels = None
+                if self.humans == 1:
+                    cpu_levels = {i: self.cpu_level for i in range(1, len(self.characters))}
+                self.loading = ASSETS.submit(load_battle, stage_id, self.characters,
+                                             self.screen.get_size(), self.items, self.hazards,
+                                             cpu_levels)
+                ASSETS.pin('battle', [('stage', stage_id)] + [('fighter', key) for key in self.characters])
+                for key in self.characters:
+                    fighter_atlas(key)
+                self.state = GameState.LOADING
+        
+        elif self.state == GameState.LOADING:
+            # Waits for the fighters' atlases as well as the match
+            atlases = [fighter_atlas(key) for key in self.characters]
+            if self.loading.done() and None not in atlases:
+                match, layer, cpus = self.loading.result()
+                self.loading = None
+                STAGE_LAYERS.put(match.stage, self.screen.get_size(), match.scenery, layer)
+                self.match = match
+                self.cpus = cpus
+                self.controls.flush()
+                if self.replay_dir:
+                    self.recorder = ReplayRecorder(self.match)
+                self.timestep.reset()
                 self.state = GameState.BATTLE
-                self.game_time = 0
         
         elif self.state == GameState.BATTLE:
             if not self.pause:
                 self.update_battle()
-                self.game_time += 1
     
-    def update_battle(self):
-        # Player 1 controls
-        p1 = self.players[0]
-        if pygame.K_a in self.keys_pressed:
-            p1.move('left')
-        elif pygame.K_d in self.keys_pressed:
-            p1.move('right')
+    def start_netplay(self, stage_id, characters, seed, local_player, local_port, remote_addr,
+                      input_delay=0):
+        # Skip the menus and go straight into a rollback battle. Both
+        # machines must be started with the same stage, characters and seed.
+        self.match = Match(STAGES[stage_id], characters, seed=seed, items=self.items,
+                           hazards=self.hazards)
+        self.cpus = None
+        if self.leaving:
+            self.leaving[0].close()
+            self.leaving = None
+        ASSETS.pin('battle', [('stage', stage_id)] + [('fighter', key) for key in characters])
+        session = RollbackSession(self.match, [local_player], input_delay=input_delay)
+        self.netplay = UdpPeer(session, local_port, remote_addr, bind_host="0.0.0.0")
+        self.timestep.reset()
+        self.state = GameState.BATTLE
+    
+    def update_netplay(self):
+        # The local keyboard always uses the P1 layout
+        session = self.netplay.session
+        self.netplay.poll()
+        if self.netplay.remote_quit:
+            self.leave_netplay()
+            self.state = GameState.MAIN_MENU
+            return
+        for _ in range(self.timestep.advance(self.frame_dt)):
+            if session.can_advance():
+                session.add_local_input(self.read_player_input(0))
+            session.advance()
+        self.netplay.send()
+        # A KO on a predicted frame may still be rolled back; only one
+        # reached with every input confirmed ends the match
+        if session.finished():
+            self.leave_netplay()
+            self.state = GameState.RESULTS
+
+    def leave_netplay(self, quit=False):
+        # Hand the peer to linger_netplay, so the next local battle doesn't
+        # step its session but the other side still hears from us
+        if self.netplay:
+            self.leaving = (self.netplay, NETPLAY_LINGER_FRAMES, quit)
+            self.netplay = None
+
+    def linger_netplay(self):
+        peer, frames, quit = self.leaving
+        peer.poll()
+        if quit:
+            peer.send_quit()
         else:
-            p1.move('stop')
-        
-        if pygame.K_w in self.keys_just_pressed:
-            p1.jump()
-        
-        if pygame.K_s in self.keys_pressed and p1.y < self.current_stage.ground_y:
-            p1.fast_falling = True
-        
-        if pygame.K_f in self.keys_just_pressed:
-            p1.attack()
-        
-        p1.shield(pygame.K_LSHIFT in self.keys_pressed)
-        
-        # Player 2 controls
-        p2 = self.players[1]
-        if pygame.K_LEFT in self.keys_pressed:
-            p2.move('left')
-        elif pygame.K_RIGHT in self.keys_pressed:
-            p2.move('right')
+            peer.send()
+        if peer.remote_quit or (not quit and peer.delivered()) or frames <= 1:
+            peer.close()
+            self.leaving = None
         else:
-            p2.move('stop')
-        
-        if pygame.K_UP in self.keys_just_pressed:
-            p2.jump()
-        
-        if pygame.K_DOWN in self.keys_pressed and p2.y < self.current_stage.ground_y:
-            p2.fast_falling = True
-        
-        if pygame.K_COMMA in self.keys_just_pressed:
-            p2.attack()
-        
-        p2.shield(pygame.K_RSHIFT in self.keys_pressed)
-        
-        # Update players
-        for player in self.players:
-            player.update(self.current_stage)
-        
-        # Check collisions
-        self.check_attack_collisions()
+            self.leaving = (peer, frames - 1, quit)
+
+    def update_battle(self):
+        if self.netplay:
+            self.update_netplay()
+            return
         
-        # Check for game over
-        for player in self.players:
-            if player.stocks <= 0:
+        # Run however many fixed ticks the last frame's wall time covers.
+        # Each tick reads the input held at its own share of that time.
+        stepper = self.recorder or self.match
+        ticks = self.timestep.advance(self.frame_dt)
+        start, end = self.pacer.previous, self.pacer.sampled
+        for tick in range(ticks):
+            until = start + (end - start) * (tick + 1) / ticks if tick + 1 < ticks else None
+            inputs = [self.read_player_input(i, until) for i in range(len(self.match.players))]
+            if self.cpus:
+                stepper.step(self.cpus.fill(self.match, inputs))
+            else:
+                stepper.step(inputs)
+            if self.match.over:
                 self.state = GameState.RESULTS
+                self.save_replay()
+                break
     
-    def check_attack_collisions(self):
-        for i, attacker in enumerate(self.players):
-            if attacker.state == PlayerState.ATTACKING:
-                for j, defender in enumerate(self.players):
-                    if i != j:
-                        # Simple collision check
-                        hitbox_x = attacker.x + (attacker.width if attacker.facing_right else -60)
-                        if (defender.x < hitbox_x + 60 and
-                            defender.x + defender.width > hitbox_x and
-                            abs(defender.y - attacker.y) < 60):
-                            
-                            knockback_x = 10 * (1 if attacker.facing_right else -1)
-                            knockback_y = -8
-                            defender.take_hit(12, knockback_x, knockback_y)
+    def save_replay(self):
+        if not self.recorder:
+            return
+        replay = self.recorder.finish()
+        self.recorder = None
+        os.makedirs(self.replay_dir, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{replay.stage_id}{REPLAY_EXTENSION}"
+        replay.save(os.path.join(self.replay_dir, name))
     
     def draw(self):
         if self.state == GameState.MAIN_MENU:
@@ -897,79 +935,104 @@ class SmashBros64Engine:
         elif self.state == GameState.STAGE_SELECT:
             self.stage_select.draw(self.screen)
         
+        elif self.state == GameState.OPTIONS:
+            self.options_menu.draw(self.screen)
+        
         elif self.state == GameState.BATTLE:
-            # Draw stage
-            self.current_stage.draw(self.screen)
-            
-            # Draw players
-            for player in self.players:
-                player.draw(self.screen)
-            
-            # Draw HUD
-            self.draw_hud()
+            self.draw_battle()
+            return
         
         elif self.state == GameState.RESULTS:
             self.draw_results()
         
+        elif self.state == GameState.LOADING:
+            self.screen.fill(BLACK)
+            TEXT.blit(self.screen, "LOADING...", 48, WHITE, center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2))
+        
+        if self.profiler_overlay:
+            self.profiler_overlay.draw(self.screen)
+        self.compositor.invalidate()
         pygame.display.flip()
     
-    def draw_hud(self):
-        hud_font = pygame.font.Font(None, 36)
-        stock_font = pygame.font.Font(None, 24)
+    def draw_battle(self):
+        # Only the areas touched last frame are restored from the baked
+        # stage layer, and only what changed is pushed to the display.
+        stage = self.match.stage
+        scenery = self.match.scenery
+        self.compositor.begin(self.screen, STAGE_LAYERS.get(stage, self.screen.get_size(), scenery))
+        
+        # Draw stage
+        dirty = animate_stage(self.screen, stage, scenery)
+        dirty.extend(draw_hazards(self.screen, self.match.hazards))
         
-        # Player 1 HUD
-        p1 = self.players[0]
-        p1_name = hud_font.render(p1.name, True, RED)
-        self.screen.blit(p1_name, (50, 20))
+        # Draw players
+        dirty.extend(draw_fighters(self.screen, self.match))
+        dirty.extend(ENTITY_SPRITES.draw(self.screen, self.match.entities))
+        dirty.extend(PARTICLE_SPRITES.draw(self.screen, self.match.particles))
         
-        # P1 Stocks
-        for i in range(p1.stocks):
-            pygame.draw.circle(self.screen, RED, (60 + i * 25, 60), 8)
+        # Draw HUD
+        dirty.extend(self.draw_hud())
         
-        # Player 2 HUD
-        p2 = self.players[1]
-        p2_name = hud_font.render(p2.name, True, BLUE)
-        self.screen.blit(p2_name, (SCREEN_WIDTH - 200, 20))
+        if self.profiler_overlay:
+            dirty.append(self.profiler_overlay.draw(self.screen))
         
-        # P2 Stocks
-        for i in range(p2.stocks):
-            pygame.draw.circle(self.screen, BLUE, (SCREEN_WIDTH - 150 + i * 25, 60), 8)
+        self.compositor.present(self.screen, dirty)
+    
+    def draw_hud(self):
+        players = self.match.players
+        name_size = 36 if len(players) <= 2 else 28
+        dirty = []
+        for player, color, (name_pos, stock_pos) in zip(players, PLAYER_COLORS, hud_slots(len(players))):
+            # Name
+            name = TEXT.render(player.name, name_size, color)
+            dirty.append(self.screen.blit(name, name_pos))
+            
+            # Stocks
+            for i in range(player.stocks):
+                dirty.append(pygame.draw.circle(self.screen, color, (stock_pos[0] + i * 25, stock_pos[1]), 8))
         
         # Timer
-        minutes = self.game_time // 3600
-        seconds = (self.game_time // 60) % 60
-        timer_text = hud_font.render(f"{minutes:02d}:{seconds:02d}", True, WHITE)
-        timer_rect = timer_text.get_rect(center=(SCREEN_WIDTH//2, 40))
-        self.screen.blit(timer_text, timer_rect)
+        minutes = self.match.game_time // 3600
+        seconds = (self.match.game_time // 60) % 60
+        dirty.append(TEXT.blit_number(self.screen, f"{minutes:02d}:{seconds:02d}", 36, WHITE,
+                                      center=(SCREEN_WIDTH//2, 40)))
+        return dirty
     
     def draw_results(self):
         self.screen.fill(BLACK)
         
         # Determine winner
-        winner = None
-        for player in self.players:
-            if player.stocks > 0:
-                winner = player
-                break
+        winner = self.match.winner()
         
         if winner:
-            result_font = pygame.font.Font(None, 72)
-            winner_text = result_font.render(f"{winner.name} WINS!", True, YELLOW)
+            winner_text = TEXT.render(f"{winner.name} WINS!", 72, YELLOW)
             winner_rect = winner_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2))
             self.screen.blit(winner_text, winner_rect)
         
-        restart_font = pygame.font.Font(None, 32)
-        restart_text = restart_font.render("Press ESC to return to menu", True, WHITE)
+        restart_text = TEXT.render("Press ESC to return to menu", 32, WHITE)
         restart_rect = restart_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2 + 100))
         self.screen.blit(restart_text, restart_rect)
     
     def run(self):
+        profiler = self.profiler
         while self.running:
+            self.frame_dt = self.pacer.wait()
+            profiling = profiler.enabled
+            if profiling:
+                profiler.begin_frame()
             self.handle_events()
             self.update()
             self.draw()
-            self.clock.tick(FPS)
-        
+            self.pacer.presented()
+            if profiling:
+                profiler.end_frame()
+        
+        if profiler.enabled:
+            profiler.print_summary()
+        if self.trace_path:
+            count = profiler.write_trace(self.trace_path)
+            print(f"Wrote {count} trace events to {self.trace_path}")
+        ASSETS.shutdown()
         pygame.quit()
         sys.exit()
 
@@ -983,5 +1046,37 @@ if __name__ == "__main__":
     print("==============================================")
     print("Loading assets and initializing...")
     
-    game = SmashBros64Engine()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--record", metavar="DIR", help="save a replay of every finished battle")
+    parser.add_argument("--players", type=int, choices=range(2, 9), default=2,
+                        help="fighters per battle; players past P2 play on gamepads 3 and up, "
+                             "CPUs in 1P MODE")
+    parser.add_argument("--netplay", nargs=2, metavar=("LOCAL_PORT", "REMOTE_HOST:PORT"),
+                        help="play a rollback VS match against another machine")
+    parser.add_argument("--player", type=int, choices=[1, 2], default=1)
+    parser.add_argument("--stage", choices=sorted(STAGES), default="peachs_castle")
+    parser.add_argument("--characters", nargs=2, choices=sorted(CHARACTER_ROSTER), default=["Mario", "Fox"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--input-delay", type=int, default=0)
+    parser.add_argument("--items", type=int, default=0, metavar="FRAMES",
+                        help="item rain: drop an item every FRAMES frames (2 or so for a party)")
+    parser.add_argument("--no-hazards", dest="hazards", action="store_false",
+                        help="play stages static, without hazards or moving platforms")
+    parser.add_argument("--cpu-level", type=int, choices=sorted(CPU_LEVELS), default=DEFAULT_LEVEL,
+                        help="1P MODE CPU difficulty")
+    parser.add_argument("--frame-delay", default="0", metavar="MS",
+                        help="start each frame MS ms late to sample input closer to the display "
+                             "refresh, or 'auto'")
+    parser.add_argument("--profile", action="store_true", help="time subsystems and show the overlay (F3)")
+    parser.add_argument("--trace", metavar="FILE", help="write a Chrome trace JSON of every frame on exit")
+    args = parser.parse_args()
+    
+    game = SmashBros64Engine(replay_dir=args.record, player_count=args.players,
+                             profile=args.profile, trace_path=args.trace, items=args.items,
+                             hazards=args.hazards, cpu_level=args.cpu_level,
+                             frame_delay=args.frame_delay if args.frame_delay == "auto" else float(args.frame_delay))
+    if args.netplay:
+        host, port = args.netplay[1].rsplit(":", 1)
+        game.start_netplay(args.stage, args.characters, args.seed, args.player - 1,
+                           int(args.netplay[0]), (host, int(port)), args.input_delay)
     game.run()
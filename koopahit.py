@@ -0,0 +1,77 @@
+# ============================================
+# HIT DETECTION - SWEEP AND PRUNE BROADPHASE
+# ============================================
+# Hitboxes (things that deal damage) and hurtboxes (things that can be
+# hit) are registered fresh every frame as axis-aligned boxes. Boxes are
+# sorted on their left edge and swept once along x, so only boxes whose x
+# spans overlap are ever compared. Cost stays close to linear when
+# fighters and projectiles are spread across the stage.
+#
+# Overlap is strict on every edge, matching the original
+# check_attack_collisions test for 60x60 attack boxes.
+
+HITBOX = 0
+HURTBOX = 1
+
+_FAR = float('inf')
+
+class CollisionWorld:
+    def __init__(self):
+        self.boxes = []
+        self.tests = 0  # narrowphase comparisons made by the last query
+
+    def clear(self):
+        self.boxes.clear()
+
+    def add_hitbox(self, left, top, right, bottom, owner, data=None):
+        self.boxes.append((left, top, right, bottom, HITBOX, owner, data))
+
+    def add_hurtbox(self, left, top, right, bottom, owner, data=None):
+        self.boxes.append((left, top, right, bottom, HURTBOX, owner, data))
+
+    def overlaps(self):
+        # Returns (hitbox owner, hurtbox owner, hitbox data, hurtbox data)
+        # for every overlapping pair with different owners, sorted by owner
+        # so results do not depend on the sweep order.
+        self.boxes.sort(key=_left_edge)
+        active = ([], [])
+        # Nearest right edge in each active group, so the common case of
+        # nothing to drop costs one comparison
+        ends = [_FAR, _FAR]
+        pairs = []
+        tests = 0
+        for box in self.boxes:
+            left = box[0]
+            kind = box[4]
+            # Drop boxes that end before this one starts from the group it
+            # is compared against. The other group is only pruned when it
+            # is next compared against, so a crowd of projectiles between
+            # two fighters is filtered a handful of times, not per box.
+            other_kind = 1 - kind
+            group = active[other_kind]
+            if ends[other_kind] <= left:
+                group[:] = [b for b in group if b[2] > left]
+                ends[other_kind] = min(b[2] for b in group) if group else _FAR
+            top = box[1]
+            bottom = box[3]
+            owner = box[5]
+            for other in group:
+                tests += 1
+                if other[5] == owner or other[1] >= bottom or other[3] <= top:
+                    continue
+                if kind == HITBOX:
+                    pairs.append((owner, other[5], box[6], other[6]))
+                else:
+                    pairs.append((other[5], owner, other[6], box[6]))
+            active[kind].append(box)
+            if box[2] < ends[kind]:
+                ends[kind] = box[2]
+        self.tests = tests
+        pairs.sort(key=_pair_order)
+        return pairs
+
+def _left_edge(box):
+    return box[0]
+
+def _pair_order(pair):
+    return (pair[0], pair[1])
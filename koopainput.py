@@ -0,0 +1,316 @@
+import json
+import os
+import sys
+import time
+from collections import deque
+
+import pygame
+
+from koopasim import INPUT_LEFT, INPUT_RIGHT, INPUT_JUMP, INPUT_DOWN, INPUT_ATTACK, INPUT_SHIELD
+
+# ============================================
+# INPUT DEVICES AND BINDINGS
+# ============================================
+# Keyboards and gamepads drive player slots through bindings: for every
+# slot, each INPUT_* bit has a list of controls, any of which holds it.
+# A control is a tuple:
+#
+#   ('key', keycode)
+#   ('button', pad, button)
+#   ('axis', pad, axis, direction)    direction -1 or 1
+#   ('hat', pad, hat, x, y)           one of x and y is 0
+#
+# where pad numbers gamepads in the order pygame found them.
+#
+# Events are stamped with the time they were pumped and queued, and
+# sample() applies the ones up to a given moment, so ticks simulated back
+# to back in one frame each see the input held at their own moment. A
+# bit pressed and released between two samples still reads as held for
+# the next one, so quick taps are never lost.
+
+INPUT_BITS = (INPUT_LEFT, INPUT_RIGHT, INPUT_JUMP, INPUT_DOWN, INPUT_ATTACK, INPUT_SHIELD)
+INPUT_NAMES = ('left', 'right', 'jump', 'down', 'attack', 'shield')
+MAX_PLAYERS = 8
+
+# Stick travel that holds an axis control, and the travel it must fall
+# back under to let go, so a stick resting near the edge does not chatter
+AXIS_PRESS = 0.5
+AXIS_RELEASE = 0.3
+
+# Keyboard layouts of P1 and P2. Every slot also takes the gamepad of its
+# own number.
+DEFAULT_KEYS = [
+    {INPUT_LEFT: pygame.K_a, INPUT_RIGHT: pygame.K_d, INPUT_JUMP: pygame.K_w,
+     INPUT_DOWN: pygame.K_s, INPUT_ATTACK: pygame.K_f, INPUT_SHIELD: pygame.K_LSHIFT},
+    {INPUT_LEFT: pygame.K_LEFT, INPUT_RIGHT: pygame.K_RIGHT, INPUT_JUMP: pygame.K_UP,
+     INPUT_DOWN: pygame.K_DOWN, INPUT_ATTACK: pygame.K_COMMA, INPUT_SHIELD: pygame.K_RSHIFT},
+]
+
+def pad_controls(pad):
+    # Stick or d-pad to move, face buttons to attack and jump, shoulders
+    # to shield. Hat y is 1 for up.
+    return {
+        INPUT_LEFT: [('axis', pad, 0, -1), ('hat', pad, 0, -1, 0)],
+        INPUT_RIGHT: [('axis', pad, 0, 1), ('hat', pad, 0, 1, 0)],
+        INPUT_JUMP: [('button', pad, 1), ('button', pad, 3), ('hat', pad, 0, 0, 1)],
+        INPUT_DOWN: [('axis', pad, 1, 1), ('hat', pad, 0, 0, -1)],
+        INPUT_ATTACK: [('button', pad, 0), ('button', pad, 2)],
+        INPUT_SHIELD: [('button', pad, 4), ('button', pad, 5)],
+    }
+
+def default_bindings(players=MAX_PLAYERS):
+    bindings = []
+    for i in range(players):
+        controls = pad_controls(i)
+        if i < len(DEFAULT_KEYS):
+            for bit, key in DEFAULT_KEYS[i].items():
+                controls[bit].insert(0, ('key', key))
+        bindings.append(controls)
+    return bindings
+
+def describe(control):
+    # Short name for the options screen
+    kind = control[0]
+    if kind == 'key':
+        return pygame.key.name(control[1]).upper() or f"KEY {control[1]}"
+    pad = f"PAD{control[1] + 1}"
+    if kind == 'button':
+        return f"{pad} B{control[2]}"
+    if kind == 'axis':
+        return f"{pad} AXIS{control[2]}{'+' if control[3] > 0 else '-'}"
+    x, y = control[3:]
+    return f"{pad} {'LEFT' if x < 0 else 'RIGHT' if x > 0 else 'UP' if y > 0 else 'DOWN'}"
+
+# ---- Saved bindings ----
+
+BINDINGS_PATH_ENV = "KOOPA_BINDINGS"
+BINDINGS_VERSION = 1
+_CONTROL_SIZES = {'key': 2, 'button': 3, 'axis': 4, 'hat': 5}
+
+def bindings_path():
+    # $KOOPA_BINDINGS, or bindings.json in ~/.koopaengine
+    return os.environ.get(BINDINGS_PATH_ENV) or os.path.join(os.path.expanduser("~"), ".koopaengine",
+                                                             "bindings.json")
+
+def _control(items):
+    control = tuple(items)
+    if (not control or _CONTROL_SIZES.get(control[0]) != len(control) or
+            not all(isinstance(value, int) for value in control[1:])):
+        raise ValueError(f"bad control {items!r}")
+    return control
+
+def load_bindings(path=None):
+    # The saved bindings, or the defaults when none were saved or the file
+    # does not parse. Slots the file does not cover keep their defaults.
+    path = path or bindings_path()
+    bindings = default_bindings()
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        if data['version'] != BINDINGS_VERSION:
+            raise ValueError(f"unknown version {data['version']!r}")
+        for i, player in enumerate(data['players'][:MAX_PLAYERS]):
+            bindings[i] = {bit: [_control(c) for c in player[name]] for bit, name in zip(INPUT_BITS, INPUT_NAMES)}
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError, TypeError) as error:
+        print(f"ignoring saved bindings in {path}: {error}", file=sys.stderr)
+        return default_bindings()
+    return bindings
+
+def save_bindings(bindings, path=None):
+    # Written beside the target and renamed into place, as the content cache is
+    path = path or bindings_path()
+    data = {
+        'version': BINDINGS_VERSION,
+        'players': [{name: [list(c) for c in controls[bit]] for bit, name in zip(INPUT_BITS, INPUT_NAMES)}
+                    for controls in bindings],
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+# ---- Live input ----
+
+class InputManager:
+    def __init__(self, bindings):
+        self.down = set()     # controls held as of the last applied event
+        self.queued = set()   # controls held once every queued event applies
+        self.pending = deque()  # (time, control, down), oldest first
+        self.pads = {}        # joystick instance id -> (pad number, Joystick)
+        self.bindings = []
+        self.held = []
+        self.tapped = []
+        self.set_bindings(bindings)
+
+    def set_bindings(self, bindings):
+        self.bindings = bindings
+        self.users = {}  # control -> [(player, bit)]
+        for player, controls in enumerate(bindings):
+            for bit, bound in controls.items():
+                for control in bound:
+                    self.users.setdefault(control, []).append((player, bit))
+        self.held = [self.bits(player) for player in range(len(bindings))]
+        self.tapped = [0] * len(bindings)
+
+    def bits(self, player):
+        # Bits the player's held controls hold
+        bits = 0
+        for bit, bound in self.bindings[player].items():
+            if any(control in self.down for control in bound):
+                bits |= bit
+        return bits
+
+    # ---- events in ----
+
+    def feed(self, event, when):
+        kind = event.type
+        if kind in (pygame.KEYDOWN, pygame.KEYUP):
+            self.queue(when, ('key', event.key), kind == pygame.KEYDOWN)
+        elif kind in (pygame.JOYBUTTONDOWN, pygame.JOYBUTTONUP):
+            pad = self.pad(event.instance_id)
+            if pad is not None:
+                self.queue(when, ('button', pad, event.button), kind == pygame.JOYBUTTONDOWN)
+        elif kind == pygame.JOYAXISMOTION:
+            pad = self.pad(event.instance_id)
+            if pad is not None:
+                for direction in (-1, 1):
+                    control = ('axis', pad, event.axis, direction)
+                    travel = event.value * direction
+                    self.queue(when, control, travel > (AXIS_RELEASE if control in self.queued else AXIS_PRESS))
+        elif kind == pygame.JOYHATMOTION:
+            pad = self.pad(event.instance_id)
+            if pad is not None:
+                x, y = event.value
+                for dx, dy in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+                    self.queue(when, ('hat', pad, event.hat, dx, dy), (dx and x == dx) or (dy and y == dy))
+        elif kind == pygame.JOYDEVICEADDED:
+            joystick = pygame.joystick.Joystick(event.device_index)
+            self.pads[joystick.get_instance_id()] = (event.device_index, joystick)
+        elif kind == pygame.JOYDEVICEREMOVED:
+            pad = self.pads.pop(event.instance_id, (None,))[0]
+            for control in list(self.queued):
+                if control[0] != 'key' and control[1] == pad:
+                    self.queue(when, control, False)
+
+    def pad(self, instance_id):
+        return self.pads.get(instance_id, (None,))[0]
+
+    def queue(self, when, control, down):
+        # Only changes are queued; key repeat and small stick motion are not
+        if (control in self.queued) == bool(down):
+            return
+        if down:
+            self.queued.add(control)
+        else:
+            self.queued.discard(control)
+        self.pending.append((when, control, bool(down)))
+
+    def control_for(self, event):
+        # The control an event would bind on the options screen, if any
+        kind = event.type
+        if kind == pygame.KEYDOWN:
+            return ('key', event.key)
+        pad = self.pad(getattr(event, 'instance_id', None))
+        if pad is None:
+            return None
+        if kind == pygame.JOYBUTTONDOWN:
+            return ('button', pad, event.button)
+        if kind == pygame.JOYAXISMOTION and abs(event.value) > AXIS_PRESS:
+            return ('axis', pad, event.axis, 1 if event.value > 0 else -1)
+        if kind == pygame.JOYHATMOTION and event.value != (0, 0):
+            x, y = event.value
+            return ('hat', pad, event.hat, x, 0) if x else ('hat', pad, event.hat, 0, y)
+        return None
+
+    # ---- bits out ----
+
+    def sample(self, player, until=None):
+        # The player's bits for the next tick: applies events stamped up to
+        # until (all of them by default) and returns what is held plus
+        # anything pressed since the player was last sampled
+        pending = self.pending
+        while pending and (until is None or pending[0][0] <= until):
+            when, control, down = pending.popleft()
+            if down:
+                self.down.add(control)
+            else:
+                self.down.discard(control)
+            for user, bit in self.users.get(control, ()):
+                bits = self.bits(user)
+                self.tapped[user] |= bits & ~self.held[user]
+                self.held[user] = bits
+        if player >= len(self.held):
+            return 0
+        bits = self.held[player] | self.tapped[player]
+        self.tapped[player] = 0
+        return bits
+
+    def flush(self):
+        # Apply everything queued and forget earlier taps, e.g. so menu
+        # key presses do not reach a battle's first tick
+        for player in range(len(self.held)):
+            self.sample(player)
+
+# ============================================
+# FRAME PACING
+# ============================================
+# FramePacer keeps the main loop on a fixed 1/fps cadence and pumps
+# events while it waits, which is what gives them millisecond timestamps.
+# By default a frame starts, and samples input, right at its refresh
+# boundary and then idles once presented. With a frame delay it idles
+# first and starts late instead, just early enough to present before the
+# next refresh, so what the frame shows is that much closer to the input
+# it sampled. "auto" picks the latest start the recent frames' work
+# allows.
+
+POLL_INTERVAL = 0.001        # seconds between event pumps while waiting
+FRAME_DELAY_MARGIN = 0.002   # time auto frame delay leaves to spare
+WORK_DECAY = 0.05            # how fast the work estimate falls back after a slow frame
+
+class FramePacer:
+    def __init__(self, fps, poll, frame_delay=0):
+        # poll() pumps events; frame_delay is in milliseconds or "auto"
+        self.period = 1.0 / fps
+        self.poll = poll
+        self.frame_delay = frame_delay
+        self.work = 0.0  # seconds from sampling to presenting, recent worst
+        now = time.perf_counter()
+        self.boundary = now  # when the next frame's refresh interval starts
+        self.previous = now  # when the last two frames sampled input
+        self.sampled = now
+
+    def delay(self):
+        if self.frame_delay == "auto":
+            return max(0.0, self.period - self.work - FRAME_DELAY_MARGIN)
+        return min(self.frame_delay / 1000, self.period)
+
+    def wait(self):
+        # Call before sampling input. Returns the seconds since the last
+        # frame sampled, for the fixed timestep.
+        target = self.boundary + self.delay()
+        while True:
+            self.poll()
+            remaining = target - time.perf_counter()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, POLL_INTERVAL))
+        now = time.perf_counter()
+        if now - target > self.period:
+            # Fell behind: restart the cadence rather than rush to catch up
+            self.boundary = now - self.delay()
+        self.boundary += self.period
+        self.previous = self.sampled
+        self.sampled = now
+        return now - self.previous
+
+    def presented(self):
+        # Call once the frame is on screen
+        work = time.perf_counter() - self.sampled
+        self.work = work if work > self.work else self.work + (work - self.work) * WORK_DECAY
@@ -0,0 +1,142 @@
+import json
+import sys
+from array import array
+from time import perf_counter
+
+# ============================================
+# FRAME PROFILER
+# ============================================
+# Opt-in timing of the main loop. Nothing is timed until instrument() is
+# called: it swaps the named methods and functions for timed wrappers and
+# uninstrument() puts the originals back, so a game that never turns the
+# profiler on runs exactly the code it always did.
+#
+# Each labelled section accumulates its time over a frame; end_frame()
+# files the per-frame totals into fixed-size ring buffers that feed the
+# rolling percentiles. Sections are inclusive, so "update" also contains
+# "fighter.update" and "collisions". With tracing on every call is kept as
+# a Chrome trace event (load the file in chrome://tracing or Perfetto).
+
+DEFAULT_HISTORY = 600       # frames kept for percentiles, ten seconds at 60fps
+MAX_TRACE_EVENTS = 2000000  # tracing stops quietly past this
+PERCENTILES = (50, 95, 99)
+FRAME = "frame"
+
+class FrameProfiler:
+    def __init__(self, history=DEFAULT_HISTORY):
+        self.history = history
+        self.enabled = False
+        self.patches = []
+        self.current = {}       # label -> seconds so far this frame
+        self.rings = {}         # label -> array of ms per frame
+        self.frames = 0         # frames recorded since reset
+        self.frame_start = 0.0
+        self.tracing = False
+        self.trace = []
+        self.origin = perf_counter()
+
+    # ---- instrumentation ----
+
+    def instrument(self, owner, attr, label):
+        # Replace owner.attr with a timed wrapper. owner may be a class, a
+        # module or an instance; instance patches shadow the class method.
+        had_own = attr in vars(owner)
+        original = vars(owner).get(attr)
+        target = getattr(owner, attr)
+        record = self.record
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return target(*args, **kwargs)
+            finally:
+                record(label, start, perf_counter())
+        timed.__wrapped__ = target
+        setattr(owner, attr, timed)
+        self.patches.append((owner, attr, original, had_own))
+        self.enabled = True
+
+    def uninstrument(self):
+        while self.patches:
+            owner, attr, original, had_own = self.patches.pop()
+            if had_own:
+                setattr(owner, attr, original)
+            else:
+                delattr(owner, attr)
+        self.enabled = False
+        self.current.clear()
+
+    # ---- recording ----
+
+    def record(self, label, start, end):
+        self.current[label] = self.current.get(label, 0.0) + (end - start)
+        if self.tracing and len(self.trace) < MAX_TRACE_EVENTS:
+            self.trace.append((label, start, end))
+
+    def begin_frame(self):
+        self.frame_start = perf_counter()
+
+    def end_frame(self):
+        end = perf_counter()
+        self.record(FRAME, self.frame_start, end)
+        slot = self.frames % self.history
+        for label, seconds in self.current.items():
+            ring = self.rings.get(label)
+            if ring is None:
+                # A section first seen now read zero on earlier frames
+                ring = self.rings[label] = array('d', bytes(8 * self.history))
+            ring[slot] = seconds * 1000
+        for label, ring in self.rings.items():
+            if label not in self.current:
+                ring[slot] = 0.0
+        self.current.clear()
+        self.frames += 1
+
+    def reset(self):
+        self.current.clear()
+        self.rings.clear()
+        self.frames = 0
+        self.trace.clear()
+
+    # ---- reading ----
+
+    def last(self, label=FRAME):
+        # ms spent in label on the most recent finished frame
+        ring = self.rings.get(label)
+        if ring is None or not self.frames:
+            return 0.0
+        return ring[(self.frames - 1) % self.history]
+
+    def percentiles(self, label=FRAME, points=PERCENTILES):
+        ring = self.rings.get(label)
+        count = min(self.frames, self.history)
+        if ring is None or not count:
+            return tuple(0.0 for p in points)
+        ordered = sorted(ring[:count])
+        return tuple(ordered[min(count - 1, count * p // 100)] for p in points)
+
+    def summary(self):
+        # label -> (p50, p95, p99) ms, frame first, then slowest p95 first
+        labels = sorted(self.rings, key=lambda label: (label != FRAME, -self.percentiles(label)[1]))
+        return {label: self.percentiles(label) for label in labels}
+
+    # ---- Chrome trace ----
+
+    def start_trace(self):
+        self.trace.clear()
+        self.tracing = True
+
+    def write_trace(self, path):
+        # Complete ("X") events with microsecond timestamps
+        origin = self.origin
+        events = [{'name': label, 'ph': 'X', 'pid': 1, 'tid': 1,
+                   'ts': round((start - origin) * 1e6, 3), 'dur': round((end - start) * 1e6, 3)}
+                  for label, start, end in self.trace]
+        with open(path, "w") as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        return len(events)
+
+    def print_summary(self, file=sys.stdout):
+        print(f"{'section':<16}{'p50':>8}{'p95':>8}{'p99':>8}  (ms over {min(self.frames, self.history)} frames)",
+              file=file)
+        for label, (p50, p95, p99) in self.summary().items():
+            print(f"{label:<16}{p50:8.2f}{p95:8.2f}{p99:8.2f}", file=file)
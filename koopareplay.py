@@ -0,0 +1,258 @@
+import struct
+import sys
+import time
+import zlib
+from array import array
+
+from koopasim import STAGES, CHARACTER_ROSTER, Match
+
+# ============================================
+# REPLAYS
+# ============================================
+# A replay is everything needed to re-simulate a match bit-for-bit:
+# stage id, roster keys, RNG seed, item rain rate, whether stage hazards
+# were on and one input byte per player per frame.
+# On disk the inputs are run-length encoded, since held buttons produce
+# long runs of identical frames.
+#
+# File layout (little endian):
+#   magic 'KRPL', u16 version, u32 seed, u32 frame count, u32 final state crc
+#   u8-length stage id, u8 player count, u8-length roster key per player
+#   varint frames between item drops (0 for none; version 2 on)
+#   u8 stage hazards on (version 3 on; earlier stages had none)
+#   per player: varint run count, then (u8 input, varint length) per run
+
+REPLAY_MAGIC = b"KRPL"
+REPLAY_VERSION = 3
+REPLAY_EXTENSION = ".krpl"
+
+class ReplayError(Exception):
+    pass
+
+def state_digest(match):
+    # Cheap fingerprint of the simulation state, stored with the replay so
+    # playback can detect physics changes.
+    return zlib.crc32(repr(match.get_state()).encode())
+
+def write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def read_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise ReplayError("truncated replay")
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def encode_runs(frames):
+    runs = []
+    for value in frames:
+        if runs and runs[-1][0] == value:
+            runs[-1][1] += 1
+        else:
+            runs.append([value, 1])
+    return runs
+
+class Replay:
+    def __init__(self, stage_id, characters, seed, inputs=None, digest=None, items=0, hazards=True):
+        self.stage_id = stage_id
+        self.characters = list(characters)
+        self.seed = seed
+        self.items = items
+        self.hazards = hazards
+        # One array of input bytes per player, indexed by frame
+        self.inputs = inputs if inputs is not None else [array('B') for c in self.characters]
+        self.digest = digest
+
+    @property
+    def frame_count(self):
+        return len(self.inputs[0]) if self.inputs else 0
+
+    def inputs_at(self, frame):
+        return [player_inputs[frame] for player_inputs in self.inputs]
+
+    def new_match(self):
+        if self.stage_id not in STAGES:
+            raise ReplayError(f"unknown stage {self.stage_id!r}")
+        for key in self.characters:
+            if key not in CHARACTER_ROSTER:
+                raise ReplayError(f"unknown character {key!r}")
+        return Match(STAGES[self.stage_id], self.characters, seed=self.seed, items=self.items,
+                     hazards=self.hazards)
+
+    def to_bytes(self):
+        if not 0 <= self.seed < 1 << 32:
+            raise ReplayError("replay seeds must fit in 32 bits")
+        out = bytearray(struct.pack("<4sHIII", REPLAY_MAGIC, REPLAY_VERSION, self.seed,
+                                    self.frame_count, self.digest or 0))
+        stage = self.stage_id.encode()
+        out.append(len(stage))
+        out += stage
+        out.append(len(self.characters))
+        for key in self.characters:
+            key = key.encode()
+            out.append(len(key))
+            out += key
+        write_varint(out, self.items)
+        out.append(self.hazards)
+        for player_inputs in self.inputs:
+            runs = encode_runs(player_inputs)
+            write_varint(out, len(runs))
+            for value, length in runs:
+                out.append(value)
+                write_varint(out, length)
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, data):
+        header = struct.calcsize("<4sHIII")
+        if len(data) < header:
+            raise ReplayError("truncated replay")
+        magic, version, seed, frame_count, digest = struct.unpack_from("<4sHIII", data)
+        if magic != REPLAY_MAGIC:
+            raise ReplayError("not a replay file")
+        if not 1 <= version <= REPLAY_VERSION:
+            raise ReplayError(f"unsupported replay version {version}")
+
+        try:
+            pos = header
+            length = data[pos]
+            stage_id = data[pos + 1:pos + 1 + length].decode()
+            pos += 1 + length
+            count = data[pos]
+            pos += 1
+            characters = []
+            for i in range(count):
+                length = data[pos]
+                characters.append(data[pos + 1:pos + 1 + length].decode())
+                pos += 1 + length
+            items = 0
+            if version >= 2:
+                items, pos = read_varint(data, pos)
+            hazards = False
+            if version >= 3:
+                hazards = bool(data[pos])
+                pos += 1
+
+            inputs = []
+            for i in range(count):
+                player_inputs = array('B')
+                runs, pos = read_varint(data, pos)
+                for r in range(runs):
+                    value = data[pos]
+                    length, pos = read_varint(data, pos + 1)
+                    player_inputs.extend([value] * length)
+                if len(player_inputs) != frame_count:
+                    raise ReplayError("input stream length does not match header")
+                inputs.append(player_inputs)
+        except (IndexError, UnicodeDecodeError):
+            raise ReplayError("truncated replay")
+        return cls(stage_id, characters, seed, inputs, digest, items, hazards)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read())
+
+class ReplayRecorder:
+    # Wraps a live match: call step() instead of match.step()
+    def __init__(self, match):
+        self.match = match
+        self.replay = Replay(match.stage.stage_id, match.characters, match.seed, items=match.items,
+                             hazards=match.hazards.enabled)
+
+    def step(self, inputs):
+        for player_inputs, bits in zip(self.replay.inputs, inputs):
+            player_inputs.append(bits)
+        self.match.step(inputs)
+
+    def finish(self):
+        self.replay.digest = state_digest(self.match)
+        return self.replay
+
+class ReplayPlayer:
+    # Headless playback with seeking. A snapshot is kept every
+    # snapshot_interval frames so a seek only re-simulates the gap.
+    def __init__(self, replay, snapshot_interval=600):
+        self.replay = replay
+        self.snapshot_interval = snapshot_interval
+        self.match = replay.new_match()
+        self.snapshots = {0: self.match.save_state()}
+
+    @property
+    def frame(self):
+        return self.match.game_time
+
+    def step(self):
+        self.match.step(self.replay.inputs_at(self.match.game_time))
+        frame = self.match.game_time
+        if frame % self.snapshot_interval == 0 and frame not in self.snapshots:
+            self.snapshots[frame] = self.match.save_state()
+
+    def run_to(self, frame):
+        frame = min(frame, self.replay.frame_count)
+        while self.match.game_time < frame:
+            self.step()
+
+    def run(self):
+        self.run_to(self.replay.frame_count)
+        return self.match
+
+    def seek(self, frame):
+        frame = max(0, min(frame, self.replay.frame_count))
+        # Snapshots only exist for frames already simulated
+        base = frame - frame % self.snapshot_interval
+        while base not in self.snapshots:
+            base -= self.snapshot_interval
+        if frame < self.match.game_time or base > self.match.game_time:
+            self.match.load_state(self.snapshots[base])
+        self.run_to(frame)
+
+    def verify(self):
+        self.run()
+        return self.replay.digest is None or state_digest(self.match) == self.replay.digest
+
+# ============================================
+# COMMAND LINE
+# ============================================
+
+def main(argv=None):
+    # python -m koopareplay FILE... : re-simulate replays and check the
+    # final state against the digest recorded with each one
+    paths = sys.argv[1:] if argv is None else argv
+    if not paths:
+        print("usage: python -m koopareplay REPLAY" + REPLAY_EXTENSION + " ...")
+        return 2
+
+    failures = 0
+    for path in paths:
+        try:
+            player = ReplayPlayer(Replay.load(path))
+        except (OSError, ReplayError) as e:
+            print(f"{path}: ERROR {e}")
+            failures += 1
+            continue
+        start = time.perf_counter()
+        ok = player.verify()
+        elapsed = time.perf_counter() - start
+        fps = player.frame / elapsed if elapsed > 0 else 0
+        print(f"{path}: {'OK' if ok else 'MISMATCH'} {player.frame} frames ({fps:.0f} fps)")
+        if not ok:
+            failures += 1
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,292 @@
+import argparse
+import random
+import socket
+import struct
+import sys
+import time
+from collections import deque
+
+from koopasim import STAGES, Match, FPS
+from koopareplay import state_digest
+
+# ============================================
+# ROLLBACK NETCODE
+# ============================================
+# Both peers run the full simulation. Local input is applied immediately
+# (optionally after a fixed input delay); remote input that has not
+# arrived yet is predicted by repeating the last one received. When the
+# real remote input turns out different, the match is restored to the
+# snapshot taken before that frame and re-simulated up to the present.
+# Snapshots live in a ring buffer sized to the rollback window.
+# A KO that ends the match only counts once every input leading up to it
+# is confirmed; until then a rollback may still undo it.
+
+DEFAULT_MAX_ROLLBACK = 8
+
+class RollbackSession:
+    def __init__(self, match, local_players, max_rollback=DEFAULT_MAX_ROLLBACK, input_delay=0):
+        self.match = match
+        self.local_players = set(local_players)
+        self.max_rollback = max_rollback
+        self.input_delay = input_delay
+        count = len(match.players)
+
+        # frame -> bits, per player. Remote entries are only ever added in
+        # frame order so "confirmed" is a single watermark per player.
+        self.inputs = [{} for i in range(count)]
+        self.confirmed = [-1] * count
+        self.used = {}  # frame -> inputs the simulation actually stepped with
+
+        self.ring_size = max_rollback + 2
+        self.snapshots = [None] * self.ring_size
+        self.rollback_to = None
+
+        # Stats
+        self.rollbacks = 0
+        self.resimulated = 0
+        self.last_advance_ms = 0.0
+        self.worst_advance_ms = 0.0
+
+        # Frames before the input delay elapses have no local input
+        for p in self.local_players:
+            for frame in range(input_delay):
+                self.inputs[p][frame] = 0
+            self.confirmed[p] = input_delay - 1
+
+    @property
+    def frame(self):
+        return self.match.game_time
+
+    def add_local_input(self, bits):
+        # Returns the frame the input was scheduled for
+        frame = self.frame + self.input_delay
+        for p in self.local_players:
+            if frame > self.confirmed[p]:
+                self.inputs[p][frame] = bits
+                self.confirmed[p] = frame
+        return frame
+
+    def add_remote_input(self, player, frame, bits):
+        if frame != self.confirmed[player] + 1:
+            return False
+        self.inputs[player][frame] = bits
+        self.confirmed[player] = frame
+        used = self.used.get(frame)
+        if used is not None and used[player] != bits:
+            if self.rollback_to is None or frame < self.rollback_to:
+                self.rollback_to = frame
+        return True
+
+    def confirmed_frame(self):
+        # Last frame for which every player's input is known
+        return min(self.confirmed)
+
+    def can_advance(self):
+        # Stall rather than predict further than we can roll back
+        return self.frame - self.confirmed_frame() <= self.max_rollback
+
+    def finished(self):
+        # The match ended on confirmed inputs, so both peers agree on it
+        return self.match.over and self.rollback_to is None and self.confirmed_frame() >= self.frame - 1
+
+    def predicted_input(self, player, frame):
+        bits = self.inputs[player].get(frame)
+        if bits is None:
+            last = self.confirmed[player]
+            bits = self.inputs[player].get(last, 0)
+        return bits
+
+    def simulate_frame(self):
+        frame = self.match.game_time
+        self.snapshots[frame % self.ring_size] = self.match.save_state()
+        inputs = [self.predicted_input(p, frame) for p in range(len(self.match.players))]
+        self.used[frame] = inputs
+        self.match.step(inputs)
+
+    def advance(self):
+        # One display frame: fix up any misprediction, then step once.
+        # A (possibly predicted) KO holds the match on the frame it ended.
+        start = time.perf_counter()
+        self.settle()
+
+        advanced = not self.match.over and self.can_advance()
+        if advanced:
+            self.simulate_frame()
+        self.prune()
+
+        self.last_advance_ms = (time.perf_counter() - start) * 1000
+        self.worst_advance_ms = max(self.worst_advance_ms, self.last_advance_ms)
+        return advanced
+
+    def settle(self):
+        # Apply any outstanding correction without stepping a new frame
+        if self.rollback_to is not None:
+            target = self.frame
+            self.match.load_state(self.snapshots[self.rollback_to % self.ring_size])
+            self.rollback_to = None
+            self.rollbacks += 1
+            while self.frame < target and not self.match.over:
+                self.simulate_frame()
+                self.resimulated += 1
+
+    def prune(self):
+        # Nothing older than the rollback window or the confirmed watermark
+        # can be needed again
+        horizon = min(self.frame - self.ring_size, self.confirmed_frame() - 1)
+        for frame in [f for f in self.used if f < horizon]:
+            del self.used[frame]
+        for player_inputs in self.inputs:
+            for frame in [f for f in player_inputs if f < horizon]:
+                del player_inputs[frame]
+
+# ============================================
+# UDP TRANSPORT
+# ============================================
+# Each datagram carries the sender's last few unacknowledged input frames,
+# so a lost packet is covered by the next one without retransmission.
+# Layout: magic 'KNET', u32 ack, u32 first frame, u8 count, count input bytes.
+# A peer leaving mid-match sends the same header with magic 'KBYE' instead.
+
+PACKET_MAGIC = b"KNET"
+QUIT_MAGIC = b"KBYE"
+PACKET_HEADER = struct.Struct("<4sIIB")
+MAX_INPUTS_PER_PACKET = 32
+
+class UdpPeer:
+    def __init__(self, session, local_port, remote_addr, bind_host="127.0.0.1", send_delay=0.0):
+        self.session = session
+        self.remote_addr = remote_addr
+        self.remote_players = [p for p in range(len(session.match.players))
+                               if p not in session.local_players]
+        self.local_player = min(session.local_players)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((bind_host, local_port))
+        self.sock.setblocking(False)
+        self.remote_ack = -1  # last local frame the remote has confirmed
+        self.remote_quit = False
+        # Artificial one-way latency for loopback testing
+        self.send_delay = send_delay
+        self.outbox = deque()
+
+    def send(self):
+        session = self.session
+        first = max(self.remote_ack + 1, session.confirmed[self.local_player] - MAX_INPUTS_PER_PACKET + 1)
+        last = session.confirmed[self.local_player]
+        if last < first:
+            first = last + 1
+        local_inputs = session.inputs[self.local_player]
+        payload = bytes(local_inputs.get(f, 0) for f in range(first, last + 1))
+        ack = session.confirmed[self.remote_players[0]]
+        packet = PACKET_HEADER.pack(PACKET_MAGIC, ack & 0xFFFFFFFF, first, len(payload)) + payload
+        if self.send_delay:
+            self.outbox.append((time.perf_counter() + self.send_delay, packet))
+            self.flush()
+        else:
+            self.sock.sendto(packet, self.remote_addr)
+
+    def send_quit(self):
+        ack = self.session.confirmed[self.remote_players[0]]
+        self.sock.sendto(PACKET_HEADER.pack(QUIT_MAGIC, ack & 0xFFFFFFFF, 0, 0), self.remote_addr)
+
+    def delivered(self):
+        # Whether the remote has every local input sent so far
+        return self.remote_ack >= self.session.confirmed[self.local_player]
+
+    def flush(self):
+        now = time.perf_counter()
+        while self.outbox and self.outbox[0][0] <= now:
+            self.sock.sendto(self.outbox.popleft()[1], self.remote_addr)
+
+    def poll(self):
+        self.flush()
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(2048)
+            except BlockingIOError:
+                return
+            except ConnectionResetError:
+                continue
+            if len(data) < PACKET_HEADER.size:
+                continue
+            magic, ack, first, count = PACKET_HEADER.unpack_from(data)
+            if magic == QUIT_MAGIC:
+                self.remote_quit = True
+                continue
+            if magic != PACKET_MAGIC or len(data) < PACKET_HEADER.size + count:
+                continue
+            if ack != 0xFFFFFFFF:
+                self.remote_ack = max(self.remote_ack, ack)
+            payload = data[PACKET_HEADER.size:PACKET_HEADER.size + count]
+            for player in self.remote_players:
+                for i, bits in enumerate(payload):
+                    self.session.add_remote_input(player, first + i, bits)
+
+    def close(self):
+        self.sock.close()
+
+# ============================================
+# LOOPBACK SELF-TEST
+# ============================================
+
+def loopback_test(frames=1800, latency_ms=50, max_rollback=DEFAULT_MAX_ROLLBACK,
+                  stage_id="dream_land", characters=("Mario", "Fox"), seed=1, base_port=47000):
+    # Two peers in one process talking over localhost UDP with artificial
+    # latency and random inputs. Both must end on identical state.
+    peers = []
+    for p in range(2):
+        match = Match(STAGES[stage_id], characters, seed=seed)
+        session = RollbackSession(match, [p], max_rollback=max_rollback)
+        peers.append(UdpPeer(session, base_port + p, ("127.0.0.1", base_port + 1 - p),
+                             send_delay=latency_ms / 1000.0))
+    rngs = [random.Random(100 + p), random.Random(200 + p)]
+    held = [0, 0]
+
+    frame_time = 1.0 / FPS
+    next_tick = time.perf_counter()
+    try:
+        while not all(peer.session.finished() or peer.session.confirmed_frame() >= frames
+                      for peer in peers):
+            for p, peer in enumerate(peers):
+                peer.poll()
+                if peer.session.frame <= frames and peer.session.confirmed[p] < frames:
+                    if rngs[p].random() < 0.1:
+                        held[p] = rngs[p].randrange(64)
+                    if peer.session.can_advance():
+                        peer.session.add_local_input(held[p])
+                if peer.session.frame < frames:
+                    peer.session.advance()
+                else:
+                    peer.session.settle()
+                peer.send()
+            next_tick += frame_time
+            delay = next_tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        for peer in peers:
+            peer.poll()
+            peer.session.settle()
+    finally:
+        for peer in peers:
+            peer.close()
+
+    digests = [state_digest(peer.session.match) for peer in peers]
+    for p, peer in enumerate(peers):
+        s = peer.session
+        print(f"peer {p}: frame {s.frame} rollbacks {s.rollbacks} resimulated {s.resimulated} "
+              f"worst frame {s.worst_advance_ms:.2f}ms digest {digests[p]:08x}")
+    return digests[0] == digests[1]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rollback netcode loopback test")
+    parser.add_argument("--frames", type=int, default=1800)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--max-rollback", type=int, default=DEFAULT_MAX_ROLLBACK)
+    parser.add_argument("--stage", default="dream_land", choices=sorted(STAGES))
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    ok = loopback_test(args.frames, args.latency_ms, args.max_rollback, args.stage, seed=args.seed)
+    print("in sync" if ok else "DESYNC")
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
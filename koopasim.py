@@ -0,0 +1,1544 @@
+import math
+import random
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Mapping
+from enum import Enum
+from operator import attrgetter
+
+from koopacontent import load_content, MOVE_NAMES, ENTITY_NAMES
+from koopahit import CollisionWorld
+
+# ============================================
+# HAL LABORATORY SUPER SMASH BROS 64 ENGINE
+# SIMULATION CORE
+# ============================================
+# Everything needed to step a match lives here and nothing in this module
+# imports pygame, so battles can be simulated headless at thousands of
+# frames per second. koopahdrv0.py is the pygame front-end that only
+# renders this state.
+
+# Constants
+SCREEN_WIDTH = 1024
+SCREEN_HEIGHT = 768
+FPS = 60
+GRAVITY = 0.9
+MAX_FALL_SPEED = 18
+FIGHTER_WIDTH = 40
+FIGHTER_HEIGHT = 60
+
+# N64 Color Palette
+BLACK = (0, 0, 0)
+WHITE = (255, 255, 255)
+RED = (200, 30, 30)
+BLUE = (30, 30, 200)
+GREEN = (30, 200, 30)
+YELLOW = (255, 220, 0)
+PURPLE = (200, 30, 200)
+CYAN = (30, 200, 200)
+ORANGE = (255, 140, 0)
+GRAY = (128, 128, 128)
+DARK_GRAY = (64, 64, 64)
+N64_BLUE = (70, 90, 120)
+N64_RED = (180, 60, 60)
+
+class PlayerState(Enum):
+    IDLE = 1
+    WALKING = 2
+    RUNNING = 3
+    JUMPING = 4
+    FALLING = 5
+    ATTACKING = 6
+    STUNNED = 7
+    SHIELDING = 8
+    DODGING = 9
+    GRABBING = 10
+    THROWN = 11
+    HANGING = 12
+
+# Per-frame controller input, one small int per player.
+# Bits are "held" state; presses are derived by the match from the
+# previous frame so the same input frame can be replayed exactly.
+INPUT_LEFT = 1 << 0
+INPUT_RIGHT = 1 << 1
+INPUT_JUMP = 1 << 2
+INPUT_DOWN = 1 << 3
+INPUT_ATTACK = 1 << 4
+INPUT_SHIELD = 1 << 5
+
+# ============================================
+# PLATFORM COLLISION
+# ============================================
+# Stage platforms are compiled once into an index for a fixed fighter body
+# width. Platform edges, widened by that width, split the stage into
+# vertical slabs; every fighter x falls in exactly one slab, found with a
+# bisect, and each slab keeps the platforms above it sorted by height. A
+# landing or ceiling query is then a second bisect.
+#
+# One-way platforms only catch fighters falling onto them from above and
+# can be dropped through. Solid platforms also block from below and from
+# the sides, and their top corners are ledges unless the edge is walk-off
+# (it reaches the blast zone).
+
+LEDGE_REACH = 24          # how close a falling fighter must be to catch a ledge
+LEDGE_HANG_FRAMES = 180   # a hanging fighter lets go on its own after this long
+LEDGE_REGRAB_FRAMES = 30  # no catching another ledge this soon after letting go
+
+class PlatformIndex:
+    def __init__(self, platforms, blast_zones, body_width=FIGHTER_WIDTH):
+        self.body_width = body_width
+        # left, top, right, bottom, solid
+        self.platforms = tuple(sorted(
+            (p['x'], p['y'], p['x'] + p['width'], p['y'] + p['height'], p.get('solid', False))
+            for p in platforms))
+
+        # A body whose left edge is x overlaps a platform when
+        # left - body_width < x < right
+        edges = set()
+        for left, top, right, bottom, solid in self.platforms:
+            edges.add(left - body_width)
+            edges.add(right)
+        self.edges = sorted(edges)
+
+        # Slab k lies between edges[k - 1] and edges[k]; the outermost two
+        # are unbounded and always empty
+        self.slab_tops = []
+        self.slab_landing = []
+        self.slab_bottoms = []
+        self.slab_ceiling = []
+        self.slab_walls = []
+        for k in range(len(self.edges) + 1):
+            if 0 < k < len(self.edges):
+                lo = self.edges[k - 1]
+                hi = self.edges[k]
+                over = [p for p in self.platforms if p[0] - body_width <= lo and p[2] >= hi]
+            else:
+                over = []
+            over.sort(key=_platform_top)
+            self.slab_tops.append(tuple(p[1] for p in over))
+            self.slab_landing.append(tuple(over))
+            solid = sorted((p for p in over if p[4]), key=_platform_bottom)
+            self.slab_bottoms.append(tuple(p[3] for p in solid))
+            self.slab_ceiling.append(tuple(solid))
+            self.slab_walls.append(tuple(p for p in over if p[4]))
+
+        # Ledges as (hanging x, top, facing right), sorted by hanging x
+        ledges = []
+        for left, top, right, bottom, solid in self.platforms:
+            if not solid:
+                continue
+            if left > blast_zones[0]:
+                ledges.append((left - body_width, top, True))
+            if right < blast_zones[1]:
+                ledges.append((right, top, False))
+        ledges.sort()
+        self.ledges = tuple(ledges)
+        self.ledge_xs = tuple(ledge[0] for ledge in ledges)
+
+    def landing(self, x, prev_feet, feet):
+        # Top of the highest platform the feet crossed moving down from
+        # prev_feet to feet, or None
+        k = bisect_right(self.edges, x)
+        tops = self.slab_tops[k]
+        platforms = self.slab_landing[k]
+        i = bisect_left(tops, prev_feet)
+        while i < len(tops) and tops[i] <= feet:
+            left, top, right, bottom, solid = platforms[i]
+            if left - self.body_width < x < right:
+                return top
+            i += 1
+        return None
+
+    def ceiling(self, x, prev_head, head):
+        # Underside of the lowest solid platform the head crossed moving up
+        # from prev_head to head, or None
+        k = bisect_right(self.edges, x)
+        bottoms = self.slab_bottoms[k]
+        platforms = self.slab_ceiling[k]
+        i = bisect_right(bottoms, prev_head) - 1
+        while i >= 0 and bottoms[i] >= head:
+            left, top, right, bottom, solid = platforms[i]
+            if left - self.body_width < x < right:
+                return bottom
+            i -= 1
+        return None
+
+    def wall(self, prev_x, x, head, feet):
+        # Where a body moving sideways from prev_x to x is stopped by the
+        # side of a solid platform, or None
+        stop = None
+        w = self.body_width
+        for left, top, right, bottom, solid in self.slab_walls[bisect_right(self.edges, x)]:
+            if not (left - w < x < right and top < feet and bottom > head):
+                continue
+            if x > prev_x and prev_x <= left - w:
+                if stop is None or left - w < stop:
+                    stop = left - w
+            elif x < prev_x and prev_x >= right:
+                if stop is None or right > stop:
+                    stop = right
+        return stop
+
+    def passable(self, x, feet):
+        # True when the platform underfoot is one-way
+        k = bisect_right(self.edges, x)
+        tops = self.slab_tops[k]
+        i = bisect_left(tops, feet)
+        while i < len(tops) and tops[i] == feet:
+            left, top, right, bottom, solid = self.slab_landing[k][i]
+            if left - self.body_width < x < right:
+                return not solid
+            i += 1
+        return False
+
+    def ledge(self, x, y):
+        # First ledge within reach of a body at (x, y), or None
+        i = bisect_left(self.ledge_xs, x - LEDGE_REACH)
+        while i < len(self.ledges) and self.ledge_xs[i] <= x + LEDGE_REACH:
+            ledge = self.ledges[i]
+            if abs(ledge[1] - y) <= LEDGE_REACH:
+                return ledge
+            i += 1
+        return None
+
+def _platform_top(platform):
+    return platform[1]
+
+def _platform_bottom(platform):
+    return platform[3]
+
+# ============================================
+# STAGE DEFINITIONS - All 9 N64 Stages
+# ============================================
+# Platforms are one-way unless marked 'solid'; the main stage body is solid.
+# Platforms with a path move and are kept out of the collision index; see
+# STAGE HAZARDS. Stages and characters come from the content packs in
+# content/.
+
+_STAGE_CONTENT, _CHARACTER_CONTENT = load_content()
+
+class Stage:
+    def __init__(self, name, stage_id, platforms, blast_zones, spawn_points, bg_color,
+                 layers=(), scenery=None, hazards=()):
+        self.name = name
+        self.stage_id = stage_id
+        self.platforms = [p for p in platforms if not p.get('path')]
+        self.moving = tuple(MovingPlatform(p) for p in platforms if p.get('path'))
+        self.hazards = tuple(Hazard(h) for h in hazards)
+        self.blast_zones = blast_zones  # left, right, top, bottom
+        self.spawn_points = spawn_points
+        self.bg_color = bg_color
+        self.layers = layers            # (shape, color, coords) background primitives
+        self.scenery = scenery          # kind of per-match StageScenery, if any
+        self.collision = PlatformIndex(self.platforms, blast_zones)
+        self.entity_indexes = None
+
+    def entity_collision(self):
+        # A platform index per entity kind, for that kind's width; built
+        # the first time something is thrown or dropped on the stage
+        if self.entity_indexes is None:
+            self.entity_indexes = tuple(PlatformIndex(self.platforms, self.blast_zones, kind.width)
+                                        for kind in ENTITY_KINDS)
+        return self.entity_indexes
+
+    def spawn_layout(self, count):
+        # Starting positions for count fighters. Extra fighters beyond the
+        # stage's own spawn points are spread evenly along the main platform.
+        if count <= len(self.spawn_points):
+            return list(self.spawn_points[:count])
+        main = self.platforms[0]
+        y = min(point[1] for point in self.spawn_points)
+        step = main['width'] / (count + 1)
+        return [(main['x'] + step * (i + 1) - 20, y) for i in range(count)]
+
+class StageRegistry(Mapping):
+    # stage id -> Stage, in content pack order. Each Stage (and its
+    # collision index) is built the first time it is looked up, so
+    # importing the engine costs nothing per stage. Safe to fill from a
+    # loader thread: a racing build loses to the first one stored.
+    def __init__(self, records):
+        self.records = records
+        self.built = {}
+
+    def __getitem__(self, stage_id):
+        stage = self.built.get(stage_id)
+        if stage is None:
+            s = self.records[stage_id]
+            stage = self.built.setdefault(stage_id, Stage(
+                s['name'], stage_id, s['platforms'], s['blast_zones'], s['spawn_points'],
+                s['bg_color'], s['layers'], s['scenery'], s['hazards']))
+        return stage
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, stage_id):
+        return stage_id in self.records
+
+STAGES = StageRegistry(_STAGE_CONTENT)
+
+# ============================================
+# STAGE SCENERY
+# ============================================
+
+class StageScenery:
+    # Decorative per-match stage state. It is rolled from the match RNG
+    # once and then advanced a tick at a time, so the same seed always
+    # produces the same skyline and the same lava bubbles on every frame.
+    def __init__(self, stage, rng):
+        self.stage_id = stage.stage_id
+        self.rng = rng
+        self.skyline = ()
+        self.bubbles = []
+
+        if stage.scenery == "skyline":
+            self.skyline = tuple(rng.randint(100, 300) for i in range(5))
+        elif stage.scenery == "lava_bubbles":
+            for i in range(10):
+                self.bubbles.append(self.new_bubble())
+
+    def new_bubble(self):
+        # x, radius, frames left
+        return [self.rng.randint(0, SCREEN_WIDTH), self.rng.randint(3, 8), self.rng.randint(4, 20)]
+
+    @property
+    def layer_key(self):
+        # Everything the static stage layer depends on
+        return self.skyline
+
+    def tick(self):
+        for i, bubble in enumerate(self.bubbles):
+            bubble[2] -= 1
+            if bubble[2] <= 0:
+                self.bubbles[i] = self.new_bubble()
+
+# ============================================
+# STAGE HAZARDS
+# ============================================
+# Stages script hazards and moving platforms as data. Anything that moves
+# follows a keyframed path, baked once per stage into one offset per frame
+# of its loop and eased between keyframes, so placing it on any frame is
+# an index.
+#
+# Hazards that come and go run off a timer wheel: a pending event waits in
+# the bucket of the frame it is due on and each tick visits one bucket.
+# The wheel is sized past the longest delay the stage ever schedules, so
+# a bucket only holds events due on that very frame and a tick costs the
+# same however many timed hazards the stage defines.
+#
+# Hazard boxes go into the match's CollisionWorld beside fighter hurtboxes,
+# owned by HAZARD_OWNER. Like entities they knock fighters away from their
+# centre, and a fighter touching several takes the hit of the first; unlike
+# entities they are never spent. Moving platforms are one-way, and
+# fighters standing on one ride along with it.
+
+HAZARD_OWNER = -2
+
+class MotionPath:
+    # Offsets along a path for every frame of its loop
+    def __init__(self, keyframes):
+        self.period = keyframes[-1][0]
+        self.dx = array('d')
+        self.dy = array('d')
+        for (f0, x0, y0), (f1, x1, y1) in zip(keyframes, keyframes[1:]):
+            span = f1 - f0
+            for f in range(span):
+                t = f / span
+                t = t * t * (3 - 2 * t)  # ease in and out
+                self.dx.append(x0 + (x1 - x0) * t)
+                self.dy.append(y0 + (y1 - y0) * t)
+
+class MovingPlatform:
+    def __init__(self, platform):
+        self.x = platform['x']
+        self.y = platform['y']
+        self.width = platform['width']
+        self.height = platform['height']
+        self.color = platform['color']
+        self.path = MotionPath(platform['path'])
+
+class Hazard:
+    def __init__(self, hazard):
+        self.x, self.y, self.width, self.height = hazard['box']
+        self.color = hazard['color']
+        self.damage = hazard['damage']
+        # Knockback for a fighter to the right of the hazard's centre
+        angle = math.radians(hazard['angle'])
+        self.base_x = hazard['base'] * math.cos(angle)
+        self.base_y = -hazard['base'] * math.sin(angle)
+        self.growth_x = hazard['growth'] * math.cos(angle)
+        self.growth_y = -hazard['growth'] * math.sin(angle)
+        self.path = MotionPath(hazard['path']) if hazard['path'] else None
+        self.schedule = hazard['schedule']  # (first frame, period, active frames) or None
+
+class TimerWheel:
+    # Hashed timing wheel over frames. An event is a small int; one due on
+    # frame f waits in bucket f % size. Buckets are only walked when due,
+    # so no event may be scheduled size or more frames ahead.
+    def __init__(self, longest=1):
+        size = 1
+        while size <= longest:
+            size <<= 1
+        self.mask = size - 1
+        self.buckets = [[] for i in range(size)]
+        self.used = set()  # indexes of non-empty buckets
+        self.now = -1      # frame of the last advance(); the first is frame 0
+
+    def schedule(self, delay, event):
+        # Fire event delay frames after the current one
+        if not 0 < delay <= self.mask:
+            raise ValueError(f"can't schedule {delay} frames ahead on a wheel of {self.mask + 1}")
+        k = (self.now + delay) & self.mask
+        self.buckets[k].append(event)
+        self.used.add(k)
+
+    def advance(self):
+        # Move on one frame and return the events due on it, in the order
+        # they were scheduled
+        self.now += 1
+        k = self.now & self.mask
+        bucket = self.buckets[k]
+        if not bucket:
+            return ()
+        due = tuple(bucket)
+        bucket.clear()
+        self.used.discard(k)
+        return due
+
+    def save_state(self):
+        # Pending events as (frame due, event), soonest first
+        now = self.now
+        mask = self.mask
+        delays = sorted((((k - now - 1) & mask) + 1, k) for k in self.used)
+        return (now, tuple((now + delay, event) for delay, k in delays for event in self.buckets[k]))
+
+    def load_state(self, state):
+        now, pending = state
+        for k in self.used:
+            self.buckets[k].clear()
+        self.used.clear()
+        self.now = now
+        for due, event in pending:
+            k = due & self.mask
+            self.buckets[k].append(event)
+            self.used.add(k)
+
+# Timer wheel events: hazard index * 2 + one of these
+HAZARD_OUT = 0
+HAZARD_IN = 1
+
+class StageHazards:
+    # Per-match hazard and moving platform state. With enabled False the
+    # stage plays static: no hazards and no moving platforms.
+    def __init__(self, stage, fighters, enabled=True):
+        self.enabled = enabled
+        self.hazards = stage.hazards if enabled else ()
+        self.platforms = stage.moving if enabled else ()
+        # Which hazards are out, and the frame each last came out on; a
+        # scheduled hazard's path starts over from there
+        self.out = [h.schedule is None for h in self.hazards]
+        self.since = [0] * len(self.hazards)
+        longest = 1
+        for h in self.hazards:
+            if h.schedule is not None:
+                longest = max(longest, h.schedule[0] + 1, h.schedule[1])
+        self.wheel = TimerWheel(longest)
+        for i, h in enumerate(self.hazards):
+            if h.schedule is not None:
+                self.wheel.schedule(h.schedule[0] + 1, i * 2 + HAZARD_OUT)
+
+        # Where everything is on the current frame, and where moving
+        # platforms were on the one before
+        self.hazard_x = [h.x for h in self.hazards]
+        self.hazard_y = [h.y for h in self.hazards]
+        self.platform_x = [p.x for p in self.platforms]
+        self.platform_y = [p.y for p in self.platforms]
+        self.prev_x = list(self.platform_x)
+        self.prev_y = list(self.platform_y)
+        self.place(0)
+        # Per fighter: the moving platform it stands on, or -1, and its
+        # feet before this frame's move
+        self.riders = [-1] * fighters
+        self.feet = [0.0] * fighters
+
+    def come_out(self, i, frame):
+        at, every, active = self.hazards[i].schedule
+        self.out[i] = True
+        self.since[i] = frame
+        self.wheel.schedule(active, i * 2 + HAZARD_IN)
+        self.wheel.schedule(every, i * 2 + HAZARD_OUT)
+
+    def go_in(self, i, frame):
+        self.out[i] = False
+
+    def place(self, frame):
+        for i, h in enumerate(self.hazards):
+            path = h.path
+            if path is not None and self.out[i]:
+                t = (frame - self.since[i]) % path.period
+                self.hazard_x[i] = h.x + path.dx[t]
+                self.hazard_y[i] = h.y + path.dy[t]
+        for p, platform in enumerate(self.platforms):
+            path = platform.path
+            t = frame % path.period
+            self.prev_x[p] = self.platform_x[p]
+            self.prev_y[p] = self.platform_y[p]
+            self.platform_x[p] = platform.x + path.dx[t]
+            self.platform_y[p] = platform.y + path.dy[t]
+
+    def tick(self, players):
+        # Before fighters move: fire this frame's events, move everything
+        # and carry riders along
+        frame = self.wheel.now + 1
+        for event in self.wheel.advance():
+            _HAZARD_EVENTS[event & 1](self, event >> 1, frame)
+        self.place(frame)
+        riders = self.riders
+        for i, player in enumerate(players):
+            self.feet[i] = player.y + player.height
+            p = riders[i]
+            if p < 0:
+                continue
+            if player.grounded and player.state != PlayerState.HANGING:
+                player.x += self.platform_x[p] - self.prev_x[p]
+                player.y += self.platform_y[p] - self.prev_y[p]
+                # Riders fall a little every frame before landing back on
+                # the platform; that must not catch ledges passing by
+                if player.ledge_timer < 2:
+                    player.ledge_timer = 2
+            else:
+                riders[i] = -1
+
+    def land(self, players):
+        # After fighters move: catch the ones that fell onto a moving
+        # platform. A rider always lands back on its own platform while
+        # over it, which keeps it there however the platform moves.
+        riders = self.riders
+        for i, player in enumerate(players):
+            riding = riders[i]
+            riders[i] = -1
+            if (player.stocks <= 0 or player.grounded or player.vy <= 0 or
+                    player.state == PlayerState.HANGING):
+                continue
+            x = player.x
+            feet = player.y + player.height
+            for p, platform in enumerate(self.platforms):
+                left = self.platform_x[p]
+                top = self.platform_y[p]
+                if (left - player.width < x < left + platform.width and top <= feet and
+                        (riding == p or self.feet[i] <= self.prev_y[p])):
+                    player.y = top - player.height
+                    player.land()
+                    riders[i] = p
+                    break
+
+    def drop(self, i, player):
+        # Down drops through a moving platform like any one-way platform
+        if self.riders[i] >= 0 and player.grounded and player.state != PlayerState.STUNNED:
+            self.riders[i] = -1
+            player.y += 1
+            player.grounded = False
+
+    def add_hitboxes(self, world):
+        # Hazard hitboxes carry the hazard index as their data
+        for i, h in enumerate(self.hazards):
+            if self.out[i]:
+                x = self.hazard_x[i]
+                y = self.hazard_y[i]
+                world.add_hitbox(x, y, x + h.width, y + h.height, HAZARD_OWNER, i)
+
+    def strike(self, fighter, i):
+        h = self.hazards[i]
+        sign = 1 if fighter.x + fighter.width / 2 >= self.hazard_x[i] + h.width / 2 else -1
+        fighter.take_hit(h.damage, h.base_x * sign, h.base_y, h.growth_x * sign, h.growth_y)
+
+    def save_state(self):
+        # Positions follow from the frame, so only what the events and
+        # riders changed is kept
+        return (self.wheel.save_state(), tuple(self.out), tuple(self.since), tuple(self.riders))
+
+    def load_state(self, state):
+        wheel, out, since, riders = state
+        self.wheel.load_state(wheel)
+        self.out[:] = out
+        self.since[:] = since
+        self.riders[:] = riders
+        self.place(max(self.wheel.now, 0))
+
+_HAZARD_EVENTS = (StageHazards.come_out, StageHazards.go_in)
+
+# ============================================
+# PARTICLES
+# ============================================
+# Hit sparks for every fighter in a match share one fixed-capacity pool.
+# Each particle field is a preallocated typed array indexed by slot and
+# finished slots go back on a free list, so a flurry of hits reuses the
+# same memory instead of allocating. When the pool is full new sparks are
+# dropped; they are cosmetic and never affect the fight.
+
+PARTICLE_CAPACITY = 512
+PARTICLE_LIFE = 20
+PARTICLE_GRAVITY = 0.3
+PARTICLE_DRAG = 0.9
+
+# Colour ramps; the renderer maps each to pre-rasterized sprites
+HIT_SPARK = 0
+
+# Directions for the 12 sparks of a hit burst
+_BURST = tuple((math.cos(i * math.pi / 6), math.sin(i * math.pi / 6)) for i in range(12))
+
+class ParticlePool:
+    def __init__(self, capacity=PARTICLE_CAPACITY):
+        self.capacity = capacity
+        self.x = array('d', bytes(8 * capacity))
+        self.y = array('d', bytes(8 * capacity))
+        self.vx = array('d', bytes(8 * capacity))
+        self.vy = array('d', bytes(8 * capacity))
+        self.size = array('B', bytes(capacity))
+        self.life = array('B', bytes(capacity))
+        self.color = array('B', bytes(capacity))
+        # Slots in use, in no particular order, and a stack of free ones
+        self.live = []
+        self.free = list(range(capacity - 1, -1, -1))
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.live)
+
+    def emit(self, x, y, vx, vy, size, life=PARTICLE_LIFE, color=HIT_SPARK):
+        if not self.free:
+            self.dropped += 1
+            return
+        i = self.free.pop()
+        self.x[i] = x
+        self.y[i] = y
+        self.vx[i] = vx
+        self.vy[i] = vy
+        self.size[i] = size
+        self.life[i] = life
+        self.color[i] = color
+        self.live.append(i)
+
+    def burst(self, x, y, rng, color=HIT_SPARK):
+        # Sparks fly out in a ring; small ones faster than big ones
+        for dx, dy in _BURST:
+            size = rng.randint(3, 8)
+            speed = 1 + (9 - size) * 0.5
+            self.emit(x, y, dx * speed, dy * speed, size, PARTICLE_LIFE, color)
+
+    def update(self):
+        # One pass over live slots: integrate, age, and swap-remove the
+        # expired ones so the live list never reallocates
+        x, y, vx, vy, life = self.x, self.y, self.vx, self.vy, self.life
+        live = self.live
+        n = len(live)
+        i = 0
+        while i < n:
+            s = live[i]
+            if life[s] <= 1:
+                self.free.append(s)
+                n -= 1
+                live[i] = live[n]
+                live.pop()
+                continue
+            life[s] -= 1
+            vx[s] *= PARTICLE_DRAG
+            vy[s] = vy[s] * PARTICLE_DRAG + PARTICLE_GRAVITY
+            x[s] += vx[s]
+            y[s] += vy[s]
+            i += 1
+
+    def clear(self):
+        self.free.extend(self.live)
+        self.live.clear()
+
+    def save_state(self):
+        # Live particles plus slot bookkeeping, so a restore reuses the
+        # same slots in the same order
+        return (tuple(self.live), tuple(self.free),
+                tuple((self.x[s], self.y[s], self.vx[s], self.vy[s],
+                       self.size[s], self.life[s], self.color[s]) for s in self.live))
+
+    def load_state(self, state):
+        live, free, particles = state
+        self.live[:] = live
+        self.free[:] = free
+        for s, (x, y, vx, vy, size, life, color) in zip(live, particles):
+            self.x[s] = x
+            self.y[s] = y
+            self.vx[s] = vx
+            self.vy[s] = vy
+            self.size[s] = size
+            self.life[s] = life
+            self.color[s] = color
+
+# ============================================
+# ENTITIES - PROJECTILES AND ITEMS
+# ============================================
+# Everything in a match that is not a fighter: projectiles thrown by moves
+# and items dropped by item rain. Like particles, every entity field is a
+# preallocated typed array indexed by slot, with a free list of slots, so
+# hundreds of live entities cost no allocation from frame to frame. When
+# the pool is full new entities are dropped.
+#
+# What an entity is lives in tables, never in branches: its kind indexes
+# ENTITY_KINDS for size, lifetime and hit, and the kind's motion names the
+# function in MOTIONS that moves it each frame. A new kind is a new row.
+#
+# An entity strikes the first fighter it touches that is neither its
+# owner nor invulnerable, and is spent doing so. A fighter touched by
+# several at once takes the hit of the first in (owner, spawn frame) order
+# and the others are spent on it without effect. Knockback points away
+# from the entity's centre.
+
+ENTITY_CAPACITY = 512
+NO_OWNER = -1    # items belong to nobody and can strike anyone
+
+class EntityKind:
+    __slots__ = ('name', 'motion', 'width', 'height', 'speed', 'lift', 'gravity', 'bounce', 'life',
+                 'damage', 'base_x', 'base_y', 'growth_x', 'growth_y')
+
+    def __init__(self, name, motion, width, height, speed, life, damage, base, growth, angle,
+                 lift=0, gravity=0, bounce=0):
+        self.name = name
+        self.motion = motion
+        self.width = width
+        self.height = height
+        self.speed = speed        # launch speed along the thrower's facing
+        self.lift = lift          # launch vy
+        self.gravity = gravity
+        self.bounce = bounce      # vy after landing, for bouncing kinds
+        self.life = life          # frames before it fizzles out
+        self.damage = damage
+        # Knockback for a fighter to the right of the entity, as for hitboxes
+        angle = math.radians(angle)
+        self.base_x = base * math.cos(angle)
+        self.base_y = -base * math.sin(angle)
+        self.growth_x = growth * math.cos(angle)
+        self.growth_y = -growth * math.sin(angle)
+
+_KINDS = {
+    'fireball': EntityKind('fireball', 'bounce', 16, 16, 6, 90, 5, 4, 5, 40, gravity=0.6, bounce=6),
+    'laser': EntityKind('laser', 'straight', 28, 4, 18, 28, 3, 0, 0, 0),
+    'shot': EntityKind('shot', 'straight', 22, 22, 9, 70, 9, 7, 10, 35),
+    'thunder': EntityKind('thunder', 'bounce', 18, 18, 5, 80, 6, 5, 6, 60, lift=-3, gravity=0.8, bounce=4),
+    'bomb': EntityKind('bomb', 'fall', 24, 24, 0, 600, 14, 8, 14, 70, gravity=0.6),
+    'shell': EntityKind('shell', 'fall', 26, 18, 4, 600, 8, 6, 9, 30, gravity=0.6),
+}
+ENTITY_KINDS = tuple(_KINDS[name] for name in ENTITY_NAMES)
+ITEM_KINDS = tuple(ENTITY_NAMES.index(name) for name in ('bomb', 'shell'))
+
+def move_straight(pool, s, kind, collision):
+    pool.x[s] += pool.vx[s]
+    pool.y[s] += pool.vy[s]
+
+def move_bounce(pool, s, kind, collision):
+    # Arcs under gravity and springs back up off any platform it lands on
+    pool.x[s] += pool.vx[s]
+    vy = pool.vy[s] + kind.gravity
+    y = pool.y[s]
+    pool.y[s] = y + vy
+    if vy > 0:
+        top = collision.landing(pool.x[s], y + kind.height, y + vy + kind.height)
+        if top is not None:
+            pool.y[s] = top - kind.height
+            vy = -kind.bounce
+    pool.vy[s] = vy
+
+def move_fall(pool, s, kind, collision):
+    # Falls onto platforms and slides along them, off the edge if moving
+    pool.x[s] += pool.vx[s]
+    vy = min(pool.vy[s] + kind.gravity, MAX_FALL_SPEED)
+    y = pool.y[s]
+    pool.y[s] = y + vy
+    top = collision.landing(pool.x[s], y + kind.height, y + vy + kind.height)
+    if top is not None:
+        pool.y[s] = top - kind.height
+        vy = 0
+    pool.vy[s] = vy
+
+MOTIONS = {
+    'straight': move_straight,
+    'bounce': move_bounce,
+    'fall': move_fall,
+}
+_MOTION_STEPS = tuple(MOTIONS[kind.motion] for kind in ENTITY_KINDS)
+
+class EntityPool:
+    def __init__(self, capacity=ENTITY_CAPACITY):
+        self.capacity = capacity
+        self.kind = array('B', bytes(capacity))
+        self.owner = array('b', bytes(capacity))
+        self.x = array('d', bytes(8 * capacity))
+        self.y = array('d', bytes(8 * capacity))
+        self.vx = array('d', bytes(8 * capacity))
+        self.vy = array('d', bytes(8 * capacity))
+        self.life = array('H', bytes(2 * capacity))
+        self.born = array('q', bytes(8 * capacity))  # frame it was spawned on
+        # Slots in use, in no particular order, and a stack of free ones
+        self.live = []
+        self.free = list(range(capacity - 1, -1, -1))
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.live)
+
+    def spawn(self, kind, owner, x, y, vx, vy, born):
+        # Returns the slot, or None when the pool is full
+        if not self.free:
+            self.dropped += 1
+            return None
+        s = self.free.pop()
+        self.kind[s] = kind
+        self.owner[s] = owner
+        self.x[s] = x
+        self.y[s] = y
+        self.vx[s] = vx
+        self.vy[s] = vy
+        self.life[s] = ENTITY_KINDS[kind].life
+        self.born[s] = born
+        self.live.append(s)
+        return s
+
+    def kill(self, s):
+        live = self.live
+        i = live.index(s)
+        live[i] = live[-1]
+        live.pop()
+        self.free.append(s)
+
+    def update(self, stage):
+        # Age, move and expire every live entity, swap-removing the ones
+        # that run out of life or leave the blast zones
+        collisions = stage.entity_collision()
+        left, right, top, bottom = stage.blast_zones
+        kind, x, y, life = self.kind, self.x, self.y, self.life
+        live = self.live
+        n = len(live)
+        i = 0
+        while i < n:
+            s = live[i]
+            k = kind[s]
+            if life[s] > 1:
+                life[s] -= 1
+                _MOTION_STEPS[k](self, s, ENTITY_KINDS[k], collisions[k])
+                if left <= x[s] <= right and top <= y[s] <= bottom:
+                    i += 1
+                    continue
+            self.free.append(s)
+            n -= 1
+            live[i] = live[n]
+            live.pop()
+
+    def add_hitboxes(self, world):
+        # Entity hitboxes carry ~slot as their data, which keeps them apart
+        # from move hitboxes (slot >= 0) in the same world
+        kind, owner, x, y = self.kind, self.owner, self.x, self.y
+        for s in self.live:
+            k = ENTITY_KINDS[kind[s]]
+            world.add_hitbox(x[s], y[s], x[s] + k.width, y[s] + k.height, owner[s], ~s)
+
+    def strike(self, fighter, s):
+        k = ENTITY_KINDS[self.kind[s]]
+        sign = 1 if fighter.x + fighter.width / 2 >= self.x[s] + k.width / 2 else -1
+        fighter.take_hit(k.damage, k.base_x * sign, k.base_y, k.growth_x * sign, k.growth_y)
+
+    def clear(self):
+        self.free.extend(self.live)
+        self.live.clear()
+
+    def save_state(self):
+        return (tuple(self.live), tuple(self.free),
+                tuple((self.kind[s], self.owner[s], self.x[s], self.y[s], self.vx[s], self.vy[s],
+                       self.life[s], self.born[s]) for s in self.live))
+
+    def load_state(self, state):
+        live, free, entities = state
+        self.live[:] = live
+        self.free[:] = free
+        for s, (kind, owner, x, y, vx, vy, life, born) in zip(live, entities):
+            self.kind[s] = kind
+            self.owner[s] = owner
+            self.x[s] = x
+            self.y[s] = y
+            self.vx[s] = vx
+            self.vy[s] = vy
+            self.life[s] = life
+            self.born[s] = born
+
+# ============================================
+# MOVES - FRAME DATA
+# ============================================
+# A move runs for startup + active + recovery frames, numbered from 1 on
+# the first frame after the button press, and each of its hitboxes is out
+# on some range of the active frames. Moves are compiled once per
+# character into flat columns: every (move, frame) pair owns a contiguous
+# run of hitbox slots, in hitbox order, so finding what is live on a frame
+# is two lookups. When several of an attack's hitboxes overlap a defender
+# the first one wins.
+#
+# Slot boxes are stored relative to the fighter's top-left for both
+# facings, and knockback as base and growth vectors for a fighter facing
+# right:
+#   knockback = base + growth * (damage after the hit / 80) / weight
+# pointed along the hitbox's angle. base == growth is the classic N64
+# formula.
+
+# The one attack every character had before moves were data
+DEFAULT_MOVES = {
+    'neutral': {'startup': 0, 'active': 19, 'recovery': 0, 'hitboxes': [
+        {'frames': (1, 19), 'box': (0, 0, 60, 60), 'damage': 12,
+         'base': math.hypot(10, 8), 'growth': math.hypot(10, 8), 'angle': math.degrees(math.atan2(8, 10))},
+    ]},
+}
+
+class MoveTable:
+    def __init__(self, moves, body_width=FIGHTER_WIDTH):
+        # moves: name -> move record as validated by koopacontent
+        self.names = tuple(moves)
+        index = {name: i for i, name in enumerate(self.names)}
+        # Move index for each of MOVE_NAMES; missing moves fall back to neutral
+        self.by_name = tuple(index.get(name, index['neutral']) for name in MOVE_NAMES)
+
+        self.length = []       # per move: frames until the fighter can act again
+        self.frame_base = []   # per move: row of its frame 1
+        # per move: the projectile it throws (kind -1 for none), on which
+        # frame, offset like a hitbox box
+        self.projectile_kind = []
+        self.projectile_frame = []
+        self.projectile_x = []
+        self.projectile_y = []
+        self.first = []        # per (move, frame) row: first slot
+        self.count = []        # per row: number of slots
+        # per slot
+        self.left = ([], [])   # indexed by facing_right
+        self.right = ([], [])
+        self.top = []
+        self.bottom = []
+        self.damage = []
+        self.base_x = []
+        self.base_y = []
+        self.growth_x = []
+        self.growth_y = []
+        for name in self.names:
+            move = moves[name]
+            length = move['startup'] + move['active'] + move['recovery']
+            self.length.append(length)
+            self.frame_base.append(len(self.first))
+            projectile = move.get('projectile')
+            if projectile:
+                self.projectile_kind.append(ENTITY_NAMES.index(projectile['kind']))
+                self.projectile_frame.append(projectile['frame'])
+                self.projectile_x.append(projectile['offset'][0])
+                self.projectile_y.append(projectile['offset'][1])
+            else:
+                self.projectile_kind.append(-1)
+                self.projectile_frame.append(0)
+                self.projectile_x.append(0)
+                self.projectile_y.append(0)
+            for frame in range(1, length + 1):
+                self.first.append(len(self.top))
+                live = [h for h in move['hitboxes'] if h['frames'][0] <= frame <= h['frames'][1]]
+                self.count.append(len(live))
+                for h in live:
+                    x, y, width, height = h['box']
+                    self.left[True].append(body_width + x)
+                    self.right[True].append(body_width + x + width)
+                    self.left[False].append(-x - width)
+                    self.right[False].append(-x)
+                    self.top.append(y)
+                    self.bottom.append(y + height)
+                    self.damage.append(h['damage'])
+                    angle = math.radians(h['angle'])
+                    self.base_x.append(h['base'] * math.cos(angle))
+                    self.base_y.append(-h['base'] * math.sin(angle))
+                    self.growth_x.append(h['growth'] * math.cos(angle))
+                    self.growth_y.append(-h['growth'] * math.sin(angle))
+
+        for name, column in list(vars(self).items()):
+            if isinstance(column, list):
+                setattr(self, name, tuple(column))
+        self.left = tuple(map(tuple, self.left))
+        self.right = tuple(map(tuple, self.right))
+
+    def slots(self, move, frame):
+        # Hitbox slots out on this frame (1-based) of a move
+        row = self.frame_base[move] + frame - 1
+        first = self.first[row]
+        return range(first, first + self.count[row])
+
+def attack_kind(held, grounded):
+    # Index into MOVE_NAMES of the move an attack press performs
+    if not grounded:
+        return 3  # air
+    if held & INPUT_DOWN:
+        return 2  # down
+    if held & (INPUT_LEFT | INPUT_RIGHT):
+        return 1  # forward
+    return 0      # neutral
+
+# ============================================
+# CHARACTER DEFINITIONS - Original 12
+# ============================================
+
+class CharacterData:
+    def __init__(self, name, color, speed, jump_power, weight, fall_speed, moves=None):
+        self.name = name
+        self.color = color
+        self.speed = speed
+        self.jump_power = jump_power
+        self.weight = weight
+        self.fall_speed = fall_speed
+        self.moves = MoveTable(moves or DEFAULT_MOVES)
+
+CHARACTER_ROSTER = {
+    key: CharacterData(c['name'], c['color'], c['speed'], c['jump_power'], c['weight'], c['fall_speed'],
+                       c['moves'])
+    for key, c in _CHARACTER_CONTENT.items()
+}
+
+# Fighter fields that change during a match, in snapshot order
+FIGHTER_STATE_FIELDS = (
+    'x', 'y', 'vx', 'vy', 'damage', 'stocks', 'state', 'facing_right',
+    'invulnerable', 'invuln_timer', 'jumps_left', 'fast_falling',
+    'attack_timer', 'stun_timer', 'shield_health', 'dodge_timer', 'hit_victims',
+    'grounded', 'ledge_timer', 'attack_move',
+)
+_get_fighter_state = attrgetter(*FIGHTER_STATE_FIELDS)
+
+class Fighter:
+    def __init__(self, character_data, x, y, player_num, rng=None, particles=None):
+        self.name = character_data.name
+        self.x = x
+        self.y = y
+        self.vx = 0
+        self.vy = 0
+        self.width = FIGHTER_WIDTH
+        self.height = FIGHTER_HEIGHT
+        self.color = character_data.color
+        self.player_num = player_num
+        self.rng = rng if rng is not None else random.Random()
+        self.particles = particles if particles is not None else ParticlePool()
+
+        # Character stats from data
+        self.speed = character_data.speed
+        self.jump_power = character_data.jump_power
+        self.weight = character_data.weight
+        self.fall_speed_multiplier = character_data.fall_speed
+        self.moves = character_data.moves
+
+        # Combat stats
+        self.damage = 0
+        self.stocks = 4
+        self.state = PlayerState.IDLE
+        self.facing_right = True
+        self.invulnerable = False
+        self.invuln_timer = 0
+
+        # Movement
+        self.max_jumps = 2
+        self.jumps_left = self.max_jumps
+        self.fast_falling = False
+        self.grounded = False
+        # Frames left hanging while on a ledge, otherwise until the next
+        # ledge can be caught
+        self.ledge_timer = 0
+
+        # Index into self.moves of the current (or last) attack, and the
+        # player indices it has already hit
+        self.attack_move = 0
+        self.hit_victims = frozenset()
+
+        # Timers
+        self.attack_timer = 0
+        self.stun_timer = 0
+        self.shield_health = 100
+        self.dodge_timer = 0
+
+    def update(self, stage):
+        # Handle invulnerability
+        if self.invulnerable:
+            self.invuln_timer -= 1
+            if self.invuln_timer <= 0:
+                self.invulnerable = False
+
+        # Handle stun
+        if self.state == PlayerState.STUNNED:
+            self.stun_timer -= 1
+            if self.stun_timer <= 0:
+                self.state = PlayerState.IDLE
+
+        # Handle attacks
+        if self.state == PlayerState.ATTACKING:
+            self.attack_timer -= 1
+            if self.attack_timer <= 0:
+                self.state = PlayerState.IDLE
+
+        # Handle dodge
+        if self.state == PlayerState.DODGING:
+            self.dodge_timer -= 1
+            if self.dodge_timer <= 0:
+                self.state = PlayerState.IDLE
+                self.invulnerable = False
+
+        # Hanging from a ledge: no physics until the fighter lets go
+        if self.state == PlayerState.HANGING:
+            self.ledge_timer -= 1
+            if self.ledge_timer <= 0:
+                self.release_ledge()
+        else:
+            if self.ledge_timer > 0:
+                self.ledge_timer -= 1
+            self.move_and_collide(stage.collision)
+
+            # Check blast zones
+            if (self.x < stage.blast_zones[0] or
+                self.x > stage.blast_zones[1] or
+                self.y < stage.blast_zones[2] or
+                self.y > stage.blast_zones[3]):
+                self.respawn(stage)
+
+    def move_and_collide(self, collision):
+        # Apply gravity
+        gravity = GRAVITY * self.fall_speed_multiplier
+        if self.fast_falling:
+            gravity *= 2
+        self.vy += gravity
+        if self.vy > MAX_FALL_SPEED * self.fall_speed_multiplier:
+            self.vy = MAX_FALL_SPEED * self.fall_speed_multiplier
+
+        # Horizontal movement, stopped by the sides of solid platforms
+        if self.state != PlayerState.STUNNED and self.vx:
+            x = self.x + self.vx
+            wall = collision.wall(self.x, x, self.y, self.y + self.height)
+            if wall is not None:
+                x = wall
+                self.vx = 0
+            self.x = x
+
+        # Vertical movement: land on platforms, bump solid undersides
+        prev_y = self.y
+        self.y += self.vy
+        self.grounded = False
+        if self.vy > 0:
+            top = collision.landing(self.x, prev_y + self.height, self.y + self.height)
+            if top is not None:
+                self.y = top - self.height
+                self.land()
+        elif self.vy < 0:
+            bottom = collision.ceiling(self.x, prev_y, self.y)
+            if bottom is not None:
+                self.y = bottom
+                self.vy = 0
+
+        # Falling fighters catch ledges
+        if self.vy > 0 and self.ledge_timer == 0 and self.state != PlayerState.STUNNED:
+            ledge = collision.ledge(self.x, self.y)
+            if ledge is not None:
+                self.grab_ledge(ledge)
+
+    def land(self):
+        self.vy = 0
+        self.grounded = True
+        self.jumps_left = self.max_jumps
+        self.fast_falling = False
+        if self.state in [PlayerState.JUMPING, PlayerState.FALLING]:
+            self.state = PlayerState.IDLE
+
+    def grab_ledge(self, ledge):
+        self.x, self.y, self.facing_right = ledge
+        self.vx = 0
+        self.vy = 0
+        self.state = PlayerState.HANGING
+        self.ledge_timer = LEDGE_HANG_FRAMES
+        self.jumps_left = self.max_jumps
+        self.fast_falling = False
+
+    def release_ledge(self):
+        self.state = PlayerState.FALLING
+        self.ledge_timer = LEDGE_REGRAB_FRAMES
+
+    def drop(self, collision):
+        # Down: let go of a ledge, or fall through a one-way platform
+        if self.state == PlayerState.HANGING:
+            self.release_ledge()
+        elif (self.grounded and self.state != PlayerState.STUNNED and
+              collision.passable(self.x, self.y + self.height)):
+            # One pixel below the top is past it for the next landing test
+            self.y += 1
+            self.grounded = False
+
+    def move(self, direction):
+        if self.state in [PlayerState.STUNNED, PlayerState.HANGING]:
+            return
+
+        if direction == 'left':
+            self.vx = -self.speed
+            self.facing_right = False
+            if self.state == PlayerState.IDLE:
+                self.state = PlayerState.WALKING
+        elif direction == 'right':
+            self.vx = self.speed
+            self.facing_right = True
+            if self.state == PlayerState.IDLE:
+                self.state = PlayerState.WALKING
+        else:
+            self.vx *= 0.85
+            if abs(self.vx) < 0.5:
+                self.vx = 0
+                if self.state == PlayerState.WALKING:
+                    self.state = PlayerState.IDLE
+
+    def jump(self):
+        if self.state == PlayerState.STUNNED:
+            return
+
+        if self.jumps_left > 0:
+            if self.state == PlayerState.HANGING:
+                self.ledge_timer = LEDGE_REGRAB_FRAMES
+            self.vy = -self.jump_power
+            self.jumps_left -= 1
+            self.state = PlayerState.JUMPING
+
+    def attack(self, attack_type='neutral'):
+        if self.state in [PlayerState.STUNNED, PlayerState.ATTACKING, PlayerState.HANGING]:
+            return
+
+        self.state = PlayerState.ATTACKING
+        self.attack_move = self.moves.by_name[MOVE_NAMES.index(attack_type)]
+        # One more than the move's length: update() counts down before
+        # hitboxes are checked, so frame 1 sees length
+        self.attack_timer = self.moves.length[self.attack_move] + 1
+        self.hit_victims = frozenset()
+
+    def move_frame(self):
+        # Frame of the current attack, from 1
+        return self.moves.length[self.attack_move] + 1 - self.attack_timer
+
+    def hitbox(self, slot):
+        moves = self.moves
+        facing = self.facing_right
+        return (self.x + moves.left[facing][slot], self.y + moves.top[slot],
+                self.x + moves.right[facing][slot], self.y + moves.bottom[slot])
+
+    def shield(self, active):
+        if self.state in [PlayerState.STUNNED, PlayerState.HANGING]:
+            return
+
+        if active and self.shield_health > 0:
+            self.state = PlayerState.SHIELDING
+            self.shield_health -= 0.5
+        else:
+            if self.state == PlayerState.SHIELDING:
+                self.state = PlayerState.IDLE
+            if self.shield_health < 100:
+                self.shield_health += 0.3
+
+    def take_hit(self, damage, base_x, base_y, growth_x, growth_y):
+        # Knockback vectors already point the way the attacker faces
+        if self.invulnerable or self.state == PlayerState.SHIELDING:
+            if self.state == PlayerState.SHIELDING:
+                self.shield_health -= damage * 2
+            return
+
+        self.damage += damage
+
+        # N64-style knockback calculation
+        scale = (self.damage / 80) / self.weight
+        self.vx = base_x + growth_x * scale
+        self.vy = base_y + growth_y * scale
+
+        self.state = PlayerState.STUNNED
+        self.stun_timer = min(60, int(damage * 1.5))
+        self.invulnerable = True
+        self.invuln_timer = 60
+
+        # Add hit effect
+        self.particles.burst(self.x + self.width//2, self.y + self.height//2, self.rng)
+
+    def save_state(self):
+        # Flat tuple snapshot; cheap enough to take every frame for rollback
+        return _get_fighter_state(self)
+
+    def load_state(self, state):
+        self.__dict__.update(zip(FIGHTER_STATE_FIELDS, state))
+
+    def respawn(self, stage):
+        self.stocks -= 1
+        if self.stocks > 0:
+            spawn = self.rng.choice(stage.spawn_points)
+            self.x = spawn[0]
+            self.y = spawn[1]
+            self.vx = 0
+            self.vy = 0
+            self.damage = 0
+            self.grounded = False
+            self.state = PlayerState.IDLE
+            self.invulnerable = True
+            self.invuln_timer = 120
+
+# ============================================
+# MATCH SIMULATION
+# ============================================
+
+class Match:
+    def __init__(self, stage, characters, seed=None, make_fighter=Fighter, items=0, hazards=True):
+        # One seeded RNG drives everything random in the match, which
+        # makes a (stage, characters, seed, items, hazards, inputs) tuple
+        # bit-reproducible. items is the number of frames between item
+        # rain drops, 0 for none; with hazards off the stage plays static.
+        if seed is None:
+            seed = random.getrandbits(32)
+        self.seed = seed
+        self.rng = random.Random(seed)
+
+        self.stage = stage
+        self.characters = list(characters)
+        self.scenery = StageScenery(stage, self.rng)
+        self.particles = ParticlePool()
+        self.entities = EntityPool()
+        self.items = items
+        self.hazards = StageHazards(stage, len(characters), hazards)
+        self.players = []
+        spawns = stage.spawn_layout(len(characters))
+        for i, char_name in enumerate(characters):
+            spawn = spawns[i]
+            self.players.append(make_fighter(CHARACTER_ROSTER[char_name], spawn[0], spawn[1], i + 1,
+                                             self.rng, self.particles))
+        self.game_time = 0
+        self.over = False
+        self.collisions = CollisionWorld()
+
+        # Last frame's held bits, used to turn held input into presses
+        self.prev_inputs = [0] * len(self.players)
+
+    def step(self, inputs):
+        # inputs: one INPUT_* bitfield per player for this frame
+        for i, player in enumerate(self.players):
+            held = inputs[i]
+            pressed = held & ~self.prev_inputs[i]
+            self.prev_inputs[i] = held
+            if player.stocks > 0:
+                self.apply_input(player, held, pressed)
+                if pressed & INPUT_DOWN:
+                    self.hazards.drop(i, player)
+
+        # Update players; eliminated fighters sit out the rest of the match
+        self.hazards.tick(self.players)
+        for player in self.players:
+            if player.stocks > 0:
+                player.update(self.stage)
+        self.hazards.land(self.players)
+        self.entities.update(self.stage)
+        self.throw_projectiles()
+        if self.items and self.game_time % self.items == 0:
+            self.drop_item()
+        self.particles.update()
+        self.scenery.tick()
+
+        # Check collisions
+        self.check_attack_collisions()
+
+        # Check for game over: last fighter standing
+        if sum(1 for player in self.players if player.stocks > 0) <= 1:
+            self.over = True
+
+        self.game_time += 1
+
+    def apply_input(self, player, held, pressed):
+        if held & INPUT_LEFT:
+            player.move('left')
+        elif held & INPUT_RIGHT:
+            player.move('right')
+        else:
+            player.move('stop')
+
+        if pressed & INPUT_JUMP:
+            player.jump()
+
+        if pressed & INPUT_DOWN:
+            player.drop(self.stage.collision)
+
+        if held & INPUT_DOWN and not player.grounded:
+            player.fast_falling = True
+
+        if pressed & INPUT_ATTACK:
+            player.attack(MOVE_NAMES[attack_kind(held, player.grounded)])
+
+        player.shield(bool(held & INPUT_SHIELD))
+
+    def throw_projectiles(self):
+        # Moves throw their projectile on one frame of the attack, from
+        # the front of the fighter
+        for i, player in enumerate(self.players):
+            if player.stocks <= 0 or player.state != PlayerState.ATTACKING:
+                continue
+            moves = player.moves
+            move = player.attack_move
+            if moves.projectile_frame[move] != player.move_frame():
+                continue
+            kind = moves.projectile_kind[move]
+            k = ENTITY_KINDS[kind]
+            if player.facing_right:
+                x = player.x + player.width + moves.projectile_x[move]
+                vx = k.speed
+            else:
+                x = player.x - moves.projectile_x[move] - k.width
+                vx = -k.speed
+            self.entities.spawn(kind, i, x, player.y + moves.projectile_y[move], vx, k.lift, self.game_time)
+
+    def drop_item(self):
+        # Item rain: a random item falls in from above the main platform
+        kind = self.rng.choice(ITEM_KINDS)
+        k = ENTITY_KINDS[kind]
+        main = self.stage.platforms[0]
+        x = self.rng.uniform(main['x'], main['x'] + main['width'] - k.width)
+        vx = self.rng.choice((-k.speed, k.speed))
+        self.entities.spawn(kind, NO_OWNER, x, -k.height, vx, 0, self.game_time)
+
+    def check_attack_collisions(self):
+        world = self.collisions
+        world.clear()
+        for i, player in enumerate(self.players):
+            if player.stocks <= 0:
+                continue
+            world.add_hurtbox(player.x, player.y, player.x + player.width, player.y + player.height, i)
+            if player.state == PlayerState.ATTACKING:
+                for slot in player.moves.slots(player.attack_move, player.move_frame()):
+                    world.add_hitbox(*player.hitbox(slot), i, slot)
+        entities = self.entities
+        entities.add_hitboxes(world)
+        self.hazards.add_hitboxes(world)
+
+        # Pairs come back in (attacker, defender) order; of one attacker's
+        # hitboxes on a defender the lowest slot wins. Hazard touches are
+        # settled after every move hit, then entity touches.
+        hits = {}
+        touches = []
+        hazards = {}
+        for i, j, slot, hurtbox in world.overlaps():
+            if i == HAZARD_OWNER:
+                if hazards.get(j, slot) >= slot:
+                    hazards[j] = slot
+            elif slot < 0:
+                touches.append((j, ~slot))
+            elif hits.get((i, j), slot) >= slot:
+                hits[i, j] = slot
+
+        # A hit can stun an attacker before its own pair is reached, so
+        # re-check its state
+        for (i, j), slot in hits.items():
+            attacker = self.players[i]
+            if attacker.state != PlayerState.ATTACKING or j in attacker.hit_victims:
+                continue
+            attacker.hit_victims = attacker.hit_victims | {j}
+            moves = attacker.moves
+            sign = 1 if attacker.facing_right else -1
+            self.players[j].take_hit(moves.damage[slot], moves.base_x[slot] * sign, moves.base_y[slot],
+                                     moves.growth_x[slot] * sign, moves.growth_y[slot])
+
+        for j in sorted(hazards):
+            self.hazards.strike(self.players[j], hazards[j])
+
+        if not touches:
+            return
+        # Each entity is spent on the first fighter it can strike; each
+        # struck fighter takes the hit of its first entity
+        struck = {}
+        for j, s in touches:
+            if s not in struck and not self.players[j].invulnerable:
+                struck[s] = j
+        first = {}
+        for s, j in struck.items():
+            key = (entities.owner[s], entities.born[s], s)
+            if j not in first or key < first[j]:
+                first[j] = key
+        for j in sorted(first):
+            entities.strike(self.players[j], first[j][2])
+        for s in struck:
+            entities.kill(s)
+
+    def save_state(self):
+        # Everything step() reads or writes, as immutable tuples
+        return (self.game_time, self.over, tuple(self.prev_inputs), self.rng.getstate(),
+                tuple(tuple(b) for b in self.scenery.bubbles),
+                tuple(p.save_state() for p in self.players), self.particles.save_state(),
+                self.entities.save_state(), self.hazards.save_state())
+
+    def load_state(self, state):
+        game_time, over, prev_inputs, rng_state, bubbles, players, particles, entities, hazards = state
+        self.game_time = game_time
+        self.over = over
+        self.prev_inputs = list(prev_inputs)
+        self.rng.setstate(rng_state)
+        self.scenery.bubbles = [list(b) for b in bubbles]
+        for p, fighter_state in zip(self.players, players):
+            p.load_state(fighter_state)
+        self.particles.load_state(particles)
+        self.entities.load_state(entities)
+        self.hazards.load_state(hazards)
+
+    def winner(self):
+        for player in self.players:
+            if player.stocks > 0:
+                return player
+        return None
+
+    def get_state(self):
+        # Plain-data view of the match for servers and tools
+        return {
+            'frame': self.game_time,
+            'stage': self.stage.stage_id,
+            'seed': self.seed,
+            'over': self.over,
+            'entities': len(self.entities),
+            'players': [
+                {'name': p.name, 'x': p.x, 'y': p.y, 'vx': p.vx, 'vy': p.vy,
+                 'damage': p.damage, 'stocks': p.stocks, 'state': p.state.name,
+                 'facing_right': p.facing_right}
+                for p in self.players
+            ],
+        }
+
+# ============================================
+# FIXED TIMESTEP
+# ============================================
+
+class FixedTimestep:
+    # Turns variable wall-clock frame times into a whole number of
+    # simulation ticks. Leftover time carries over to the next frame and
+    # max_steps stops a long stall from spiralling into catch-up work.
+    def __init__(self, fps=FPS, max_steps=5):
+        self.step_time = 1.0 / fps
+        self.max_steps = max_steps
+        self.accumulator = 0.0
+
+    def reset(self):
+        self.accumulator = 0.0
+
+    def advance(self, dt):
+        self.accumulator += dt
+        steps = int(self.accumulator / self.step_time)
+        if steps > self.max_steps:
+            steps = self.max_steps
+            self.accumulator = 0.0
+        else:
+            self.accumulator -= steps * self.step_time
+        return steps
+
+    @property
+    def alpha(self):
+        # Fraction of a tick left over, for render interpolation
+        return self.accumulator / self.step_time
+
+def run_headless(match, input_source, max_frames=None):
+    # Steps a match as fast as possible without any display.
+    # input_source(match) returns the per-player input list for the next frame.
+    frames = 0
+    while not match.over and (max_frames is None or frames < max_frames):
+        match.step(input_source(match))
+        frames += 1
+    return frames
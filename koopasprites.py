@@ -0,0 +1,298 @@
+import hashlib
+import math
+import os
+import sys
+
+import pygame
+
+from koopacontent import cache_dir
+from koopasim import PlayerState, FIGHTER_WIDTH, FIGHTER_HEIGHT, WHITE, BLACK
+
+# ============================================
+# FIGHTER SPRITES
+# ============================================
+# Each character is drawn from one texture atlas. Every PlayerState has an
+# animation clip, and every clip frame is painted once into the atlas in
+# both facings and in the white invulnerability flash, so drawing any
+# fighter is one blit of an atlas area and never a transform.flip. The
+# front-end gathers all fighters into a single Surface.blits call.
+#
+# The layout depends only on CLIPS and the cell size, so the atlas image
+# is the only thing cached: a PNG in the build cache named by a hash of the
+# character's look and SPRITE_VERSION. python -m koopasprites builds every
+# roster atlas ahead of time; a missing one is built on first use.
+#
+# Cells are a fighter's body plus a margin that is wider in front, where
+# arms reach out. Left-facing cells are mirror images, so their body sits
+# the other side of the cell.
+
+SPRITE_VERSION = 1   # bump when the painters change
+SPRITE_BACK = 4      # margin behind the body
+SPRITE_FRONT = 24    # margin in front of it, for reaching arms
+SPRITE_TOP = 8
+SPRITE_BOTTOM = 8
+CELL_SIZE = (FIGHTER_WIDTH + SPRITE_BACK + SPRITE_FRONT, FIGHTER_HEIGHT + SPRITE_TOP + SPRITE_BOTTOM)
+ATLAS_COLUMNS = 16
+FLASH_PERIOD = 12    # invulnerable fighters flash white half of every period
+LEG_LENGTH = 14      # of the fighter's height, below the torso
+
+# state -> (frames, ticks per frame, loops)
+CLIPS = {
+    PlayerState.IDLE: (4, 8, True),
+    PlayerState.WALKING: (6, 5, True),
+    PlayerState.RUNNING: (6, 3, True),
+    PlayerState.JUMPING: (3, 4, False),
+    PlayerState.FALLING: (2, 8, True),
+    PlayerState.ATTACKING: (4, 5, False),  # spread over the move's length instead
+    PlayerState.STUNNED: (2, 4, True),
+    PlayerState.SHIELDING: (1, 1, False),
+    PlayerState.DODGING: (4, 3, False),
+    PlayerState.GRABBING: (3, 4, False),
+    PlayerState.THROWN: (4, 3, True),
+    PlayerState.HANGING: (2, 15, True),
+}
+
+def atlas_layout():
+    # -> (atlas size, {(state, facing_right, flash): (Rect, ...)}); cells
+    # are packed in order along rows of ATLAS_COLUMNS
+    width, height = CELL_SIZE
+    frames = {}
+    index = 0
+    for flash in (False, True):
+        for facing_right in (True, False):
+            for state, (count, ticks, loops) in CLIPS.items():
+                rects = []
+                for i in range(count):
+                    row, column = divmod(index, ATLAS_COLUMNS)
+                    rects.append(pygame.Rect(column * width, row * height, width, height))
+                    index += 1
+                frames[state, facing_right, flash] = tuple(rects)
+    rows = -(-index // ATLAS_COLUMNS)
+    return (ATLAS_COLUMNS * width, rows * height), frames
+
+ATLAS_SIZE, ATLAS_FRAMES = atlas_layout()
+
+# Where a cell goes relative to the fighter's body, per facing
+CELL_OFFSETS = {True: (-SPRITE_BACK, -SPRITE_TOP), False: (-SPRITE_FRONT, -SPRITE_TOP)}
+
+# ============================================
+# POSES
+# ============================================
+# A pose is (body dx, dy, dw, dh, arm reach (x, y) from the shoulder, feet
+# x offsets (front, back), feet lift), facing right; dy moves only the top
+# of the body and dh only its bottom. Pose functions get the frame index
+# and the clip length.
+
+def pose_idle(i, count):
+    bob = (0, 1, 2, 1)[i]
+    return 0, bob, 0, 0, (8, 12), (6, -6), 0
+
+def pose_walking(i, count):
+    swing = round(8 * math.sin(2 * math.pi * i / count))
+    return 0, abs(swing) // 4, 0, 0, (6 - swing // 2, 12), (swing, -swing), 0
+
+def pose_running(i, count):
+    swing = round(14 * math.sin(2 * math.pi * i / count))
+    return 3, abs(swing) // 5, 0, -2, (14, 2 - swing // 3), (swing, -swing), abs(swing) // 3
+
+def pose_jumping(i, count):
+    stretch = (4, 6, 2)[i]
+    return 1, -stretch, -2, 0, (6, -18), (4, -4), 10 - 3 * i
+
+def pose_falling(i, count):
+    return 0, 0, 0, 0, (14, -6 + 4 * i), (10, -10), 0
+
+def pose_attacking(i, count):
+    lean = (0, 2, 4, 1)[i]
+    return lean, 0, 0, 0, ((4, 4), (14, 0), (26, -2), (10, 6))[i], (10, -8), 0
+
+def pose_stunned(i, count):
+    shake = (-2, 2)[i]
+    return shake, 2, 0, -2, (-6, -16 + 4 * i), (4, -4), 0
+
+def pose_shielding(i, count):
+    return -1, 6, 2, -6, (10, 2), (8, -8), 0
+
+def pose_dodging(i, count):
+    squash = (4, 10, 10, 4)[i]
+    return 0, squash, 4, -squash, (2, 6), (6, -6), squash // 2
+
+def pose_grabbing(i, count):
+    return (1, 3, 3)[i], 0, 0, 0, ((10, 2), (20, 0), (24, 2))[i], (8, -8), 0
+
+def pose_thrown(i, count):
+    angle = 2 * math.pi * i / count
+    return round(3 * math.cos(angle)), round(3 * math.sin(angle)), 0, 0, \
+        (round(12 * math.cos(angle)), round(-12 * math.sin(angle))), (12, -12), 6
+
+def pose_hanging(i, count):
+    return 0, 0, 0, 0, (4 + 2 * i, -20), (2, -2 + 2 * i), -4
+
+POSES = {
+    PlayerState.IDLE: pose_idle,
+    PlayerState.WALKING: pose_walking,
+    PlayerState.RUNNING: pose_running,
+    PlayerState.JUMPING: pose_jumping,
+    PlayerState.FALLING: pose_falling,
+    PlayerState.ATTACKING: pose_attacking,
+    PlayerState.STUNNED: pose_stunned,
+    PlayerState.SHIELDING: pose_shielding,
+    PlayerState.DODGING: pose_dodging,
+    PlayerState.GRABBING: pose_grabbing,
+    PlayerState.THROWN: pose_thrown,
+    PlayerState.HANGING: pose_hanging,
+}
+
+def shade(color, amount):
+    return tuple(int(c * amount) for c in color[:3])
+
+def paint_frame(surface, origin, color, pose):
+    # One right-facing frame with the body's top-left at origin
+    dx, dy, dw, dh, (reach_x, reach_y), (front, back), lift = pose
+    dark = shade(color, 0.55)
+    x = origin[0] + dx
+    y = origin[1] + dy
+    body = pygame.Rect(x, y, FIGHTER_WIDTH + dw, FIGHTER_HEIGHT - LEG_LENGTH - dy + dh)
+    feet = origin[1] + FIGHTER_HEIGHT - 3 - lift
+    hip = body.bottom - 4
+
+    # Legs behind the torso
+    pygame.draw.line(surface, dark, (body.centerx - 8, hip), (body.centerx - 8 + back, feet), 6)
+    pygame.draw.line(surface, dark, (body.centerx + 8, hip), (body.centerx + 8 + front, feet), 6)
+
+    pygame.draw.rect(surface, color, body, border_radius=8)
+    pygame.draw.rect(surface, dark, body, 2, border_radius=8)
+
+    # Eye toward the front, where the old flat rendering had it
+    eye = (body.right - 10, body.top + 15)
+    pygame.draw.circle(surface, WHITE, eye, 5)
+    pygame.draw.circle(surface, BLACK, (eye[0] + 1, eye[1]), 2)
+
+    # Front arm over the body
+    shoulder = (body.centerx + 6, body.top + 24)
+    hand = (shoulder[0] + reach_x, shoulder[1] + reach_y)
+    pygame.draw.line(surface, dark, shoulder, hand, 6)
+    pygame.draw.circle(surface, color, hand, 5)
+    pygame.draw.circle(surface, dark, hand, 5, 1)
+
+def build_atlas(color):
+    # Paints every frame; safe on a worker thread as it touches nothing shared
+    atlas = pygame.Surface(ATLAS_SIZE, pygame.SRCALPHA)
+    for flash in (False, True):
+        paint_color = WHITE if flash else color
+        for state, (count, ticks, loops) in CLIPS.items():
+            right = ATLAS_FRAMES[state, True, flash]
+            left = ATLAS_FRAMES[state, False, flash]
+            for i in range(count):
+                cell = right[i]
+                atlas.set_clip(cell)
+                paint_frame(atlas, (cell.x + SPRITE_BACK, cell.y + SPRITE_TOP), paint_color,
+                            POSES[state](i, count))
+                atlas.set_clip(None)
+                atlas.blit(pygame.transform.flip(atlas.subsurface(cell), True, False), left[i])
+    return atlas
+
+# ============================================
+# ATLAS CACHE
+# ============================================
+
+def atlas_path(color):
+    h = hashlib.sha256(repr((SPRITE_VERSION, CELL_SIZE, ATLAS_COLUMNS, tuple(color[:3]),
+                             [(state.name, clip) for state, clip in CLIPS.items()])).encode())
+    return os.path.join(cache_dir(), "sprites", f"fighter-{h.hexdigest()[:16]}.png")
+
+def save_atlas(atlas, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp.png"
+    try:
+        pygame.image.save(atlas, tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def load_atlas(character):
+    # The cached atlas for a CharacterData, built and saved if missing or
+    # stale. Runs on an asset worker.
+    path = atlas_path(character.color)
+    try:
+        atlas = pygame.image.load(path)
+        if atlas.get_size() == ATLAS_SIZE:
+            return atlas
+    except (OSError, pygame.error):
+        pass
+    atlas = build_atlas(character.color)
+    try:
+        save_atlas(atlas, path)
+    except (OSError, pygame.error):
+        pass  # read-only install: build again next time
+    return atlas
+
+# ============================================
+# ANIMATION
+# ============================================
+
+class FighterAnimator:
+    # Picks each fighter's atlas frame. A clip restarts whenever a fighter
+    # changes state; the clock is the match's frame counter, so animation
+    # pauses, rolls back and replays along with the simulation.
+    def __init__(self):
+        self.match = None
+        self.clips = {}  # fighter -> (state, frame the clip started)
+
+    def blit(self, atlas, fighter, clock):
+        # (atlas, dest, area) for Surface.blits
+        state = fighter.state
+        clip = self.clips.get(fighter)
+        if clip is None or clip[0] is not state:
+            clip = self.clips[fighter] = (state, clock)
+        count, ticks, loops = CLIPS[state]
+        if state is PlayerState.ATTACKING:
+            # In step with the attack itself, however long it lasts
+            length = fighter.moves.length[fighter.attack_move]
+            index = min(count - 1, max(0, (fighter.move_frame() - 1) * count // length))
+        else:
+            index = (clock - clip[1]) // ticks
+            index = index % count if loops else min(index, count - 1)
+        flash = fighter.invulnerable and fighter.invuln_timer % FLASH_PERIOD < FLASH_PERIOD // 2
+        facing_right = fighter.facing_right
+        offset_x, offset_y = CELL_OFFSETS[facing_right]
+        return atlas, (fighter.x + offset_x, fighter.y + offset_y), ATLAS_FRAMES[state, facing_right, flash][index]
+
+    def follow(self, match):
+        # Forget the fighters of an earlier match
+        if match is not self.match:
+            self.match = match
+            self.clips.clear()
+
+# ============================================
+# COMMAND LINE
+# ============================================
+# python -m koopasprites
+# builds the atlas of every roster character into the cache.
+
+def main(argv=None):
+    import argparse
+    from koopasim import CHARACTER_ROSTER
+    parser = argparse.ArgumentParser(description="Build the fighter sprite atlases")
+    parser.add_argument("characters", nargs="*", metavar="KEY", help="roster keys to build (default: all)")
+    parser.add_argument("--force", action="store_true", help="rebuild atlases that are already cached")
+    args = parser.parse_args(argv)
+
+    for key in args.characters:
+        if key not in CHARACTER_ROSTER:
+            parser.error(f"unknown character {key!r}")
+    for key in args.characters or CHARACTER_ROSTER:
+        character = CHARACTER_ROSTER[key]
+        path = atlas_path(character.color)
+        if args.force or not os.path.exists(path):
+            atlas = build_atlas(character.color)
+            save_atlas(atlas, path)
+            status = "built"
+        else:
+            status = "cached"
+        print(f"{key:<12}{status:<8}{path}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,735 @@
+import random
+
+import numpy as np
+
+from koopasim import (
+    STAGES, CHARACTER_ROSTER, GRAVITY, MAX_FALL_SPEED, PlayerState, Fighter, FIGHTER_STATE_FIELDS,
+    ParticlePool, ENTITY_KINDS, MOTIONS,
+    LEDGE_REACH, LEDGE_HANG_FRAMES, LEDGE_REGRAB_FRAMES, MOVE_NAMES,
+    INPUT_LEFT, INPUT_RIGHT, INPUT_JUMP, INPUT_DOWN, INPUT_ATTACK, INPUT_SHIELD,
+)
+
+# ============================================
+# BATCHED SIMULATION - STRUCTURE OF ARRAYS
+# ============================================
+# Runs thousands of independent matches in lockstep. Every fighter field
+# is a column in a (matches, fighters) NumPy array and one step() applies
+# the same rules as Match.step / Fighter.update to all rows at once.
+#
+# FighterView is a Fighter whose fields read and write one row of the
+# store, so scalar code (Fighter.update, the renderer) still works on any
+# fighter in the batch.
+#
+# Thrown projectiles live in (matches, entity_capacity) columns, where a
+# slot is free while its life is 0. Matches whose projectiles outnumber
+# the slots drop the extra ones, as a full EntityPool would. Item rain is
+# not simulated, and stages play static, as in Match(hazards=False): no
+# hazards and no moving platforms.
+
+ENTITY_BATCH_CAPACITY = 32  # projectile slots per match
+
+IDLE = PlayerState.IDLE.value
+WALKING = PlayerState.WALKING.value
+JUMPING = PlayerState.JUMPING.value
+FALLING = PlayerState.FALLING.value
+ATTACKING = PlayerState.ATTACKING.value
+STUNNED = PlayerState.STUNNED.value
+SHIELDING = PlayerState.SHIELDING.value
+DODGING = PlayerState.DODGING.value
+HANGING = PlayerState.HANGING.value
+
+# Column name -> dtype. Covers the snapshot fields plus the per-fighter
+# stats the physics step reads.
+ROW_FIELDS = {
+    'x': np.float64,
+    'y': np.float64,
+    'vx': np.float64,
+    'vy': np.float64,
+    'damage': np.float64,
+    'stocks': np.int32,
+    'state': np.int8,
+    'facing_right': np.bool_,
+    'invulnerable': np.bool_,
+    'invuln_timer': np.int32,
+    'jumps_left': np.int32,
+    'fast_falling': np.bool_,
+    'attack_timer': np.int32,
+    'stun_timer': np.int32,
+    'shield_health': np.float64,
+    'dodge_timer': np.int32,
+    'hit_victims': np.uint32,
+    'grounded': np.bool_,
+    'ledge_timer': np.int32,
+    'width': np.float64,
+    'height': np.float64,
+    'speed': np.float64,
+    'jump_power': np.float64,
+    'weight': np.float64,
+    'fall_speed_multiplier': np.float64,
+    'max_jumps': np.int32,
+    'attack_move': np.int32,
+}
+
+class MoveColumns:
+    # The MoveTable columns of every character in a batch, concatenated
+    # into arrays. Each table's moves start at its entry in base; rows and
+    # slots are renumbered to match, so one gather serves every fighter.
+    def __init__(self, tables):
+        self.base = {}
+        columns = {name: [] for name in ('length', 'frame_base', 'first', 'count', 'left_r', 'left_l',
+                                         'right_r', 'right_l', 'top', 'bottom', 'damage',
+                                         'base_x', 'base_y', 'growth_x', 'growth_y',
+                                         'projectile_kind', 'projectile_frame', 'projectile_x',
+                                         'projectile_y')}
+        moves = rows = slots = 0
+        for table in tables:
+            if id(table) in self.base:
+                continue
+            self.base[id(table)] = moves
+            columns['length'].extend(table.length)
+            columns['frame_base'].extend(b + rows for b in table.frame_base)
+            columns['first'].extend(f + slots for f in table.first)
+            columns['count'].extend(table.count)
+            columns['left_r'].extend(table.left[True])
+            columns['left_l'].extend(table.left[False])
+            columns['right_r'].extend(table.right[True])
+            columns['right_l'].extend(table.right[False])
+            for name in ('top', 'bottom', 'damage', 'base_x', 'base_y', 'growth_x', 'growth_y',
+                         'projectile_kind', 'projectile_frame', 'projectile_x', 'projectile_y'):
+                columns[name].extend(getattr(table, name))
+            moves += len(table.length)
+            rows += len(table.first)
+            slots += len(table.top)
+        for name, values in columns.items():
+            dtype = (np.int64 if name in ('length', 'frame_base', 'first', 'count', 'projectile_kind',
+                                          'projectile_frame') else np.float64)
+            setattr(self, name, np.array(values, dtype=dtype))
+        # Most hitboxes live on any one frame
+        self.max_slots = int(self.count.max()) if rows else 0
+
+class KindColumns:
+    # ENTITY_KINDS as arrays indexed by kind, with each kind's motion as an
+    # index into MOTIONS
+    def __init__(self, kinds):
+        for name in ('width', 'height', 'gravity', 'bounce', 'damage', 'base_x', 'base_y',
+                     'growth_x', 'growth_y'):
+            setattr(self, name, np.array([getattr(k, name) for k in kinds], dtype=np.float64))
+        self.speed = np.array([k.speed for k in kinds], dtype=np.float64)
+        self.lift = np.array([k.lift for k in kinds], dtype=np.float64)
+        self.life = np.array([k.life for k in kinds], dtype=np.int32)
+        self.motion = np.array([list(MOTIONS).index(k.motion) for k in kinds], dtype=np.int64)
+
+class FighterStore:
+    def __init__(self, n_matches, fighters_per_match):
+        self.shape = (n_matches, fighters_per_match)
+        for name, dtype in ROW_FIELDS.items():
+            setattr(self, name, np.zeros(self.shape, dtype=dtype))
+
+    def factory(self, match_index):
+        # A make_fighter callable for Match that places fighters in this
+        # store's row for match_index
+        def make_fighter(character_data, x, y, player_num, rng=None, particles=None):
+            return FighterView(self, match_index, player_num - 1, character_data, x, y, player_num,
+                               rng, particles)
+        return make_fighter
+
+def _row_property(name, dtype):
+    if name == 'state':
+        def get(self):
+            return PlayerState(int(self.store.state[self.row]))
+        def set(self, value):
+            self.store.state[self.row] = value.value
+    elif name == 'hit_victims':
+        # Stored as a bitmask of player indices
+        def get(self):
+            mask = int(self.store.hit_victims[self.row])
+            return frozenset(i for i in range(mask.bit_length()) if mask >> i & 1)
+        def set(self, value):
+            self.store.hit_victims[self.row] = sum(1 << i for i in value)
+    else:
+        cast = bool if dtype is np.bool_ else int if np.issubdtype(dtype, np.integer) else float
+        def get(self):
+            return cast(getattr(self.store, name)[self.row])
+        def set(self, value):
+            getattr(self.store, name)[self.row] = value
+    return property(get, set)
+
+class FighterView(Fighter):
+    def __init__(self, store, match_index, slot, character_data, x, y, player_num, rng=None, particles=None):
+        self.store = store
+        self.row = (match_index, slot)
+        super().__init__(character_data, x, y, player_num, rng, particles)
+
+    def load_state(self, state):
+        for name, value in zip(FIGHTER_STATE_FIELDS, state):
+            setattr(self, name, value)
+
+for _name, _dtype in ROW_FIELDS.items():
+    setattr(FighterView, _name, _row_property(_name, _dtype))
+
+# BatchSim columns outside the fighter store that save_state covers
+_BATCH_STATE_FIELDS = ('e_kind', 'e_owner', 'e_x', 'e_y', 'e_vx', 'e_vy', 'e_life', 'e_born',
+                       'game_time', 'over', 'prev_inputs')
+
+class BatchSim:
+    def __init__(self, stage_ids, characters, seed=0, entity_capacity=ENTITY_BATCH_CAPACITY):
+        # stage_ids: one stage id per match
+        # characters: one list of roster keys per match, all the same length
+        n = len(stage_ids)
+        per_match = len(characters[0])
+        if len(characters) != n or any(len(c) != per_match for c in characters):
+            raise ValueError("every match needs a character list of the same length")
+
+        self.n_matches = n
+        self.store = FighterStore(n, per_match)
+        self.np_rng = np.random.default_rng(seed)
+
+        # Rows are initialised by the scalar Fighter constructor
+        shared_rng = random.Random(seed)
+        # The vectorised step emits no hit sparks; one pool serves any
+        # scalar updates made through the views
+        shared_particles = ParticlePool()
+        self.fighters = []
+        for m, (stage_id, chars) in enumerate(zip(stage_ids, characters)):
+            stage = STAGES[stage_id]
+            make = self.store.factory(m)
+            spawns = stage.spawn_layout(len(chars))
+            row = []
+            for i, key in enumerate(chars):
+                spawn = spawns[i]
+                row.append(make(CHARACTER_ROSTER[key], spawn[0], spawn[1], i + 1, shared_rng, shared_particles))
+            self.fighters.append(row)
+
+        # Per-match stage geometry from each stage's compiled platform
+        # index, padded to the busiest stage. Platforms keep the index's
+        # order so ties resolve the same way as the scalar queries.
+        stages = [STAGES[s] for s in stage_ids]
+        max_platforms = max(len(s.collision.platforms) for s in stages)
+        max_ledges = max(1, max(len(s.collision.ledges) for s in stages))
+        max_spawns = max(len(s.spawn_points) for s in stages)
+        self.blast_zones = np.array([s.blast_zones for s in stages], dtype=np.float64)
+        self.plat_left = np.full((n, max_platforms), np.inf)
+        self.plat_right = np.full((n, max_platforms), -np.inf)
+        self.plat_top = np.zeros((n, max_platforms))
+        self.plat_bottom = np.zeros((n, max_platforms))
+        self.plat_solid = np.zeros((n, max_platforms), dtype=np.bool_)
+        self.ledge_x = np.zeros((n, max_ledges))
+        self.ledge_y = np.zeros((n, max_ledges))
+        self.ledge_facing = np.zeros((n, max_ledges), dtype=np.bool_)
+        self.ledge_valid = np.zeros((n, max_ledges), dtype=np.bool_)
+        self.spawns = np.zeros((n, max_spawns, 2))
+        self.spawn_count = np.array([len(s.spawn_points) for s in stages])
+        for m, stage in enumerate(stages):
+            for p, (left, top, right, bottom, solid) in enumerate(stage.collision.platforms):
+                self.plat_left[m, p] = left
+                self.plat_right[m, p] = right
+                self.plat_top[m, p] = top
+                self.plat_bottom[m, p] = bottom
+                self.plat_solid[m, p] = solid
+            for l, (x, y, facing_right) in enumerate(stage.collision.ledges):
+                self.ledge_x[m, l] = x
+                self.ledge_y[m, l] = y
+                self.ledge_facing[m, l] = facing_right
+                self.ledge_valid[m, l] = True
+            self.spawns[m, :len(stage.spawn_points)] = stage.spawn_points
+
+        # Move frame data: each fighter's first move in the shared columns,
+        # and its move for each attack kind (MOVE_NAMES order)
+        self.moves = MoveColumns(f.moves for row in self.fighters for f in row)
+        self.move_base = np.array([[self.moves.base[id(f.moves)] for f in row] for row in self.fighters],
+                                  dtype=np.int64)
+        self.move_by_kind = np.array([[f.moves.by_name for f in row] for row in self.fighters],
+                                     dtype=np.int32).reshape(n, per_match, len(MOVE_NAMES))
+
+        # Projectiles, one row of slots per match
+        self.kinds = KindColumns(ENTITY_KINDS)
+        shape = (n, entity_capacity)
+        self.e_kind = np.zeros(shape, dtype=np.int64)
+        self.e_owner = np.zeros(shape, dtype=np.int64)
+        self.e_x = np.zeros(shape)
+        self.e_y = np.zeros(shape)
+        self.e_vx = np.zeros(shape)
+        self.e_vy = np.zeros(shape)
+        self.e_life = np.zeros(shape, dtype=np.int32)
+        self.e_born = np.zeros(shape, dtype=np.int64)
+
+        self.game_time = np.zeros(n, dtype=np.int64)
+        self.over = np.zeros(n, dtype=np.bool_)
+        self.prev_inputs = np.zeros((n, per_match), dtype=np.uint8)
+
+    def step(self, inputs):
+        s = self.store
+        st = s.state
+        running = ~self.over
+        # Eliminated fighters sit out the rest of the match
+        act = running[:, None] & (s.stocks > 0)
+        held = np.asarray(inputs, dtype=np.uint8)
+        pressed = held & ~self.prev_inputs
+        self.prev_inputs = np.where(running[:, None], held, self.prev_inputs)
+
+        # ---- Match.apply_input ----
+        free = act & (st != STUNNED) & (st != HANGING)
+        left = free & ((held & INPUT_LEFT) != 0)
+        right = free & ~left & ((held & INPUT_RIGHT) != 0)
+        stop = free & ~left & ~right
+        s.vx[left] = -s.speed[left]
+        s.facing_right[left] = False
+        s.vx[right] = s.speed[right]
+        s.facing_right[right] = True
+        st[(left | right) & (st == IDLE)] = WALKING
+        s.vx[stop] *= 0.85
+        halt = stop & (np.abs(s.vx) < 0.5)
+        s.vx[halt] = 0
+        st[halt & (st == WALKING)] = IDLE
+
+        jump = act & ((pressed & INPUT_JUMP) != 0) & (st != STUNNED) & (s.jumps_left > 0)
+        s.ledge_timer[jump & (st == HANGING)] = LEDGE_REGRAB_FRAMES
+        s.vy[jump] = -s.jump_power[jump]
+        s.jumps_left[jump] -= 1
+        st[jump] = JUMPING
+
+        down = act & ((pressed & INPUT_DOWN) != 0)
+        let_go = down & (st == HANGING)
+        st[let_go] = FALLING
+        s.ledge_timer[let_go] = LEDGE_REGRAB_FRAMES
+        through = down & ~let_go & s.grounded & (st != STUNNED)
+        if through.any():
+            # Only the first platform exactly underfoot counts, as in
+            # PlatformIndex.passable
+            under = self._overlapping(s.x) & (self.plat_top[:, None, :] == (s.y + s.height)[:, :, None])
+            solid = np.take_along_axis(self.plat_solid, under.argmax(axis=2), axis=1)
+            through &= under.any(axis=2) & ~solid
+            s.y[through] += 1
+            s.grounded[through] = False
+
+        s.fast_falling[act & ((held & INPUT_DOWN) != 0) & ~s.grounded] = True
+
+        attack = act & ((pressed & INPUT_ATTACK) != 0) & (st != STUNNED) & (st != ATTACKING) & (st != HANGING)
+        if attack.any():
+            # The move follows attack_kind: air, then down, then forward
+            kind = np.where(~s.grounded, 3, np.where((held & INPUT_DOWN) != 0, 2,
+                                                     np.where((held & (INPUT_LEFT | INPUT_RIGHT)) != 0, 1, 0)))
+            move = np.take_along_axis(self.move_by_kind, kind[:, :, None], axis=2)[:, :, 0]
+            s.attack_move[attack] = move[attack]
+            s.attack_timer[attack] = self.moves.length[self.move_base + s.attack_move][attack] + 1
+            st[attack] = ATTACKING
+            s.hit_victims[attack] = 0
+
+        free = act & (st != STUNNED) & (st != HANGING)
+        shield_on = free & ((held & INPUT_SHIELD) != 0) & (s.shield_health > 0)
+        shield_off = free & ~shield_on
+        st[shield_on] = SHIELDING
+        s.shield_health[shield_on] -= 0.5
+        st[shield_off & (st == SHIELDING)] = IDLE
+        regen = shield_off & (s.shield_health < 100)
+        s.shield_health[regen] += 0.3
+
+        # ---- Fighter.update ----
+        inv = act & s.invulnerable
+        s.invuln_timer[inv] -= 1
+        s.invulnerable[inv & (s.invuln_timer <= 0)] = False
+
+        for timer, state in ((s.stun_timer, STUNNED), (s.attack_timer, ATTACKING)):
+            mask = act & (st == state)
+            timer[mask] -= 1
+            st[mask & (timer <= 0)] = IDLE
+
+        dodge = act & (st == DODGING)
+        s.dodge_timer[dodge] -= 1
+        done = dodge & (s.dodge_timer <= 0)
+        st[done] = IDLE
+        s.invulnerable[done] = False
+
+        # Hanging fighters only count down to letting go
+        hanging = act & (st == HANGING)
+        s.ledge_timer[hanging] -= 1
+        let_go = hanging & (s.ledge_timer <= 0)
+        st[let_go] = FALLING
+        s.ledge_timer[let_go] = LEDGE_REGRAB_FRAMES
+        act = act & ~hanging
+        s.ledge_timer[act & (s.ledge_timer > 0)] -= 1
+
+        # Gravity, clamped to each fighter's max fall speed
+        gravity = GRAVITY * s.fall_speed_multiplier
+        gravity = np.where(s.fast_falling, gravity * 2, gravity)
+        s.vy[act] = np.minimum(s.vy + gravity, MAX_FALL_SPEED * s.fall_speed_multiplier)[act]
+
+        # Horizontal movement, stopped by the sides of solid platforms
+        moving = act & (st != STUNNED) & (s.vx != 0)
+        x = np.where(moving, s.x + s.vx, s.x)
+        body_left = (self.plat_left[:, None, :] - s.width[:, :, None])
+        ahead = s.vx[:, :, None] > 0
+        walls = (moving[:, :, None] & self.plat_solid[:, None, :] & self._overlapping(x) &
+                 (self.plat_top[:, None, :] < (s.y + s.height)[:, :, None]) &
+                 (self.plat_bottom[:, None, :] > s.y[:, :, None]) &
+                 np.where(ahead, s.x[:, :, None] <= body_left,
+                          s.x[:, :, None] >= self.plat_right[:, None, :]))
+        blocked = walls.any(axis=2)
+        if blocked.any():
+            near_left = np.where(walls, body_left, np.inf).min(axis=2)
+            near_right = np.where(walls, self.plat_right[:, None, :], -np.inf).max(axis=2)
+            x = np.where(blocked, np.where(s.vx > 0, near_left, near_right), x)
+            s.vx[blocked] = 0
+        s.x[:] = x
+
+        # Vertical movement: land on platforms, bump solid undersides
+        prev_y = s.y.copy()
+        s.y[act] += s.vy[act]
+        s.grounded[act] = False
+        top = self.plat_top[:, None, :]
+        on = ((act & (s.vy > 0))[:, :, None] & self._overlapping(s.x) &
+              (top >= (prev_y + s.height)[:, :, None]) & (top <= (s.y + s.height)[:, :, None]))
+        landed = on.any(axis=2)
+        if landed.any():
+            highest = np.where(on, top, np.inf).min(axis=2)
+            s.y[landed] = (highest - s.height)[landed]
+            self._land(landed)
+        bottom = self.plat_bottom[:, None, :]
+        under = ((act & (s.vy < 0))[:, :, None] & self.plat_solid[:, None, :] & self._overlapping(s.x) &
+                 (bottom <= prev_y[:, :, None]) & (bottom >= s.y[:, :, None]))
+        bumped = under.any(axis=2)
+        if bumped.any():
+            lowest = np.where(under, bottom, -np.inf).max(axis=2)
+            s.y[bumped] = lowest[bumped]
+            s.vy[bumped] = 0
+
+        # Falling fighters catch the first ledge in reach
+        catch = act & (s.vy > 0) & (s.ledge_timer == 0) & (st != STUNNED)
+        if catch.any():
+            lx = self.ledge_x[:, None, :]
+            near = (catch[:, :, None] & self.ledge_valid[:, None, :] &
+                    (lx >= (s.x - LEDGE_REACH)[:, :, None]) & (lx <= (s.x + LEDGE_REACH)[:, :, None]) &
+                    (np.abs(self.ledge_y[:, None, :] - s.y[:, :, None]) <= LEDGE_REACH))
+            grab = near.any(axis=2)
+            if grab.any():
+                first = near.argmax(axis=2)
+                matches, slots = np.nonzero(grab)
+                ledge = first[matches, slots]
+                s.x[grab] = self.ledge_x[matches, ledge]
+                s.y[grab] = self.ledge_y[matches, ledge]
+                s.facing_right[grab] = self.ledge_facing[matches, ledge]
+                s.vx[grab] = 0
+                s.vy[grab] = 0
+                st[grab] = HANGING
+                s.ledge_timer[grab] = LEDGE_HANG_FRAMES
+                s.jumps_left[grab] = s.max_jumps[grab]
+                s.fast_falling[grab] = False
+
+        # Blast zones
+        bz = self.blast_zones
+        out = act & ((s.x < bz[:, 0:1]) | (s.x > bz[:, 1:2]) | (s.y < bz[:, 2:3]) | (s.y > bz[:, 3:4]))
+        if out.any():
+            self._respawn(out)
+
+        # ---- EntityPool.update, Match.throw_projectiles ----
+        self._update_entities(running)
+        self._throw_projectiles(running)
+
+        # ---- Match.check_attack_collisions ----
+        # Pairs run in (attacker, defender) order like the scalar resolver,
+        # because a hit changes the defender's state before the next pair.
+        # Each attack hits a given defender at most once, with the first
+        # of its live hitboxes that overlaps.
+        alive = running[:, None] & (s.stocks > 0)
+        fighters = s.shape[1]
+        mv = self.moves
+        for i in range(fighters):
+            attacking = alive[:, i] & (st[:, i] == ATTACKING)
+            if not attacking.any():
+                continue
+            # This frame's hitbox slots for every attacker: row of the
+            # (move, frame) pair, then up to max_slots boxes from it
+            move = self.move_base[:, i] + s.attack_move[:, i]
+            row = np.where(attacking, mv.frame_base[move] + mv.length[move] - s.attack_timer[:, i], 0)
+            count = np.where(attacking, mv.count[row], 0)
+            facing = s.facing_right[:, i]
+            boxes = []
+            for h in range(mv.max_slots):
+                live = count > h
+                if not live.any():
+                    break
+                slot = np.where(live, mv.first[row] + h, 0)
+                boxes.append((live, slot,
+                              s.x[:, i] + np.where(facing, mv.left_r[slot], mv.left_l[slot]),
+                              s.y[:, i] + mv.top[slot],
+                              s.x[:, i] + np.where(facing, mv.right_r[slot], mv.right_l[slot]),
+                              s.y[:, i] + mv.bottom[slot]))
+            for j in range(fighters):
+                if i == j:
+                    continue
+                # Re-checked per pair: an earlier hit can stun the attacker
+                open_pair = (alive[:, i] & (st[:, i] == ATTACKING) & alive[:, j] &
+                             ((s.hit_victims[:, i] >> j) & 1 == 0))
+                chosen = np.full(s.shape[0], -1, dtype=np.int64)
+                for live, slot, left, top, right, bottom in boxes:
+                    over = (open_pair & live & (chosen < 0) &
+                            (s.x[:, j] < right) & (s.x[:, j] + s.width[:, j] > left) &
+                            (s.y[:, j] < bottom) & (s.y[:, j] + s.height[:, j] > top))
+                    chosen[over] = slot[over]
+                hit = chosen >= 0
+                if hit.any():
+                    s.hit_victims[hit, i] |= np.uint32(1 << j)
+                    slot = np.maximum(chosen, 0)
+                    self._take_hit(j, hit, mv.damage[slot],
+                                   np.where(facing, mv.base_x[slot], -mv.base_x[slot]), mv.base_y[slot],
+                                   np.where(facing, mv.growth_x[slot], -mv.growth_x[slot]), mv.growth_y[slot])
+
+        # Entities strike after every move hit: each is spent on the first
+        # fighter it can strike, and each struck fighter takes the hit of
+        # its first entity in (owner, spawn frame) order
+        live = running[:, None] & (self.e_life > 0)
+        if live.any():
+            k = self.kinds
+            kind = self.e_kind
+            ex = self.e_x
+            ey = self.e_y
+            right = ex + k.width[kind]
+            bottom = ey + k.height[kind]
+            target = np.full(live.shape, -1, dtype=np.int64)
+            for j in range(fighters):
+                can = alive[:, j] & ~s.invulnerable[:, j]
+                touch = (live & (target < 0) & (self.e_owner != j) & can[:, None] &
+                         (s.x[:, j, None] < right) & ((s.x[:, j] + s.width[:, j])[:, None] > ex) &
+                         (s.y[:, j, None] < bottom) & ((s.y[:, j] + s.height[:, j])[:, None] > ey))
+                target[touch] = j
+            rows = np.arange(s.shape[0])
+            order = ((self.e_owner + 1) << 40) + self.e_born
+            for j in range(fighters):
+                mine = target == j
+                hit = mine.any(axis=1)
+                if not hit.any():
+                    continue
+                first = np.where(mine, order, np.iinfo(np.int64).max).argmin(axis=1)
+                kind = self.e_kind[rows, first]
+                away = s.x[:, j] + s.width[:, j] / 2 >= self.e_x[rows, first] + k.width[kind] / 2
+                self._take_hit(j, hit, k.damage[kind],
+                               np.where(away, k.base_x[kind], -k.base_x[kind]), k.base_y[kind],
+                               np.where(away, k.growth_x[kind], -k.growth_x[kind]), k.growth_y[kind])
+            self.e_life[target >= 0] = 0
+
+        # ---- Game over: last fighter standing ----
+        self.over |= running & ((s.stocks > 0).sum(axis=1) <= 1)
+        self.game_time[running] += 1
+
+    def _overlapping(self, x):
+        # (matches, fighters, platforms) mask of bodies at x overlapping
+        # each platform horizontally
+        s = self.store
+        return (((self.plat_left[:, None, :] - s.width[:, :, None]) < x[:, :, None]) &
+                (x[:, :, None] < self.plat_right[:, None, :]))
+
+    def _update_entities(self, running):
+        # Age every live entity, move it by its kind's motion, and free the
+        # ones that run out of life or leave the blast zones
+        live = running[:, None] & (self.e_life > 0)
+        if not live.any():
+            return
+        expired = live & (self.e_life <= 1)
+        self.e_life[expired] = 0
+        live &= ~expired
+        self.e_life[live] -= 1
+        motion = self.kinds.motion[self.e_kind]
+        for index, step in enumerate(_MOTION_STEPS):
+            mask = live & (motion == index)
+            if mask.any():
+                step(self, mask)
+        bz = self.blast_zones
+        out = live & ((self.e_x < bz[:, 0:1]) | (self.e_x > bz[:, 1:2]) |
+                      (self.e_y < bz[:, 2:3]) | (self.e_y > bz[:, 3:4]))
+        self.e_life[out] = 0
+
+    def _entity_landing(self, mask, prev_bottom, bottom):
+        # Top of the highest platform each masked entity's bottom crossed
+        # moving down, as in PlatformIndex.landing; inf where none. Only
+        # the masked slots are gathered: most of a batch's slots are free.
+        landing = np.full(mask.shape, np.inf)
+        m, e = np.nonzero(mask)
+        if len(m):
+            x = self.e_x[m, e][:, None]
+            width = self.kinds.width[self.e_kind[m, e]][:, None]
+            top = self.plat_top[m]
+            on = (((self.plat_left[m] - width) < x) & (x < self.plat_right[m]) &
+                  (top >= prev_bottom[m, e][:, None]) & (top <= bottom[m, e][:, None]))
+            landing[m, e] = np.where(on, top, np.inf).min(axis=1)
+        return landing
+
+    def _throw_projectiles(self, running):
+        s = self.store
+        mv = self.moves
+        k = self.kinds
+        for i in range(s.shape[1]):
+            move = self.move_base[:, i] + s.attack_move[:, i]
+            frame = mv.length[move] + 1 - s.attack_timer[:, i]
+            throw = (running & (s.stocks[:, i] > 0) & (s.state[:, i] == ATTACKING) &
+                     (mv.projectile_frame[move] == frame))
+            if not throw.any():
+                continue
+            # First free slot; a full row drops the throw
+            slot = (self.e_life > 0).argmin(axis=1)
+            throw &= self.e_life[np.arange(len(slot)), slot] == 0
+            m = np.nonzero(throw)[0]
+            e = slot[m]
+            move = move[m]
+            kind = mv.projectile_kind[move]
+            facing = s.facing_right[m, i]
+            self.e_kind[m, e] = kind
+            self.e_owner[m, e] = i
+            self.e_x[m, e] = np.where(facing, s.x[m, i] + s.width[m, i] + mv.projectile_x[move],
+                                      s.x[m, i] - mv.projectile_x[move] - k.width[kind])
+            self.e_y[m, e] = s.y[m, i] + mv.projectile_y[move]
+            self.e_vx[m, e] = np.where(facing, k.speed[kind], -k.speed[kind])
+            self.e_vy[m, e] = k.lift[kind]
+            self.e_life[m, e] = k.life[kind]
+            self.e_born[m, e] = self.game_time[m]
+
+    def _land(self, mask):
+        s = self.store
+        s.vy[mask] = 0
+        s.grounded[mask] = True
+        s.jumps_left[mask] = s.max_jumps[mask]
+        s.fast_falling[mask] = False
+        s.state[mask & ((s.state == JUMPING) | (s.state == FALLING))] = IDLE
+
+    def _respawn(self, mask):
+        s = self.store
+        s.stocks[mask] -= 1
+        alive = mask & (s.stocks > 0)
+        matches, slots = np.nonzero(alive)
+        if not len(matches):
+            return
+        choice = (self.np_rng.random(len(matches)) * self.spawn_count[matches]).astype(np.int64)
+        s.x[alive] = self.spawns[matches, choice, 0]
+        s.y[alive] = self.spawns[matches, choice, 1]
+        s.vx[alive] = 0
+        s.vy[alive] = 0
+        s.damage[alive] = 0
+        s.grounded[alive] = False
+        s.state[alive] = IDLE
+        s.invulnerable[alive] = True
+        s.invuln_timer[alive] = 120
+
+    def _take_hit(self, j, mask, damage, base_x, base_y, growth_x, growth_y):
+        # damage and knockback are per-match arrays from the attacker's hitbox
+        s = self.store
+        shielding = s.state[:, j] == SHIELDING
+        blocked = mask & (s.invulnerable[:, j] | shielding)
+        s.shield_health[blocked & shielding, j] -= (damage * 2)[blocked & shielding]
+        hit = mask & ~blocked
+        if not hit.any():
+            return
+        s.damage[hit, j] += damage[hit]
+
+        # N64-style knockback calculation
+        scale = (s.damage[:, j] / 80) / s.weight[:, j]
+        s.vx[hit, j] = (base_x + growth_x * scale)[hit]
+        s.vy[hit, j] = (base_y + growth_y * scale)[hit]
+        s.state[hit, j] = STUNNED
+        s.stun_timer[hit, j] = np.minimum(60, (damage * 1.5).astype(np.int32))[hit]
+        s.invulnerable[hit, j] = True
+        s.invuln_timer[hit, j] = 60
+
+    def load_match(self, match, rows=slice(None)):
+        # Copy a scalar Match's state into some rows (all by default), to
+        # play on from there. The match must have the same characters in
+        # the same order; hazards and item rain stay behind, and projectiles
+        # past entity_capacity are dropped.
+        s = self.store
+        for i, p in enumerate(match.players):
+            for name in FIGHTER_STATE_FIELDS:
+                value = getattr(p, name)
+                if name == 'state':
+                    value = value.value
+                elif name == 'hit_victims':
+                    value = sum(1 << v for v in value)
+                getattr(s, name)[rows, i] = value
+        pool = match.entities
+        self.e_life[rows] = 0
+        for e, slot in enumerate(pool.live[:self.e_life.shape[1]]):
+            self.e_kind[rows, e] = pool.kind[slot]
+            self.e_owner[rows, e] = pool.owner[slot]
+            self.e_x[rows, e] = pool.x[slot]
+            self.e_y[rows, e] = pool.y[slot]
+            self.e_vx[rows, e] = pool.vx[slot]
+            self.e_vy[rows, e] = pool.vy[slot]
+            self.e_life[rows, e] = pool.life[slot]
+            self.e_born[rows, e] = pool.born[slot]
+        self.game_time[rows] = match.game_time
+        self.over[rows] = match.over
+        self.prev_inputs[rows] = match.prev_inputs
+
+    def save_state(self):
+        # Copies of every column that changes during a match
+        s = self.store
+        return (tuple(getattr(s, name).copy() for name in ROW_FIELDS) +
+                tuple(getattr(self, name).copy() for name in _BATCH_STATE_FIELDS))
+
+    def load_state(self, state, rows=slice(None)):
+        # Put some rows (all by default) back as they were in a save_state
+        # snapshot of this batch, e.g. to restart finished matches
+        s = self.store
+        columns = [getattr(s, name) for name in ROW_FIELDS]
+        columns += [getattr(self, name) for name in _BATCH_STATE_FIELDS]
+        for column, saved in zip(columns, state):
+            column[rows] = saved[rows]
+
+    def run(self, policy, max_frames):
+        # policy(sim) -> (matches, fighters) uint8 input array
+        frames = 0
+        while frames < max_frames and not self.over.all():
+            self.step(policy(self))
+            frames += 1
+        return frames
+
+# ---- Entity motions, vectorised; same order and rules as MOTIONS ----
+
+def _move_straight(sim, mask):
+    sim.e_x[mask] += sim.e_vx[mask]
+    sim.e_y[mask] += sim.e_vy[mask]
+
+def _move_bounce(sim, mask):
+    k = sim.kinds
+    height = k.height[sim.e_kind]
+    sim.e_x[mask] += sim.e_vx[mask]
+    vy = np.where(mask, sim.e_vy + k.gravity[sim.e_kind], sim.e_vy)
+    y = sim.e_y
+    new_y = np.where(mask, y + vy, y)
+    top = sim._entity_landing(mask & (vy > 0), y + height, new_y + height)
+    landed = top < np.inf
+    new_y[landed] = (top - height)[landed]
+    vy[landed] = -k.bounce[sim.e_kind][landed]
+    sim.e_y = new_y
+    sim.e_vy = vy
+
+def _move_fall(sim, mask):
+    k = sim.kinds
+    height = k.height[sim.e_kind]
+    sim.e_x[mask] += sim.e_vx[mask]
+    vy = np.where(mask, np.minimum(sim.e_vy + k.gravity[sim.e_kind], MAX_FALL_SPEED), sim.e_vy)
+    y = sim.e_y
+    new_y = np.where(mask, y + vy, y)
+    top = sim._entity_landing(mask, y + height, new_y + height)
+    landed = top < np.inf
+    new_y[landed] = (top - height)[landed]
+    vy[landed] = 0
+    sim.e_y = new_y
+    sim.e_vy = vy
+
+_VEC_MOTIONS = {
+    'straight': _move_straight,
+    'bounce': _move_bounce,
+    'fall': _move_fall,
+}
+_MOTION_STEPS = tuple(_VEC_MOTIONS[name] for name in MOTIONS)
+
+def random_policy(seed=0, change_chance=0.1):
+    # Held buttons that change at random, like a mashing player
+    rng = np.random.default_rng(seed)
+    held = None
+    def policy(sim):
+        nonlocal held
+        if held is None:
+            held = np.zeros(sim.store.shape, dtype=np.uint8)
+        change = rng.random(sim.store.shape) < change_chance
+        held[change] = rng.integers(0, 64, size=int(change.sum()), dtype=np.uint8)
+        return held
+    return policy
@@ -0,0 +1,68 @@
+import random
+import struct
+
+from koopasim import STAGES, Match, INPUT_LEFT, INPUT_RIGHT, INPUT_JUMP, INPUT_ATTACK, INPUT_SHIELD
+from koopareplay import Replay, ReplayPlayer, ReplayRecorder, read_varint, state_digest
+
+CHOICES = [0, INPUT_LEFT, INPUT_RIGHT, INPUT_JUMP, INPUT_ATTACK, INPUT_SHIELD, INPUT_RIGHT | INPUT_ATTACK]
+
+def record(frames=1500):
+    # A seeded match with item rain and stage hazards, played by random
+    # held inputs
+    match = Match(STAGES['peachs_castle'], ['Mario', 'Fox', 'Samus'], seed=9, items=90)
+    assert match.hazards.enabled
+    recorder = ReplayRecorder(match)
+    rng = random.Random(9)
+    held = [0, 0, 0]
+    for frame in range(frames):
+        held = [rng.choice(CHOICES) if rng.random() < 0.1 else bits for bits in held]
+        recorder.step(held)
+    return recorder.finish()
+
+def downgrade(data, version):
+    # The same replay in an older layout: version 2 has no hazards byte,
+    # version 1 no item rate either
+    pos = struct.calcsize("<4sHIII")
+    pos += 1 + data[pos]
+    count = data[pos]
+    pos += 1
+    for i in range(count):
+        pos += 1 + data[pos]
+    items_end = read_varint(data, pos)[1]
+    old = bytearray(data[:pos] if version == 1 else data[:items_end])
+    old += data[items_end + 1:]
+    struct.pack_into("<H", old, 4, version)
+    return bytes(old)
+
+def test_bytes_round_trip():
+    replay = record()
+    data = replay.to_bytes()
+    loaded = Replay.from_bytes(data)
+    assert loaded.to_bytes() == data
+    assert (loaded.stage_id, loaded.characters, loaded.seed, loaded.items, loaded.hazards, loaded.digest) == \
+        (replay.stage_id, replay.characters, replay.seed, replay.items, replay.hazards, replay.digest)
+
+def test_old_versions_load():
+    replay = record(300)
+    data = replay.to_bytes()
+    v2 = Replay.from_bytes(downgrade(data, 2))
+    assert (v2.items, v2.hazards, v2.inputs) == (90, False, replay.inputs)
+    v1 = Replay.from_bytes(downgrade(data, 1))
+    assert (v1.items, v1.hazards, v1.inputs) == (0, False, replay.inputs)
+
+def test_verify():
+    replay = record()
+    assert ReplayPlayer(Replay.from_bytes(replay.to_bytes())).verify()
+    replay.digest ^= 1
+    assert not ReplayPlayer(replay).verify()
+
+def test_seek_matches_straight_playback():
+    replay = record()
+    player = ReplayPlayer(replay, snapshot_interval=200)
+    # Forwards past snapshots, back into earlier ones, and to the ends
+    for frame in [700, 1450, 250, 0, 999, 1500, 600]:
+        player.seek(frame)
+        straight = ReplayPlayer(replay)
+        straight.run_to(frame)
+        assert player.frame == frame
+        assert state_digest(player.match) == state_digest(straight.match), frame
@@ -0,0 +1,50 @@
+from collections import deque
+
+from koopasim import STAGES, Match, PlayerState, INPUT_JUMP
+from kooparollback import RollbackSession
+from koopareplay import state_digest
+
+DELAY = 8  # frames before a peer's input reaches the other
+
+def falling_match():
+    # P2 on its last stock, dropping towards the bottom blast zone: it
+    # survives only by jumping straight away
+    match = Match(STAGES['dream_land'], ['Mario', 'Fox'], seed=1)
+    p = match.players[1]
+    p.stocks = 1
+    p.x, p.y, p.vy = 980, 630, 6
+    p.grounded = False
+    p.state = PlayerState.FALLING
+    return match
+
+def test_predicted_ko_is_rolled_back():
+    sessions = [RollbackSession(falling_match(), [p]) for p in range(2)]
+    wire = deque()  # (arrival frame, player, frame, bits)
+    held = [lambda frame: 0, lambda frame: INPUT_JUMP if frame < 3 else 0]
+    first_ko = [None, None]  # frame each peer first saw the match end on
+    undone = False
+    for tick in range(200):
+        while wire and wire[0][0] <= tick:
+            arrival, player, frame, bits = wire.popleft()
+            sessions[1 - player].add_remote_input(player, frame, bits)
+        for p, session in enumerate(sessions):
+            if session.can_advance():
+                frame = session.add_local_input(held[p](session.frame))
+                wire.append((tick + DELAY, p, frame, held[p](frame)))
+            was_over = session.match.over
+            session.advance()
+            if session.match.over and first_ko[p] is None:
+                first_ko[p] = session.frame
+            if was_over and not session.match.over:
+                undone = True
+        if all(session.finished() for session in sessions):
+            break
+
+    # P1's peer guessed P2 kept still and saw it fall out, until P2's
+    # jump arrived and the KO was rolled back
+    assert undone
+    assert all(session.finished() for session in sessions)
+    assert sessions[0].frame == sessions[1].frame == first_ko[1]
+    assert first_ko[0] < sessions[0].frame
+    assert state_digest(sessions[0].match) == state_digest(sessions[1].match)
+    assert [p.stocks for p in sessions[0].match.players] == [4, 0]
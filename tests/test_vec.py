@@ -0,0 +1,55 @@
+import random
+
+import numpy as np
+import pytest
+
+from koopasim import (
+    STAGES, FIGHTER_STATE_FIELDS, Match,
+    INPUT_LEFT, INPUT_RIGHT, INPUT_JUMP, INPUT_DOWN, INPUT_ATTACK, INPUT_SHIELD,
+)
+from koopavec import BatchSim
+
+# Held inputs the random players pick from: walking, jumping, attacks
+# (the neutral ones throw projectiles), shields
+CHOICES = [0, INPUT_LEFT, INPUT_RIGHT, INPUT_ATTACK, INPUT_LEFT | INPUT_ATTACK, INPUT_RIGHT | INPUT_ATTACK,
+           INPUT_JUMP, INPUT_DOWN | INPUT_ATTACK, INPUT_SHIELD, INPUT_JUMP | INPUT_ATTACK]
+ROSTER = ['Mario', 'Fox', 'Samus', 'Pikachu', 'Luigi', 'DK']
+
+@pytest.mark.parametrize("count", [2, 3, 4])
+def test_batch_matches_scalar_until_first_ko(count):
+    # BatchSim.step re-implements Match.step; the CPU planner and the gym
+    # rely on the two playing the same game
+    stage_ids = list(STAGES)
+    characters = [[ROSTER[(m + i) % len(ROSTER)] for i in range(count)] for m in range(len(stage_ids))]
+    sim = BatchSim(stage_ids, characters, seed=3)
+    matches = [Match(STAGES[s], c, seed=3, hazards=False) for s, c in zip(stage_ids, characters)]
+    rng = random.Random(count)
+    held = np.zeros((len(matches), count), dtype=np.uint8)
+    running = set(range(len(matches)))
+    hits = 0
+    for frame in range(3000):
+        for m in running:
+            for i in range(count):
+                if rng.random() < 0.1:
+                    held[m, i] = rng.choice(CHOICES)
+        sim.step(held)
+        for m in sorted(running):
+            match = matches[m]
+            match.step([int(b) for b in held[m]])
+            if any(p.stocks < 4 for p in match.players):
+                # The two draw respawn points from different RNGs, so
+                # only the KO itself has to agree
+                assert [p.stocks for p in match.players] == [v.stocks for v in sim.fighters[m]], \
+                    (stage_ids[m], frame)
+                hits += 1
+                running.discard(m)
+                continue
+            for i, (fighter, view) in enumerate(zip(match.players, sim.fighters[m])):
+                for name in FIGHTER_STATE_FIELDS:
+                    assert getattr(view, name) == getattr(fighter, name), \
+                        (stage_ids[m], frame, i, name)
+            assert len(match.entities) == int((sim.e_life[m] > 0).sum()), (stage_ids[m], frame)
+        if not running:
+            break
+    # Every match got as far as a KO, so hits, knockback and blast zones ran
+    assert hits == len(matches)